@@ -0,0 +1,53 @@
+import asyncio
+import time
+
+
+class AdaptiveLimiter:
+    """
+    同時に実行するモデル呼び出しの上限を、バックエンドの遅延に応じて増減させる（AIMD）。
+    遅延の指標は呼び出しの壁時計時間を生成トークン数で割ったもの（ms/token）の指数移動平均。
+    これまでの最小値（サーバが空いているときの値）より tolerance 以上遅くなったら上限を backoff 倍に下げ、
+    そうでなければ上限と同じ回数だけ呼び出しが終わるごとに1つ上げる。
+    """
+    def __init__(self, initial=4, min_limit=1, max_limit=32, tolerance=0.5, backoff=0.75, alpha=0.2):
+        self.limit = max(min_limit, min(initial, max_limit))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.alpha = alpha
+        self.in_flight = 0
+        self.ewma = None
+        self.baseline = None
+        self.history = []
+        self._since_change = 0
+        self._cond = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+        return self
+
+    async def __aexit__(self, *exc):
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def observe(self, usage):
+        if not usage or usage.get("cached"):
+            return
+        latency = usage.get("wall_ms", 0.0) / max(1, usage.get("completion_tokens", 0))
+        self.ewma = latency if self.ewma is None else self.alpha * latency + (1 - self.alpha) * self.ewma
+        self.baseline = self.ewma if self.baseline is None else min(self.baseline, self.ewma)
+        self._since_change += 1
+        if self._since_change < self.limit:
+            return
+        if self.ewma > self.baseline * (1 + self.tolerance):
+            new_limit = max(self.min_limit, int(self.limit * self.backoff))
+        else:
+            new_limit = min(self.max_limit, self.limit + 1)
+        if new_limit != self.limit:
+            self.history.append((round(time.time(), 3), self.limit, new_limit, round(self.ewma, 3)))
+            self.limit = new_limit
+        self._since_change = 0
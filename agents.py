@@ -1,26 +1,53 @@
 import re
 import sys
 import contextlib
-from llama_cpp import Llama
+import threading
+import time
+import llama_cpp
+from llama_cpp import Llama, LlamaGrammar
+import numpy as np
 import json
 from enum import Enum
+from metrics import UsageTimer
+from json_stream import JsonFieldScanner, parse_partial
+from native_log import native_log
+from speculative import supports_drafting
 
 class OutputFormat(Enum):
     JSON = "json"
     PLAIN = "plain"
 
+class MBTIAnswer(Enum):
+    A = "A"
+    B = "B"
+
+_suppress_lock = threading.Lock()
+_suppress_depth = 0
+_saved_streams = None
+
 @contextlib.contextmanager
 def suppress_stdout_stderr():
-    with open('/dev/null', 'w') as devnull:
-        old_stdout = sys.stdout
-        old_stderr = sys.stderr
-        sys.stdout = devnull
-        sys.stderr = devnull
-        try:
-            yield
-        finally:
-            sys.stdout = old_stdout
-            sys.stderr = old_stderr
+    # 複数スレッドから同時に使われても元のストリームを正しく戻せるよう、ネスト数で管理する。
+    # native_log をインストールしていれば、llama.cpp が fd 1/2 に直接書く出力もそのリングバッファに取り込む
+    global _suppress_depth, _saved_streams
+    with _suppress_lock:
+        if _suppress_depth == 0:
+            devnull = open('/dev/null', 'w')
+            _saved_streams = (sys.stdout, sys.stderr, devnull)
+            sys.stdout = devnull
+            sys.stderr = devnull
+            native_log.redirect()
+        _suppress_depth += 1
+    try:
+        yield
+    finally:
+        with _suppress_lock:
+            _suppress_depth -= 1
+            if _suppress_depth == 0:
+                native_log.restore()
+                sys.stdout, sys.stderr, devnull = _saved_streams
+                _saved_streams = None
+                devnull.close()
 
 def filter_repetitions(text, max_length=200):
     """
@@ -34,16 +61,82 @@ def filter_repetitions(text, max_length=200):
         filtered.append(line)
     return "\n".join(filtered)
 
+# ディベートの各ターンを {"reasoning": "...", "answer": "A"～"D"} の JSON に制約する GBNF 文法。
+# オブジェクトが閉じた時点で EOS 以外を許さないので、そこで生成が止まる。
+DEBATE_JSON_GBNF = r"""
+root   ::= "{" ws "\"reasoning\"" ws ":" ws string ws "," ws "\"answer\"" ws ":" ws answer ws "}"
+answer ::= "\"" [A-D] "\""
+string ::= "\"" ( [^"\\\x7F\x00-\x1F] | "\\" ( ["\\/bfnrt] | "u" [0-9a-fA-F] [0-9a-fA-F] [0-9a-fA-F] [0-9a-fA-F] ) )* "\""
+ws     ::= [ \t\n]?
+"""
+
+_debate_json_grammar = None
+
+def get_debate_json_grammar():
+    global _debate_json_grammar
+    if _debate_json_grammar is None:
+        with suppress_stdout_stderr():
+            _debate_json_grammar = LlamaGrammar.from_string(DEBATE_JSON_GBNF, verbose=False)
+    return _debate_json_grammar
+
+# チャットテンプレートが1メッセージごとに足すトークン（llama-3 ならヘッダと <|eot_id|> で5つ）の見積もり
+CHAT_MESSAGE_OVERHEAD_TOKENS = 8
+
+class ChatMessage:
+    """
+    会話履歴の1発言。role は "system" / "user" / "assistant"。
+    n_tokens はテンプレート分を含むトークン数で、初めて必要になったときに数えて保持する。
+    """
+    __slots__ = ("role", "content", "n_tokens")
+
+    def __init__(self, role, content, n_tokens=None):
+        self.role = role
+        self.content = content
+        self.n_tokens = n_tokens
+
+    def token_count(self, model):
+        if self.n_tokens is None:
+            tokens = model.tokenize(self.content.encode("utf-8"), add_bos=False, special=True)
+            self.n_tokens = len(tokens) + CHAT_MESSAGE_OVERHEAD_TOKENS
+        return self.n_tokens
+
+    def as_dict(self):
+        return {"role": self.role, "content": self.content}
+
+    def __repr__(self):
+        return f"ChatMessage({self.role!r}, {self.content!r})"
+
 class LlamaAgent:
     """
     各エージェントは、システムプロンプトにより性格特性を与え、
     議論中にその個性を反映した理由付け（reasoning）を生成する。
     """
-    def __init__(self, name, personality_text, model, max_tokens=512):
+    def __init__(self, name, personality_text, model, max_tokens=512, kv_cache=None, output_format=OutputFormat.PLAIN, completion_cache=None, stream_stop=None, profiler=None,
+                 draft_model=None):
         self.name = name
         self.personality_text = personality_text
         self.model = model
         self.max_tokens = max_tokens
+        # OutputFormat.JSON のとき、ディベートの回答を DEBATE_JSON_GBNF で制約して生成する
+        self.output_format = output_format
+        # completion_cache.CompletionCache。シード指定の呼び出し結果をディスクから再利用する
+        self.completion_cache = completion_cache
+        # ストリーミングで生成し、JSON の "answer" が閉じた時点（"answer"）または
+        # オブジェクトが閉じた時点（"object"）でデコードを打ち切る。None なら最後まで生成する
+        self.stream_stop = stream_stop
+        # 直前のモデル呼び出しの使用量（metrics.UsageTimer.finish の結果）
+        self.last_usage = None
+        # metrics.CallProfiler。モデル呼び出しのたびに last_usage を記録する
+        self.profiler = profiler
+        # KV 状態の復元・保存を担うオブジェクト（kv_cache.PersonaStateCache など）。None なら何もしない
+        self.kv_cache = kv_cache
+        # 投機デコードの下書き（speculative.PromptLookupDraft）。ディベートの生成の間だけモデルに付ける
+        self.draft_model = draft_model
+        if draft_model is not None:
+            if getattr(model, "is_remote", False):
+                raise ValueError("speculative decoding with a server backend is configured on llama.cpp server itself")
+            if not supports_drafting(model):
+                raise ValueError("speculative decoding needs a model loaded with logits_all=True")
         if personality_text == "":
             self.system_message = f"System: You are {self.name}.\n"
         else:
@@ -55,79 +148,227 @@ class LlamaAgent:
                 "if you are enthusiastic, include personal insights. "
                 "When answering multiple-choice questions, output your answer in JSON format with the keys \"reasoning\" and \"answer\"."
             )
-        self.conversation_history = [self.system_message]
+        self._system_entry = ChatMessage("system", self.system_message[len("System:"):].strip())
+        self.conversation_history = [self._system_entry]
+        # MBTI モード中は generate_response が A/B の1トークン選択になる
+        self.mbti_mode = False
+        self.last_mbti_probs = None
+
+    def set_mbti_mode(self, enabled: bool):
+        self.mbti_mode = enabled
+
+    def history_tokens(self):
+        return sum(message.token_count(self.model) for message in self.conversation_history)
 
-    def _trim_conversation_history(self, max_lines=6):
-        # 常にシステムプロンプト（最初の1行）は保持し、直近(max_lines-1)行だけ残す
-        if len(self.conversation_history) > max_lines:
-            self.conversation_history = [self.conversation_history[0]] + self.conversation_history[-(max_lines-1):]
+    def _trim_conversation_history(self):
+        """
+        履歴全体が n_ctx - max_tokens（生成分を残したプロンプトの上限）に収まるまで、
+        システムプロンプトと最新の発言を残して古い発言から捨てる。
+        捨てた後の先頭がアシスタントの発言になる場合はそれも捨て、user から始まるようにする。
+        """
+        budget = self.model.n_ctx() - self.max_tokens
+        total = self.history_tokens()
+        history = self.conversation_history
+        while total > budget and len(history) > 2:
+            total -= history.pop(1).token_count(self.model)
+            while len(history) > 2 and history[1].role == "assistant":
+                total -= history.pop(1).token_count(self.model)
 
     def reset_history(self):
-        self.conversation_history = [self.system_message]
+        # システムプロンプトのメッセージは使い回すので、トークン数は最初の1回だけ数える
+        self.conversation_history = [self._system_entry]
     
-    def generate_response(self, prompt):
-        # ユーザ発言を履歴に追加（文字列）
-        self.conversation_history.append(f"User: {prompt}")
-        self._trim_conversation_history(max_lines=10)
-        
-        # conversation_history は文字列のリストなので、各行を分解してメッセージ辞書のリストに変換する
-        messages = []
-        for line in self.conversation_history:
-            # 既に辞書型の場合はそのまま利用（万が一）
-            if isinstance(line, dict):
-                messages.append(line)
-                continue
-            # 文字列の場合は、先頭の "Role:" 部分を切り出して辞書に変換
-            if line.startswith("System:"):
-                messages.append({"role": "system", "content": line[len("System:"):].strip()})
-            elif line.startswith("User:"):
-                messages.append({"role": "user", "content": line[len("User:"):].strip()})
-            elif line.startswith(f"{self.name}:"):
-                messages.append({"role": "assistant", "content": line[len(f"{self.name}:"):].strip()})
-            else:
-                # そのほかの行はユーザ発言として扱う
-                messages.append({"role": "user", "content": line.strip()})
-        
-        with suppress_stdout_stderr():
-            output = self.model.create_chat_completion(
-                messages,
-                max_tokens=self.max_tokens,
-                temperature=0.7,
-                top_p=0.9,
-                stop=["System:", "User:"],
-                seed=-1
-            )
+    def generate_response(self, prompt, seed=None, round=None, queued_at=None):
+        """
+        seed を指定すると決定的にサンプリングし、completion_cache があれば結果を再利用する。
+        None のときは従来通り毎回ランダム（キャッシュもしない）。
+        round と queued_at（呼び出しを受け付けた time.perf_counter() の値）は profiler への記録に使う。
+        """
+        if self.mbti_mode:
+            answer, self.last_mbti_probs = self.answer_mbti(prompt)
+            return answer.value
+        self.conversation_history.append(ChatMessage("user", prompt))
+        self._trim_conversation_history()
+        messages = [message.as_dict() for message in self.conversation_history]
+
+        output = self._chat_completion(messages, seed, round=round, queued_at=queued_at)
         
         # llama-cpp-python の返り値は "choices" 内の "message" キーに回答内容が入っている前提
         try:
             json_response = json.loads(output['choices'][0]['message']['content'].strip())
         except json.JSONDecodeError:
-            json_response = {"reasoning": "", "answer": output['choices'][0]['message']['content'].strip()}
+            # 途中で打ち切った回答は閉じたフィールドだけを使う（answer があれば多数決に使える）
+            partial = parse_partial(output['choices'][0]['message']['content'])
+            if "answer" in partial:
+                json_response = {"reasoning": partial.get("reasoning", ""), "answer": partial["answer"]}
+            else:
+                json_response = {"reasoning": "", "answer": output['choices'][0]['message']['content'].strip()}
         
-        # 生成結果を会話履歴に追加
-        self.conversation_history.append(f"{self.name}: {output['choices'][0]['message']['content'].strip()}")
+        # 生成結果を会話履歴に追加（completion_tokens がわかればそれを件数として使う）
+        content = output['choices'][0]['message']['content'].strip()
+        completion_tokens = output.get("usage", {}).get("completion_tokens")
+        n_tokens = completion_tokens + CHAT_MESSAGE_OVERHEAD_TOKENS if completion_tokens else None
+        self.conversation_history.append(ChatMessage("assistant", content, n_tokens=n_tokens))
         return json_response
 
 
 
-    def get_bfi_score(self, question_text: str, question_index: int, n_questions: int) -> int:
+    def _record_call(self, kind, round=None):
+        if self.profiler is not None:
+            self.profiler.record(self.name, kind, self.last_usage, round=round)
+
+    @contextlib.contextmanager
+    def _drafting(self, round=None):
+        """ディベートの生成の間だけモデルに下書きを付ける（同じモデルを使う BFI・MBTI や他のエージェントには影響しない）。"""
+        if self.draft_model is None or not self.draft_model.applies_to(round):
+            yield
+            return
+        previous = getattr(self.model, "draft_model", None)
+        self.model.draft_model = self.draft_model
+        try:
+            yield
+        finally:
+            self.model.draft_model = previous
+
+    def _chat_completion(self, messages, seed=None, round=None, queued_at=None):
+        params = {
+            "max_tokens": self.max_tokens,
+            "temperature": 0.7,
+            "top_p": 0.9,
+            "stop": ["System:", "User:"],
+        }
+        cache_key = None
+        if self.completion_cache is not None and seed is not None:
+            cache_key = self.completion_cache.make_key(
+                self.model, "chat",
+                {"messages": messages, "output_format": self.output_format.value, "stream_stop": self.stream_stop, "seed": seed, **params}
+            )
+            output = self.completion_cache.get(cache_key)
+            if output is not None:
+                self.last_usage = UsageTimer(self.model, queued_at).finish(output, cached=True)
+                self._record_call("chat", round)
+                return output
+
+        if self.kv_cache is not None:
+            self.kv_cache.prepare(self, messages)
+        grammar = None
+        if self.output_format == OutputFormat.JSON:
+            # HTTP のバックエンド（llama_server.LlamaServerClient）には GBNF の文字列をそのまま渡す
+            grammar = DEBATE_JSON_GBNF if getattr(self.model, "is_remote", False) else get_debate_json_grammar()
+        with self._drafting(round):
+            timer = UsageTimer(self.model, queued_at)
+            with suppress_stdout_stderr():
+                if self.stream_stop is not None:
+                    output = self._stream_chat_completion(messages, seed, grammar, timer, params)
+                else:
+                    output = self.model.create_chat_completion(
+                        messages,
+                        seed=-1 if seed is None else seed,
+                        grammar=grammar,
+                        **params
+                    )
+            self.last_usage = timer.finish(output)
+        self._record_call("chat", round)
+        if self.kv_cache is not None:
+            self.kv_cache.commit(self)
+        if cache_key is not None:
+            self.completion_cache.put(cache_key, "chat", output)
+        return output
+
+    def _stream_chat_completion(self, messages, seed, grammar, timer, params):
+        """
+        create_chat_completion をストリーミングで呼び、JSON を読みながら stream_stop の条件を満たしたら
+        ジェネレータを閉じてデコードを止める。返り値は通常の呼び出しと同じ形に組み立てる。
+        llama_cpp のストリームには usage が付かないので、デコードしたトークン数とコンテキスト長から求める
+        （投機デコード中は1ステップで複数トークンを確定するので、生成したテキストをトークン化して数える）。
+        """
+        scanner = JsonFieldScanner()
+        pieces = []
+        finish_reason = None
+        usage = None
+        stream = self.model.create_chat_completion(
+            messages,
+            seed=-1 if seed is None else seed,
+            grammar=grammar,
+            stream=True,
+            **params
+        )
+        try:
+            for chunk in stream:
+                usage = chunk.get("usage") or usage
+                choice = chunk["choices"][0]
+                piece = choice["delta"].get("content")
+                if piece:
+                    pieces.append(piece)
+                    if scanner.feed(piece).done(self.stream_stop):
+                        finish_reason = self.stream_stop
+                        break
+                if choice.get("finish_reason"):
+                    finish_reason = choice["finish_reason"]
+        finally:
+            stream.close()
+        if usage is not None:
+            prompt_tokens, completion_tokens = usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+        elif self.draft_model is not None:
+            text = "".join(pieces).encode("utf-8")
+            completion_tokens = len(self.model.tokenize(text, add_bos=False)) if pieces else 0
+            prompt_tokens = max(0, self.model.n_tokens - max(0, completion_tokens - 1))
+        else:
+            decoded = timer.timings["decode_tokens"] - timer.before["decode_tokens"]
+            completion_tokens = decoded + 1 if pieces else 0
+            prompt_tokens = self.model.n_tokens - decoded
+        return {
+            "object": "chat.completion",
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(pieces)},
+                "finish_reason": finish_reason,
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    def _completion(self, prompt, seed=None, **params):
+        cache_key = None
+        if self.completion_cache is not None and seed is not None:
+            cache_key = self.completion_cache.make_key(self.model, "completion", {"prompt": prompt, "seed": seed, **params})
+            output = self.completion_cache.get(cache_key)
+            if output is not None:
+                self.last_usage = UsageTimer(self.model).finish(output, cached=True)
+                self._record_call("completion")
+                return output
+        timer = UsageTimer(self.model)
+        with suppress_stdout_stderr():
+            output = self.model(prompt, seed=-1 if seed is None else seed, **params)
+        self.last_usage = timer.finish(output)
+        self._record_call("completion")
+        if cache_key is not None:
+            self.completion_cache.put(cache_key, "completion", output)
+        return output
+
+    def _bfi_prompt(self, question_text: str, question_index: int, n_questions: int) -> str:
         system_prompt = (
             f"System: You are {self.name} with personality traits:\n{self.personality_text}\n"
             "Here are a number of characteristics that may or may not apply to you. For example, do you agree that you are someone who likes to spend time with others? Please write a number next to each statement to indicate the extent to which you agree or disagree with that statement.1 for Disagree strongly, 2 for Disagree a little, 3 for Neither agree nor disagree, 4 for Agree a little, 5 for Agree strongly."
             "For the following BFI question, respond with ONLY a single digit (1-5) without explanation."
         )
         user_prompt = f"BFI Q{question_index}/{n_questions}: {question_text}\n(1-5)?"
-        full_prompt = f"{system_prompt}\nUser: {user_prompt}\n{self.name}:"
+        return f"{system_prompt}\nUser: {user_prompt}\n{self.name}:"
+
+    def get_bfi_score(self, question_text: str, question_index: int, n_questions: int, seed=None) -> int:
+        full_prompt = self._bfi_prompt(question_text, question_index, n_questions)
         stop_tokens = ["Agent1:", "Agent2:", "Agent3:", "System:", "User:", "\n\n"]
-        with suppress_stdout_stderr():
-            output = self.model(
-                full_prompt,
-                max_tokens=20,
-                temperature=0.7,
-                top_p=0.9,
-                stop=stop_tokens,
-                seed=-1
-            )
+        output = self._completion(
+            full_prompt,
+            seed=seed,
+            max_tokens=20,
+            temperature=0.7,
+            top_p=0.9,
+            stop=stop_tokens
+        )
         if 'choices' in output and len(output['choices']) > 0:
             raw = output['choices'][0]['text'].strip()
             m = re.search(r"\b([1-5])\b", raw)
@@ -136,35 +377,187 @@ class LlamaAgent:
                 return int(m.group(1))
         return 0
 
+    def get_bfi_distribution(self, question_text: str, question_index: int, n_questions: int) -> dict:
+        """
+        サンプリングせず、プロンプト直後のトークン分布から 1～5 の確率を返す（1回の順伝播のみ）。
+        """
+        full_prompt = self._bfi_prompt(question_text, question_index, n_questions)
+        probs = self._next_token_distribution(full_prompt, [f" {d}" for d in range(1, 6)])
+        return {int(option): p for option, p in probs.items()}
+
+    def answer_mbti(self, question_prompt: str):
+        """
+        MBTI の質問に A/B のどちらかで答える。生成はせず、1回の順伝播で
+        " A" と " B" の次トークン確率を比べる。(MBTIAnswer, {"A": p, "B": p}) を返す。
+        """
+        full_prompt = f"{self.system_message.rstrip()}\nUser: {question_prompt}\n{self.name}:"
+        probs = self._next_token_distribution(full_prompt, [" A", " B"])
+        answer = MBTIAnswer.A if probs["A"] >= probs["B"] else MBTIAnswer.B
+        return answer, probs
+
+    def _next_token_distribution(self, prompt: str, options: list) -> dict:
+        """
+        prompt の直後に options（各々1トークンになる文字列）のどれが続くかの確率を、
+        次トークンの logits から求めて options 内で正規化して返す。
+        options 間で共通の接頭トークン（先頭の空白など）はプロンプト側に含めて評価する。
+        KV キャッシュに残っている共通プレフィックスは再評価しない。
+        HTTP のバックエンドでは、サーバが返す上位トークンの logprobs から求める。
+        """
+        if hasattr(self.model, "next_token_distribution"):
+            timer = UsageTimer(self.model)
+            probs = self.model.next_token_distribution(prompt, options)
+            self.last_usage = timer.finish({"usage": {"prompt_tokens": self.model.n_tokens, "completion_tokens": 0}})
+            self._record_call("logits")
+            return probs
+        option_tokens = [self.model.tokenize((prompt + option).encode("utf-8"), add_bos=True, special=True) for option in options]
+        context_len = min(len(toks) - 1 for toks in option_tokens)
+        for toks in option_tokens[1:]:
+            context_len = min(context_len, Llama.longest_token_prefix(option_tokens[0], toks))
+        context = option_tokens[0][:context_len]
+        option_ids = []
+        for option, toks in zip(options, option_tokens):
+            if toks[:context_len] != context or len(toks) != context_len + 1:
+                raise ValueError(f"option {option!r} is not a single token after the prompt")
+            option_ids.append(toks[context_len])
+
+        timer = UsageTimer(self.model)
+        with suppress_stdout_stderr():
+            n_past = Llama.longest_token_prefix(self.model._input_ids.tolist(), context[:-1])
+            self.model.n_tokens = n_past
+            self.model.eval(context[n_past:])
+        self.last_usage = timer.finish({"usage": {"prompt_tokens": len(context), "completion_tokens": 0}})
+        self._record_call("logits")
+        if getattr(self.model, "_logits_all", False):
+            logits = self.model.scores[self.model.n_tokens - 1]
+        else:
+            logits = np.ctypeslib.as_array(llama_cpp.llama_get_logits(self.model.ctx), shape=(self.model.n_vocab(),))
+        logprobs = Llama.logits_to_logprobs(logits)
+        option_logprobs = np.array([logprobs[i] for i in option_ids], dtype=np.float64)
+        weights = np.exp(option_logprobs - option_logprobs.max())
+        weights /= weights.sum()
+        return {option.strip(): float(w) for option, w in zip(options, weights)}
+
+class StoppingPolicy:
+    """
+    ディベートを途中で打ち切る条件。各ラウンドの後に check() を呼び、打ち切るならその理由を返す。
+        unanimous_after : このラウンド以降、3体の有効な回答（A～D）がすべて一致したら打ち切る
+        stable_majority : 多数派の回答が直前のラウンドと同じなら打ち切る
+        max_tokens      : 1問あたりのトークン（prompt + completion）の上限。
+                          これまでの使用量に直前のラウンドの使用量（次のラウンドの見積もり）を足すと
+                          上限を超える場合に打ち切る
+    どれも None / False なら打ち切らない（従来どおり全ラウンドを行う）。
+    """
+    def __init__(self, unanimous_after=None, stable_majority=False, max_tokens=None):
+        self.unanimous_after = unanimous_after
+        self.stable_majority = stable_majority
+        self.max_tokens = max_tokens
+
+    def config(self):
+        return {"unanimous_after": self.unanimous_after, "stable_majority": self.stable_majority, "max_tokens": self.max_tokens}
+
+    @staticmethod
+    def _majority(answers):
+        votes = {}
+        for ans in answers:
+            if ans != "N/A":
+                votes[ans] = votes.get(ans, 0) + 1
+        if not votes:
+            return None
+        best = max(votes, key=votes.get)
+        return best if votes[best] * 2 > len(answers) else None
+
+    def check(self, triad, turn):
+        answers = [triad.extract_answer(resp) for resp in triad.round_responses[turn].values()]
+        if self.unanimous_after is not None and turn >= self.unanimous_after:
+            if "N/A" not in answers and len(set(answers)) == 1:
+                return "unanimous"
+        if self.stable_majority and turn - 1 in triad.round_responses:
+            previous = [triad.extract_answer(resp) for resp in triad.round_responses[turn - 1].values()]
+            majority = self._majority(answers)
+            if majority is not None and majority == self._majority(previous):
+                return "stable_majority"
+        if self.max_tokens is not None:
+            def round_tokens(usages):
+                return sum(u.get("prompt_tokens", 0) + u.get("completion_tokens", 0) for u in usages.values() if u)
+            spent = sum(round_tokens(usages) for usages in triad.round_usage.values())
+            if spent + round_tokens(triad.round_usage.get(turn, {})) > self.max_tokens:
+                return "token_budget"
+        return None
+
+
 class AgentTriad:
     """
     3体のエージェントによるディベートを管理するクラス。
     ターン1では初回回答、ターン2以降では他エージェントの回答を参照して更新回答を生成する。
     最終回答は、3ターン目の各エージェントのJSON出力から「answer」を抽出し、多数決で決定する。
     """
-    def __init__(self, agentX, agentY, agentZ):
+    def __init__(self, agentX, agentY, agentZ, executor=None, stopping_policy=None, compactor=None):
         self.agents = [agentX, agentY, agentZ]
         self.round_responses = {}
+        # StoppingPolicy を渡すと、条件を満たした時点で残りのラウンドを省く。
+        # stop_reason に直近のディベートで打ち切った理由（打ち切らなければ None）を残す
+        self.stopping_policy = stopping_policy
+        self.stop_reason = None
+        # peer_compactor.PeerCompactor を渡すと、プロンプトに埋め込む他エージェントの回答をトークン予算内に縮める
+        self.compactor = compactor
+        # round_responses と同じ形で、各回答の使用量（トークン数・時間）を保持する
+        self.round_usage = {}
+        # round_executor.RoundExecutor を渡すと、1ラウンド内の各エージェントの生成を並行して行う
+        self.executor = executor
+
+    def run_round(self, prompts, label=None, seeds=None):
+        """
+        各エージェントに対応するプロンプトで1ラウンド分の回答を生成し、{エージェント名: 回答} を返す。
+        回答の順序は常に self.agents の順。seeds を渡すと各エージェントの生成に使う。
+        """
+        seeds = seeds or [None] * len(self.agents)
+        calls = list(zip(self.agents, prompts, seeds))
+        if self.executor is not None:
+            responses = self.executor.run(calls, label=label)
+        else:
+            queued_at = time.perf_counter()
+            responses = [agent.generate_response(prompt, seed=seed, round=label, queued_at=queued_at) for agent, prompt, seed in calls]
+        if label is not None:
+            self.round_usage[label] = {agent.name: agent.last_usage for agent in self.agents}
+        return {agent.name: response for agent, response in zip(self.agents, responses)}
+
+    def peer_responses(self, turn, agent):
+        """turn ラウンドの、agent 以外のエージェントの回答（compactor があれば縮めたもの）を返す。"""
+        others = [self.round_responses[turn][a.name] for a in self.agents if a.name != agent.name]
+        if self.compactor is None:
+            return others
+        return [self.compactor.compact(resp) for resp in others]
+
+    def should_stop(self, turn):
+        """turn ラウンドの後で打ち切るかを判定し、打ち切るなら stop_reason を設定して True を返す。"""
+        if self.stopping_policy is None:
+            return False
+        self.stop_reason = self.stopping_policy.check(self, turn)
+        return self.stop_reason is not None
 
     def conduct_discussion(self, topic_prompt, max_turns=3):
         print("\n=== Round 1 ===")
-        self.round_responses[1] = {}
         # ターン1：初回回答
         round1_prompt = (
             "Can you answer the following question as accurately as possible? "
             f"{{{topic_prompt}}} Explain your answer, putting the answer in the form (X) at the end of your response. "
             "Please also reflect your personality in your explanation."
         )
-        for agent in self.agents:
-            response = agent.generate_response(round1_prompt)
-            self.round_responses[1][agent.name] = response
+        # 前の議題のラウンドの回答・使用量・打ち切り理由を持ち越さない（main.run_debate と同じ）
+        self.round_responses = {}
+        self.round_usage = {}
+        self.stop_reason = None
+        self.round_responses[1] = self.run_round([round1_prompt] * len(self.agents), label=1)
 
         # ターン2以降：他エージェントの直前の回答を参照するプロンプト
         for turn in range(2, max_turns+1):
+            if self.should_stop(turn-1):
+                print(f"[INFO] Early stop after round {turn-1}: {self.stop_reason}")
+                break
             print(f"\n=== Round {turn} ===")
-            self.round_responses[turn] = {}
+            prompts = []
             for agent in self.agents:
-                other_responses = [self.round_responses[turn-1][a.name] for a in self.agents if a.name != agent.name]
+                other_responses = self.peer_responses(turn-1, agent)
                 debate_prompt = (
                     "These are the solutions to the question from other agents:\n"
                     f"One agent solution: {other_responses[0]}\n"
@@ -175,38 +568,38 @@ class AgentTriad:
                     "Output your answer in JSON format with the format: {\"reasoning\": \"\", \"answer\": \"\"}. "
                     "Please strictly output in JSON format."
                 )
-                response = agent.generate_response(debate_prompt)
-                self.round_responses[turn][agent.name] = response
+                prompts.append(debate_prompt)
+            self.round_responses[turn] = self.run_round(prompts, label=turn)
 
-    def get_final_consensus(self):
-        final_round = self.round_responses.get(max(self.round_responses.keys()), {})
-        extracted = {}
-        for agent_name, resp in final_round.items():
-            # もし resp が dict 型なら、直接 "answer" キーを利用する
-            if isinstance(resp, dict):
-                ans_value = resp.get("answer", "")
+    @staticmethod
+    def extract_answer(resp):
+        """1件の回答（dict または文字列）から選択肢を取り出す。取り出せなければ "N/A"。"""
+        # もし resp が dict 型なら、直接 "answer" キーを利用する
+        if isinstance(resp, dict):
+            ans_value = resp.get("answer", "")
+            if isinstance(ans_value, int):
+                ans_value = str(ans_value)
+            return ans_value.strip() if ans_value else "N/A"
+        # resp が文字列の場合は、正規表現で JSON 部分を抽出する
+        m_json = re.search(r'(\{.*\})', resp, re.DOTALL)
+        if m_json:
+            json_str = m_json.group(1)
+            try:
+                response_data = json.loads(json_str)
+                ans_value = response_data.get("answer", "")
                 if isinstance(ans_value, int):
                     ans_value = str(ans_value)
-                extracted[agent_name] = ans_value.strip() if ans_value else "N/A"
-            else:
-                # resp が文字列の場合は、正規表現で JSON 部分を抽出する
-                m_json = re.search(r'(\{.*\})', resp, re.DOTALL)
-                if m_json:
-                    json_str = m_json.group(1)
-                    try:
-                        response_data = json.loads(json_str)
-                        ans_value = response_data.get("answer", "")
-                        if isinstance(ans_value, int):
-                            ans_value = str(ans_value)
-                        extracted[agent_name] = str(ans_value).strip('"') if ans_value else "N/A"
-                    except json.JSONDecodeError:
-                        extracted[agent_name] = "N/A"
-                else:
-                    m = re.search(r"\(([A-D])\)", resp)
-                    if m:
-                        extracted[agent_name] = m.group(1).upper()
-                    else:
-                        extracted[agent_name] = "N/A"
+                return str(ans_value).strip('"') if ans_value else "N/A"
+            except (json.JSONDecodeError, AttributeError):
+                return "N/A"
+        m = re.search(r"\(([A-D])\)", resp)
+        if m:
+            return m.group(1).upper()
+        return "N/A"
+
+    def get_final_consensus(self):
+        final_round = self.round_responses.get(max(self.round_responses.keys()), {})
+        extracted = {agent_name: self.extract_answer(resp) for agent_name, resp in final_round.items()}
         votes = {}
         for ans in extracted.values():
             if ans != "N/A":
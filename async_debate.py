@@ -0,0 +1,225 @@
+import asyncio
+import csv
+import io
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from adaptive_limiter import AdaptiveLimiter
+from agents import AgentTriad
+from completion_cache import derive_seed
+from event_log import TextLog
+from main import (MMLU_FIELDNAMES, build_agents, format_mmlu_question, log_round, make_debate_prompt, make_round1_prompt,
+                  record_question)
+from metrics import TokenLedger
+
+
+class AsyncAgentTriad:
+    """
+    AgentTriad の非同期版。ラウンド内の各エージェントの生成を executor のスレッドで並行に行い、
+    ラウンドの状態（round_responses など）と打ち切り・縮約・多数決は内側の AgentTriad をそのまま使う。
+    エージェントはそれぞれ別のクライアント（llama_server.LlamaServerClient）を持つ前提。
+    """
+    def __init__(self, triad, limiter, executor):
+        self.triad = triad
+        self.limiter = limiter
+        self.executor = executor
+
+    async def _call(self, agent, prompt, seed, label):
+        loop = asyncio.get_running_loop()
+        async with self.limiter:
+            queued_at = time.perf_counter()
+            response = await loop.run_in_executor(
+                self.executor, lambda: agent.generate_response(prompt, seed=seed, round=label, queued_at=queued_at)
+            )
+        self.limiter.observe(agent.last_usage)
+        return response
+
+    async def run_round(self, prompts, label, seeds=None):
+        seeds = seeds or [None] * len(self.triad.agents)
+        responses = await asyncio.gather(*(
+            self._call(agent, prompt, seed, label) for agent, prompt, seed in zip(self.triad.agents, prompts, seeds)
+        ))
+        self.triad.round_usage[label] = {agent.name: agent.last_usage for agent in self.triad.agents}
+        return {agent.name: response for agent, response in zip(self.triad.agents, responses)}
+
+    async def run_debate(self, question_text, log_f, seed_key=None, multiple_choice=True):
+        """main.run_debate と同じ手順（最大3ラウンド、打ち切り条件つき）で1問を議論し、最終回答を返す。"""
+        triad = self.triad
+        agents = triad.agents
+        loop = asyncio.get_running_loop()
+
+        def round_seeds(turn):
+            if seed_key is None:
+                return None
+            return [derive_seed(*seed_key, agent.name, turn) for agent in agents]
+
+        for agent in agents:
+            agent.reset_history()
+        log_f.write("\n=== Round 1 ===\n")
+        triad.round_responses = {}
+        triad.round_usage = {}
+        triad.stop_reason = None
+        round1_prompt = make_round1_prompt(question_text, multiple_choice)
+        triad.round_responses[1] = await self.run_round([round1_prompt] * len(agents), 1, round_seeds(1))
+        log_round(triad, 1, log_f)
+        for turn in range(2, 4):
+            if triad.should_stop(turn-1):
+                log_f.write(f"\n[Early stop] policy={triad.stop_reason} after round {turn-1}\n")
+                break
+            log_f.write(f"\n=== Round {turn} ===\n")
+            # 縮約（PeerCompactor）はトークン化や要約でサーバを同期的に呼ぶので、イベントループを止めないよう executor で行う
+            prompts = await asyncio.gather(*(
+                loop.run_in_executor(self.executor, lambda agent=agent: make_debate_prompt(triad.peer_responses(turn-1, agent)))
+                for agent in agents
+            ))
+            triad.round_responses[turn] = await self.run_round(prompts, turn, round_seeds(turn))
+            log_round(triad, turn, log_f)
+        final_answer = triad.get_final_consensus()
+        log_f.write(f"\n[Final Consensus Answer] answer: {final_answer}\n")
+        return final_answer
+
+
+def make_async_triads(model, personalities, n_triads, limiter, executor, stopping_policy=None, compactor=None, **agent_kwargs):
+    """
+    同時に議論する問題の数だけ、エージェント3体の組を作る。エージェントごとに
+    model.with_shared_pool() のクライアント（接続プールは共有）を持たせる。
+    """
+    if not hasattr(model, "with_shared_pool"):
+        raise ValueError("the async debate engine needs a server backend (llama_server.LlamaServerClient)")
+    triads = []
+    for _ in range(n_triads):
+        models = [model.with_shared_pool() for _ in personalities]
+        agents = build_agents(models, personalities, **agent_kwargs)
+        triads.append(AsyncAgentTriad(AgentTriad(*agents, stopping_policy=stopping_policy, compactor=compactor), limiter, executor))
+    return triads
+
+
+async def run_mmlu_async(model, personalities, dl, indices, results_csv, debate_log_file, max_inflight=8, limiter=None,
+                         journal=None, seed=None, events=None, results=None, stopping_policy=None, compactor=None, **agent_kwargs):
+    """
+    run_mmlu の非同期版。最大 max_inflight 問のディベートを同時に進め、サーバの並列スロットを使い切る。
+    同時に走るモデル呼び出しの数は limiter（AdaptiveLimiter）が遅延を見ながら調整する。
+    問題は終わった順に記録するが、結果 CSV とディベートログは問題番号の順に書き出す
+    （先の問題が終わるまで後の問題の行はメモリに保持する）。(正解数, 採点対象数) を返す。
+    1問でも失敗したら新しい問題は始めず、残りを取り消してから、順番どおりに書ける行まで書き出して例外を送出する
+    （書き出せなかった完了済みの問題もジャーナルには記録されているので、再開すれば飛ばされる）。
+    問題の先読みの受け取りと、1問ごとの記録（record_question のジャーナル・結果ストア・ログへの書き込みと書き出し）は
+    イベントループを止めないようスレッドで行う。記録は専用の1スレッドで順に行うので、ジャーナルなどを同時に触らない。
+    """
+    limiter = limiter or AdaptiveLimiter(initial=max_inflight, max_limit=max_inflight * 3)
+    executor = ThreadPoolExecutor(max_workers=max_inflight * 3, thread_name_prefix="async-debate")
+    recorder = ThreadPoolExecutor(max_workers=1, thread_name_prefix="async-debate-record")
+    idle = asyncio.Queue()
+    for triad in make_async_triads(model, personalities, max_inflight, limiter, executor, stopping_policy, compactor, **agent_kwargs):
+        idle.put_nowait(triad)
+    inflight = asyncio.Semaphore(max_inflight)
+
+    os.makedirs(os.path.dirname(results_csv) or ".", exist_ok=True)
+    os.makedirs(os.path.dirname(debate_log_file) or ".", exist_ok=True)
+    resuming = journal is not None and len(journal.completed) > 0
+    ledger = TokenLedger()
+    counts = {"correct": 0, "total": 0}
+    todo = [idx for idx in indices if journal is None or not journal.is_done(idx+1)]
+    pending = {}
+    next_pos = 0
+    failures = []
+
+    with TextLog(debate_log_file, append=resuming) as log_f, \
+            open(results_csv, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=MMLU_FIELDNAMES)
+        writer.writeheader()
+        if resuming:
+            writer.writerows(journal.result_rows(MMLU_FIELDNAMES))
+
+        def flush_ready():
+            # 問題番号の順に、前の問題がすべて終わっているところまで書き出す
+            nonlocal next_pos
+            while next_pos < len(todo) and todo[next_pos] in pending:
+                log_text, row = pending.pop(todo[next_pos])
+                log_f.write(log_text)
+                writer.writerow(row)
+                next_pos += 1
+            f.flush()
+            log_f.flush()
+
+        async def debate(idx, item):
+            loop = asyncio.get_running_loop()
+            try:
+                async_triad = await idle.get()
+                try:
+                    question_tuple = item["task_info"]
+                    correct_ans = item["answer"]
+                    question_text = format_mmlu_question(question_tuple)
+                    buf = io.StringIO()
+                    buf.write(f"--- MMLU Q{idx+1} ---\n{question_text}\n")
+                    seed_key = None if seed is None else (seed, idx+1)
+                    final_answer = await async_triad.run_debate(question_text, buf, seed_key=seed_key,
+                                                                multiple_choice=not isinstance(question_tuple, str))
+
+                    def record():
+                        rows = []
+                        is_correct = record_question(idx, question_tuple, correct_ans, async_triad.triad, final_answer, buf,
+                                                     ledger, rows.append, events=events, journal=journal, results=results)
+                        pending[idx] = (buf.getvalue(), rows[0])
+                        flush_ready()
+                        return is_correct
+
+                    is_correct = await loop.run_in_executor(recorder, record)
+                finally:
+                    idle.put_nowait(async_triad)
+                print(f"[Q{idx+1}] final={final_answer} correct={correct_ans} (calls in flight limit {limiter.limit})")
+                if correct_ans:
+                    counts["total"] += 1
+                    counts["correct"] += int(is_correct)
+            except Exception as e:
+                failures.append((idx, e))
+                raise
+            finally:
+                inflight.release()
+
+        tasks = []
+        questions = dl.prefetch(todo)
+        try:
+            # 問題の読み込みは先読みし、同時に走るディベートは max_inflight 問までに抑える
+            # （先読みのキューを待つ間もイベントループを止めないよう、受け取りはスレッドで行う）
+            while True:
+                next_item = await asyncio.to_thread(next, questions, None)
+                if next_item is None:
+                    break
+                idx, item = next_item
+                await inflight.acquire()
+                if failures:
+                    inflight.release()
+                    break
+                tasks.append(asyncio.create_task(debate(idx, item)))
+            await asyncio.gather(*tasks)
+        finally:
+            # 失敗や中断のときは残りのディベートを取り消し、終わるのを待ってからファイルを閉じる
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            try:
+                questions.close()
+            except ValueError:
+                # 取り消されたときに先読みの受け取りがまだスレッドで動いている（読み込みスレッドはデーモンなので放っておく）
+                pass
+            recorder.shutdown()
+            flush_ready()
+            executor.shutdown()
+            if failures:
+                print(f"[ERROR] Debate failed for Q{failures[0][0]+1}: {failures[0][1]!r}")
+
+        num_correct, total = journal.accuracy() if journal is not None else (counts["correct"], counts["total"])
+        if total > 0:
+            accuracy = num_correct / total
+            print(f"\nOverall accuracy: {accuracy*100:.1f}% ({num_correct}/{total})")
+            log_f.write(f"\nOverall accuracy: {accuracy*100:.1f}% ({num_correct}/{total})\n")
+        if ledger.records:
+            print(ledger.report())
+            log_f.write(ledger.report() + "\n")
+            ledger.write_summary(os.path.splitext(results_csv)[0] + "_usage.csv")
+        if limiter.history:
+            print(f"[INFO] Concurrency limit changes (time, from, to, ms/token): {limiter.history}")
+    print(f"\nResults saved: {results_csv}\n")
+    return num_correct, total
@@ -0,0 +1,312 @@
+import argparse
+import asyncio
+import io
+import json
+import os
+import pickle
+import tempfile
+import time
+
+from agents import AgentTriad, BFIAnalyzerAgent, suppress_stdout_stderr
+from bfi import BFI_QUESTIONS, run_bfi_test_with_analyzer
+from dataloader import dataloader
+from fake_backend import FakeLlama, quoting_script
+from json_stream import STREAM_STOPS
+from llama_server import LlamaServerClient
+from main import bigfive_prompts, build_agents, format_mmlu_question, run_debate
+from mbti_test import TOTAL_QUESTIONS, run_mbti_test
+from metrics import TokenLedger, summarize_usage
+from stub_server import start_stub_server
+
+BENCHES = ["debate", "debate_async", "speculative", "bfi", "mbti", "dataloader"]
+RESULT_FIELDS = ["bench", "size", "calls", "wall_s", "simulated_s", "overhead_ms_per_call", "calls_per_s", "tokens_per_s"]
+
+
+def make_result(bench, size, calls, wall, simulated=0.0, tokens=0):
+    """
+    1つのベンチマークの結果。simulated は FakeLlama が模擬した推論時間で、
+    wall との差を呼び出し回数で割ったものが Python 側のオーバーヘッド（1呼び出しあたり）。
+    """
+    return {
+        "bench": bench,
+        "size": size,
+        "calls": calls,
+        "wall_s": round(wall, 4),
+        "simulated_s": round(simulated, 4),
+        "overhead_ms_per_call": round((wall - simulated) / calls * 1000, 4) if calls else 0.0,
+        "calls_per_s": round(calls / wall, 2) if wall else 0.0,
+        "tokens_per_s": round(tokens / wall, 1) if wall else 0.0,
+    }
+
+
+class _Measure:
+    """with ブロックの壁時計時間と、その間に fake（FakeLlama）が模擬した時間・処理したトークン数を測る。"""
+    def __init__(self, fake):
+        self.model = fake
+
+    def __enter__(self):
+        self.before = dict(self.model.stats)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall = time.perf_counter() - self.start
+        after = self.model.stats
+        self.calls = after["calls"] - self.before["calls"]
+        self.simulated = after["simulated_s"] - self.before["simulated_s"]
+        self.tokens = (after["prompt_tokens"] + after["completion_tokens"]) - (self.before["prompt_tokens"] + self.before["completion_tokens"])
+
+
+def make_model(args):
+    """
+    (エージェントに渡すモデル, 計測に使う FakeLlama) を返す。
+    --server ならスタブの HTTP サーバを起動し、llama_server.LlamaServerClient 経由で使う。
+    """
+    if not args.server:
+        fake = FakeLlama(seed=args.seed, prompt_ms=args.prompt_ms, decode_ms=args.decode_ms)
+        return fake, fake
+    server, url = start_stub_server(seed=args.seed, prompt_ms=args.prompt_ms, decode_ms=args.decode_ms)
+    args.servers.append(server)
+    return LlamaServerClient(url), server.slots.models[0]
+
+
+def synthetic_questions(n):
+    return [
+        (f"Synthetic question {i}: which option is correct?", f"Option {i}A", f"Option {i}B", f"Option {i}C", f"Option {i}D")
+        for i in range(n)
+    ]
+
+
+def bench_debate(args, n_questions):
+    model, fake = make_model(args)
+    personalities = [bigfive_prompts["AgentT1"], bigfive_prompts["AgentT2"], bigfive_prompts["AgentT3"]]
+    triad = AgentTriad(*build_agents(model, personalities, stream_stop=args.stream_stop))
+    questions = [format_mmlu_question(q) for q in synthetic_questions(n_questions)]
+    turns = 0
+    with _Measure(fake) as m, suppress_stdout_stderr():
+        for i, question_text in enumerate(questions, start=1):
+            run_debate(triad, question_text, io.StringIO(), seed_key=(args.seed, i))
+            turns += sum(len(responses) for responses in triad.round_responses.values())
+    return make_result("debate", n_questions, turns, m.wall, m.simulated, m.tokens)
+
+
+class _QuestionList:
+    """async_debate.run_mmlu_async に渡す、dataloader と同じ prefetch を持つ合成問題の列。"""
+    def __init__(self, questions):
+        self.items = [{"task_info": q, "answer": "ABCD"[i % 4]} for i, q in enumerate(questions)]
+
+    def __len__(self):
+        return len(self.items)
+
+    def prefetch(self, indices):
+        for idx in indices:
+            yield idx, self.items[idx]
+
+
+def bench_debate_async(args, n_questions, workdir):
+    """
+    並列スロットが args.parallel のスタブサーバに対し、async_debate で最大 args.async_questions 問を同時に議論する。
+    simulated_s はスロットごとの模擬時間の合計なので、wall より大きくなりうる。
+    """
+    from async_debate import run_mmlu_async
+
+    server, url = start_stub_server(n_parallel=args.parallel, seed=args.seed, prompt_ms=args.prompt_ms, decode_ms=args.decode_ms)
+    args.servers.append(server)
+    model = LlamaServerClient(url, pool_size=3 * args.async_questions)
+    fakes = server.slots.models
+    personalities = [bigfive_prompts["AgentT1"], bigfive_prompts["AgentT2"], bigfive_prompts["AgentT3"]]
+    before = [dict(fake.stats) for fake in fakes]
+    start = time.perf_counter()
+    with suppress_stdout_stderr():
+        asyncio.run(run_mmlu_async(model, personalities, _QuestionList(synthetic_questions(n_questions)), range(n_questions),
+                                   os.path.join(workdir, "async.csv"), os.path.join(workdir, "async_log.txt"),
+                                   max_inflight=args.async_questions, seed=args.seed, stream_stop=args.stream_stop))
+    wall = time.perf_counter() - start
+    model.close()
+    delta = {key: sum(fake.stats[key] - b[key] for fake, b in zip(fakes, before)) for key in before[0]}
+    return make_result("debate_async", n_questions, delta["calls"], wall, delta["simulated_s"],
+                       delta["prompt_tokens"] + delta["completion_tokens"])
+
+
+def _debate_questions(triad, questions, seed):
+    """questions を順にディベートし、(エージェントの応答数, TokenLedger) を返す。"""
+    ledger = TokenLedger()
+    turns = 0
+    for i, question_text in enumerate(questions, start=1):
+        run_debate(triad, question_text, io.StringIO(), seed_key=(seed, i))
+        turns += sum(len(responses) for responses in triad.round_responses.values())
+        ledger.add_question(i, triad.round_usage)
+    return turns, ledger
+
+
+def bench_speculative(args, n_questions):
+    """
+    ラウンド2以降で他エージェントの reasoning を引用する合成スクリプト（fake_backend.quoting_script）で、
+    通常のデコード（debate_plain）とプロンプト参照の投機デコード（debate_speculative）を同じシードで比べる。
+    CPU を模擬するなら --prompt-ms / --decode-ms に実測に近い値（例: 20 / 120）を与える。検証バッチは
+    下書き1トークンごとに prompt_ms かかるので、受理率が低いと投機デコードのほうが遅くなる。
+    投機デコードの結果にはラウンドごとの受理率（draft_acceptance）を付ける。
+    --model-path を指定すると FakeLlama の代わりに実際の GGUF モデルで計る（bench_speculative_gguf）。
+    """
+    if args.model_path:
+        return bench_speculative_gguf(args, n_questions)
+    personalities = [bigfive_prompts["AgentT1"], bigfive_prompts["AgentT2"], bigfive_prompts["AgentT3"]]
+    questions = [format_mmlu_question(q) for q in synthetic_questions(n_questions)]
+    results = []
+    for speculative in (False, True):
+        fake = FakeLlama(seed=args.seed, prompt_ms=args.prompt_ms, decode_ms=args.decode_ms, script=quoting_script)
+        triad = AgentTriad(*build_agents(fake, personalities, stream_stop=args.stream_stop, speculative=speculative))
+        with _Measure(fake) as m, suppress_stdout_stderr():
+            turns, ledger = _debate_questions(triad, questions, args.seed)
+        result = make_result("debate_speculative" if speculative else "debate_plain", n_questions, turns, m.wall, m.simulated, m.tokens)
+        if speculative:
+            result["draft_acceptance"] = {turn: s["draft_acceptance"] for turn, s in ledger.by("round").items()}
+        results.append(result)
+    return results
+
+
+def bench_speculative_gguf(args, n_questions):
+    """
+    bench_speculative を実際の GGUF モデル（--model-path）で行う。main.load_model で通常のロードと
+    speculative=True（logits_all）のロードを1回ずつ行い、同じ合成問題をディベートして実測の tokens/s を比べる。
+    結果には生成の実測スループット（decode_tps）と、投機デコードではラウンドごとの受理率を付ける。
+    """
+    from main import load_model
+
+    personalities = [bigfive_prompts["AgentT1"], bigfive_prompts["AgentT2"], bigfive_prompts["AgentT3"]]
+    questions = [format_mmlu_question(q) for q in synthetic_questions(n_questions)]
+    results = []
+    for speculative in (False, True):
+        with suppress_stdout_stderr():
+            model = load_model(n_threads=args.threads, model_path=args.model_path, speculative=speculative)
+        triad = AgentTriad(*build_agents(model, personalities, stream_stop=args.stream_stop, speculative=speculative))
+        start = time.perf_counter()
+        with suppress_stdout_stderr():
+            turns, ledger = _debate_questions(triad, questions, args.seed)
+        wall = time.perf_counter() - start
+        total = summarize_usage(ledger.records)
+        name = "debate_speculative_gguf" if speculative else "debate_plain_gguf"
+        result = make_result(name, n_questions, turns, wall, tokens=total["prompt_tokens"] + total["completion_tokens"])
+        result["decode_tps"] = total["decode_tps"]
+        if speculative:
+            result["draft_acceptance"] = {turn: s["draft_acceptance"] for turn, s in ledger.by("round").items()}
+        results.append(result)
+        model.close()
+    return results
+
+
+def bench_bfi(args, scoring, workdir, n_samples=1):
+    model, fake = make_model(args)
+    agent = build_agents(model, [bigfive_prompts["AgentT1"]])[0]
+    name = f"bfi_{scoring}" if n_samples == 1 else f"bfi_{scoring}_x{n_samples}"
+    csv_file = os.path.join(workdir, f"{name}.csv")
+    with _Measure(fake) as m, suppress_stdout_stderr():
+        run_bfi_test_with_analyzer(agent, BFIAnalyzerAgent(model), "Bench", csv_file, scoring=scoring, seed=args.seed, n_samples=n_samples)
+    return make_result(name, len(BFI_QUESTIONS) * n_samples, len(BFI_QUESTIONS), m.wall, m.simulated, m.tokens)
+
+
+def bench_mbti(args, workdir):
+    model, fake = make_model(args)
+    agent = build_agents(model, [bigfive_prompts["AgentT1"]])[0]
+    with _Measure(fake) as m, suppress_stdout_stderr():
+        run_mbti_test(agent, "Bench", base_csv_file=os.path.join(workdir, "mbti"))
+    return make_result("mbti", TOTAL_QUESTIONS, TOTAL_QUESTIONS, m.wall, m.simulated, m.tokens)
+
+
+def bench_dataloader(size, workdir):
+    """
+    size 問の合成データセットを作り、pickle / columnar の各バックエンドで
+    読み込み（columnar は初回の変換も）と全問の読み出し・先読みを計る。
+    """
+    pkl_path = os.path.join(workdir, f"bench_{size}.pkl")
+    questions = synthetic_questions(size)
+    with open(pkl_path, "wb") as f:
+        pickle.dump({"task_info": questions, "answer": ["ABCD"[i % 4] for i in range(size)]}, f)
+    loader_cls = type("BenchLoader", (dataloader,), {"FILE_PATH": {"mmlu": pkl_path}})
+
+    results = []
+    with suppress_stdout_stderr():
+        start = time.perf_counter()
+        loader_cls("mmlu", n_case=size, backend="columnar")
+        results.append(make_result("dataloader_convert", size, size, time.perf_counter() - start))
+    for backend in ("pickle", "columnar"):
+        with suppress_stdout_stderr():
+            start = time.perf_counter()
+            dl = loader_cls("mmlu", n_case=size, backend=backend)
+            results.append(make_result(f"dataloader_open_{backend}", size, 1, time.perf_counter() - start))
+        dl.set_mode("all")
+        start = time.perf_counter()
+        for idx in range(len(dl)):
+            dl[idx]
+        results.append(make_result(f"dataloader_read_{backend}", size, size, time.perf_counter() - start))
+        start = time.perf_counter()
+        for _ in dl.prefetch(range(len(dl))):
+            pass
+        results.append(make_result(f"dataloader_prefetch_{backend}", size, size, time.perf_counter() - start))
+    return results
+
+
+def run_benchmarks(args):
+    results = []
+    args.servers = []
+    with tempfile.TemporaryDirectory(prefix="bench_") as workdir:
+        if "debate" in args.only:
+            results.append(bench_debate(args, args.questions))
+        if "debate_async" in args.only:
+            results.append(bench_debate_async(args, args.questions, workdir))
+        if "speculative" in args.only:
+            results.extend(bench_speculative(args, args.questions))
+        if "bfi" in args.only:
+            for scoring in ("sample", "expected"):
+                results.append(bench_bfi(args, scoring, workdir))
+            if args.bfi_samples > 1:
+                results.append(bench_bfi(args, "sample", workdir, n_samples=args.bfi_samples))
+        if "mbti" in args.only:
+            results.append(bench_mbti(args, workdir))
+        if "dataloader" in args.only:
+            for size in args.sizes:
+                results.extend(bench_dataloader(size, workdir))
+    for server in args.servers:
+        server.shutdown()
+    return results
+
+
+def format_results(results):
+    widths = {field: max(len(field), *(len(str(r[field])) for r in results)) for field in RESULT_FIELDS}
+    lines = ["  ".join(field.ljust(widths[field]) for field in RESULT_FIELDS)]
+    for r in results:
+        lines.append("  ".join(str(r[field]).ljust(widths[field]) for field in RESULT_FIELDS))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="GGUF モデルなしで（fake_backend.FakeLlama を使って）各パイプラインの処理時間を計る"
+                                                 "（speculative は --model-path で実モデルでも計れる）")
+    parser.add_argument("--only", nargs="+", choices=BENCHES, default=BENCHES)
+    parser.add_argument("--questions", type=int, default=5, help="ディベートする合成問題の数")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000], help="dataloader の合成データセットの問題数")
+    parser.add_argument("--prompt-ms", type=float, default=0.0, help="プロンプト評価1トークンあたりの模擬時間（ms）")
+    parser.add_argument("--decode-ms", type=float, default=0.0, help="デコード1トークンあたりの模擬時間（ms）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--model-path", help="speculative を FakeLlama ではなくこの GGUF モデルで計る（実測の tokens/s）")
+    parser.add_argument("--threads", type=int, default=8, help="--model-path のモデルの推論スレッド数")
+    parser.add_argument("--stream-stop", choices=STREAM_STOPS, default=None)
+    parser.add_argument("--server", action="store_true", help="スタブの llama.cpp server を起動し、HTTP クライアント経由で計る")
+    parser.add_argument("--parallel", type=int, default=4, help="debate_async で使うスタブサーバの並列スロット数")
+    parser.add_argument("--async-questions", type=int, default=4, help="debate_async で同時に議論する問題の数")
+    parser.add_argument("--bfi-samples", type=int, default=100, help="bfi で、まとめて作る繰り返し回数（1 なら計らない）")
+    parser.add_argument("--out", help="結果を JSON で書き出すファイル")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args)
+    print(format_results(results))
+    for r in results:
+        if "decode_tps" in r:
+            print(f"[INFO] {r['bench']} decode: {r['decode_tps']} tok/s")
+        if "draft_acceptance" in r:
+            print(f"[INFO] {r['bench']} draft acceptance by round: {r['draft_acceptance']}")
+    if args.out:
+        os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"config": {k: v for k, v in vars(args).items() if k != "servers"}, "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"[INFO] Benchmark results saved: {args.out}")
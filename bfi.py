@@ -2,6 +2,10 @@ import os
 import csv
 import re
 
+import numpy as np
+
+from completion_cache import derive_seed
+
 BFI_QUESTIONS = [
     "Is talkative",
     "Tends to find fault with others",
@@ -60,26 +64,145 @@ BFI_SCALE = {
 REVERSE_SCORED = [6, 21, 31, 2, 12, 27, 37, 8, 18, 23, 43, 9, 24, 34, 35, 41]
 REVERSE_MAPPING = {1:5, 2:4, 3:3, 4:2, 5:1}
 
+BFI_TRAITS = list(BFI_SCALE)
+# 逆転項目のマスク（44,）と、項目→特性の対応行列（44 × 5）
+REVERSE_MASK = np.isin(np.arange(1, len(BFI_QUESTIONS) + 1), REVERSE_SCORED)
+TRAIT_MATRIX = np.zeros((len(BFI_QUESTIONS), len(BFI_TRAITS)))
+for _j, _items in enumerate(BFI_SCALE.values()):
+    TRAIT_MATRIX[np.asarray(_items) - 1, _j] = 1
+
+def compute_bfi_scores_matrix(score_matrix):
+    """
+    (回数 × 44) の項目スコアの行列から、特性ごとの合計（長さ = 回数の配列）の dict を返す。
+    1～5 の逆転項目は 6 - x にし（期待値スコアの小数も同じ）、無効な回答（0）はそのまま 0 として足す。
+    """
+    scores = np.atleast_2d(np.asarray(score_matrix, dtype=float))
+    valid = (scores >= 1) & (scores <= 5)
+    converted = np.where(REVERSE_MASK & valid, 6 - scores, scores)
+    sums = converted @ TRAIT_MATRIX
+    return {trait: sums[:, j] for j, trait in enumerate(BFI_TRAITS)}
+
 def compute_bfi_scores(all_scores):
-    converted = []
-    for i, val in enumerate(all_scores, start=1):
-        if i in REVERSE_SCORED and val in REVERSE_MAPPING:
-            converted.append(REVERSE_MAPPING[val])
-        else:
-            converted.append(val)
-    results = {}
-    for trait, items in BFI_SCALE.items():
-        s = sum(converted[item-1] for item in items)
-        results[trait] = s
-    return results
+    results = compute_bfi_scores_matrix([all_scores])
+    # 整数の回答なら合計も整数で返す（従来の出力と同じ）
+    is_int = all(float(v).is_integer() for v in all_scores)
+    return {trait: int(v[0]) if is_int else float(v[0]) for trait, v in results.items()}
+
+BFI_SCORING_MODES = ["sample", "argmax", "expected"]
+
+def score_from_distribution(dist, scoring):
+    """
+    1～5 の確率分布から項目スコアを求める。argmax は最頻値、expected は期待値。
+    """
+    if scoring == "argmax":
+        return max(dist, key=dist.get)
+    return sum(k * p for k, p in dist.items())
+
+def write_bfi_item_distributions(csv_file, agent_name, test_phase, scores, distributions):
+    fieldnames = ["AgentName", "TestPhase", "Question", "Score", "P1", "P2", "P3", "P4", "P5"]
+    write_header = not os.path.exists(csv_file)
+    with open(csv_file, "a", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        if write_header:
+            writer.writeheader()
+        for i, (score, dist) in enumerate(zip(scores, distributions), start=1):
+            row = {"AgentName": agent_name, "TestPhase": test_phase, "Question": i, "Score": round(score, 4)}
+            for k in range(1, 6):
+                row[f"P{k}"] = round(dist[k], 6)
+            writer.writerow(row)
+
+def sample_item_scores(distributions, n_samples, rng, temperature=0.7, top_p=0.9):
+    """
+    項目ごとの 1～5 の確率分布（44 個の dict）から、(n_samples × 44) の回答をまとめて引く。
+    get_bfi_score のサンプリング（temperature / top_p）を 1～5 の分布に当てはめてから、
+    一様乱数と累積分布の比較で全項目・全回数を一度に引く。
+    """
+    probs = np.array([[dist[k] for k in range(1, 6)] for dist in distributions], dtype=float)
+    probs = np.maximum(probs, 1e-12) ** (1.0 / max(temperature, 1e-6))
+    probs /= probs.sum(axis=1, keepdims=True)
+    # top_p: 確率の高い順に累積が top_p に達するまでの選択肢だけを残す（達した選択肢も含む）
+    order = np.argsort(-probs, axis=1)
+    sorted_probs = np.take_along_axis(probs, order, axis=1)
+    keep_sorted = np.cumsum(sorted_probs, axis=1) - sorted_probs < top_p
+    keep = np.zeros_like(keep_sorted)
+    np.put_along_axis(keep, order, keep_sorted, axis=1)
+    probs = np.where(keep, probs, 0.0)
+    cdf = np.cumsum(probs / probs.sum(axis=1, keepdims=True), axis=1)
+    u = rng.random((n_samples, len(distributions), 1))
+    return (u > cdf[None, :, :-1]).sum(axis=2) + 1
 
-def run_bfi_test_with_analyzer(persona_agent, analyzer_agent, test_phase, csv_file="bfi_results.csv"):
+def write_bfi_score_rows(csv_file, agent_name, test_phase, trait_scores):
+    """特性スコア（特性 → 長さ = 回数の配列）を1回1行で csv_file に追記する。"""
+    fieldnames = ["AgentName", "TestPhase", *BFI_TRAITS]
+    write_header = not os.path.exists(csv_file)
+    n_rows = len(next(iter(trait_scores.values())))
+    with open(csv_file, "a", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        if write_header:
+            writer.writeheader()
+        for r in range(n_rows):
+            values = {trait: float(v[r]) for trait, v in trait_scores.items()}
+            writer.writerow({"AgentName": agent_name, "TestPhase": test_phase,
+                             **{trait: int(x) if x.is_integer() else round(x, 3) for trait, x in values.items()}})
+
+def run_bfi_repeated(persona_agent, test_phase, csv_file, n_samples, seed=None, temperature=0.7, top_p=0.9, results=None):
+    """
+    BFI を n_samples 回受けた結果をまとめて作る（plot_bfi_change.py の箱ひげ図用）。
+    各項目について次トークン分布を1回の順伝播で求め（44 回）、そこから全回数分の回答を一度に引き、
+    (n_samples × 44) の行列のまま採点して n_samples 行を csv_file（と results があれば結果ストア）に追記する。
+    1 回ずつ最大 20 トークンを生成する sample モードを n_samples 回繰り返すのと違い、
+    モデルの呼び出し回数は回数によらない（最初のトークンが数字でない回答は起こらない）。
+    """
+    distributions = [
+        persona_agent.get_bfi_distribution(question_text, i, len(BFI_QUESTIONS))
+        for i, question_text in enumerate(BFI_QUESTIONS, start=1)
+    ]
+    rng = np.random.default_rng(None if seed is None else derive_seed(seed, persona_agent.name, test_phase, "repeated"))
+    score_matrix = sample_item_scores(distributions, n_samples, rng, temperature=temperature, top_p=top_p)
+    trait_scores = compute_bfi_scores_matrix(score_matrix)
+    items_csv = os.path.splitext(csv_file)[0] + "_items.csv"
+    write_bfi_item_distributions(items_csv, persona_agent.name, test_phase, score_matrix.mean(axis=0), distributions)
+    write_bfi_score_rows(csv_file, persona_agent.name, test_phase, trait_scores)
+    if results is not None:
+        results.add_bfi_scores(persona_agent.name, test_phase,
+                               [{trait: v[r] for trait, v in trait_scores.items()} for r in range(n_samples)])
+        results.add_bfi_items(persona_agent.name, test_phase, score_matrix.mean(axis=0), distributions)
+    print(f"[INFO] BFI test done for {persona_agent.name} ({test_phase}, {n_samples} samples), saved to {csv_file}")
+    return score_matrix
+
+def run_bfi_test_with_analyzer(persona_agent, analyzer_agent, test_phase, csv_file="bfi_results.csv", scoring="sample", seed=None, n_samples=1,
+                               results=None):
+    """
+    scoring="sample"   : 従来通り最大20トークンをサンプリングして数字を抽出する
+                         （seed を渡すと項目ごとに決定的なシードを使い、キャッシュ可能になる）
+    scoring="argmax"   : 次トークン分布（"1"～"5"）の最頻値を使う（1項目1回の順伝播）
+    scoring="expected" : 次トークン分布の期待値を使う
+    logprob 系のモードでは、各項目の分布を <csv_file>_items.csv に書き出す。
+    scoring="sample" で n_samples > 1 なら、run_bfi_repeated で n_samples 回分をまとめて作る。
+    results（results_store.RunRecorder）を渡すと、結果ストアにも追記する。
+    """
+    assert scoring in BFI_SCORING_MODES, f"scoring {scoring} not valid."
+    if scoring == "sample" and n_samples > 1:
+        run_bfi_repeated(persona_agent, test_phase, csv_file, n_samples, seed=seed, results=results)
+        return
     n_questions = len(BFI_QUESTIONS)
     collected_scores = [0] * n_questions
+    distributions = []
     for i, question_text in enumerate(BFI_QUESTIONS, start=1):
-        numeric_score = persona_agent.get_bfi_score(question_text, i, n_questions)
+        if scoring == "sample":
+            item_seed = None if seed is None else derive_seed(seed, persona_agent.name, test_phase, i)
+            numeric_score = persona_agent.get_bfi_score(question_text, i, n_questions, seed=item_seed)
+        else:
+            dist = persona_agent.get_bfi_distribution(question_text, i, n_questions)
+            distributions.append(dist)
+            numeric_score = score_from_distribution(dist, scoring)
         collected_scores[i-1] = numeric_score if 1 <= numeric_score <= 5 else 0
     final_scores = compute_bfi_scores(collected_scores)
+    if scoring == "expected":
+        final_scores = {trait: round(s, 3) for trait, s in final_scores.items()}
+    if distributions:
+        items_csv = os.path.splitext(csv_file)[0] + "_items.csv"
+        write_bfi_item_distributions(items_csv, persona_agent.name, test_phase, collected_scores, distributions)
     fieldnames = ["AgentName", "TestPhase", "Extraversion", "Agreeableness", "Conscientiousness", "Neuroticism", "Openness"]
     write_header = not os.path.exists(csv_file)
     with open(csv_file, "a", newline="", encoding="utf-8") as f:
@@ -96,4 +219,8 @@ def run_bfi_test_with_analyzer(persona_agent, analyzer_agent, test_phase, csv_fi
             "Openness": final_scores["Openness"]
         }
         writer.writerow(row)
+    if results is not None:
+        results.add_bfi_scores(persona_agent.name, test_phase, [final_scores])
+        if distributions:
+            results.add_bfi_items(persona_agent.name, test_phase, collected_scores, distributions)
     print(f"[INFO] BFI test done for {persona_agent.name} ({test_phase}), saved to {csv_file}")
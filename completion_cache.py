@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import config
+
+
+def derive_seed(*parts):
+    """
+    (実行シード, 問題番号, エージェント名, ラウンド) などから決定的なシードを作る。
+    """
+    digest = hashlib.sha256("\0".join(str(p) for p in parts).encode("utf-8")).digest()
+    return int.from_bytes(digest[:4], "little") & 0x7FFFFFFF
+
+
+def model_id(model):
+    """キャッシュキーに使うモデルの識別子（ファイル名・サイズ・chat_format）。"""
+    path = getattr(model, "model_path", "")
+    size = os.path.getsize(path) if path and os.path.exists(path) else 0
+    return f"{os.path.basename(path)}:{size}:{getattr(model, 'chat_format', '')}"
+
+
+class CompletionCache:
+    """
+    LlamaAgent の生成結果を SQLite に保存する内容アドレス型キャッシュ。
+    キーはモデル ID・入力（メッセージ列やプロンプト）・サンプリング設定・シードのハッシュ。
+    合計サイズが max_bytes を超えたら、最後に参照された時刻の古いものから削除する。
+    合計サイズは cache_meta の行にトリガーで積算しておき（複数プロセスで共有しても正しい）、put のたびに全件を数えない。
+    """
+    def __init__(self, path=config.COMPLETION_CACHE_PATH, max_bytes=1024 ** 3):
+        os.makedirs(os.path.dirname(str(path)) or ".", exist_ok=True)
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS completions ("
+            " key TEXT PRIMARY KEY, kind TEXT, value TEXT, size INTEGER,"
+            " created REAL, last_access REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_completions_last_access ON completions(last_access)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS cache_meta (name TEXT PRIMARY KEY, value INTEGER)")
+        # 既存のキャッシュでは最初の1回だけ合計を数える
+        self._conn.execute(
+            "INSERT OR IGNORE INTO cache_meta (name, value) SELECT 'total_bytes', COALESCE(SUM(size), 0) FROM completions"
+        )
+        self._conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS completions_size_insert AFTER INSERT ON completions BEGIN"
+            " UPDATE cache_meta SET value = value + NEW.size WHERE name = 'total_bytes'; END"
+        )
+        self._conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS completions_size_delete AFTER DELETE ON completions BEGIN"
+            " UPDATE cache_meta SET value = value - OLD.size WHERE name = 'total_bytes'; END"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(model, kind, request):
+        payload = json.dumps([model_id(model), kind, request], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            self._conn.execute("UPDATE completions SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self.stats["hits"] += 1
+            return json.loads(row[0])
+
+    def put(self, key, kind, value):
+        data = json.dumps(value, ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            # REPLACE による削除ではトリガーが動かないので、既存の行は明示的に消してから入れる
+            self._conn.execute("DELETE FROM completions WHERE key = ?", (key,))
+            self._conn.execute(
+                "INSERT INTO completions (key, kind, value, size, created, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, kind, data, len(data), now, now),
+            )
+            self._evict()
+            self._conn.commit()
+
+    def total_bytes(self):
+        return self._conn.execute("SELECT value FROM cache_meta WHERE name = 'total_bytes'").fetchone()[0]
+
+    def _evict(self):
+        total = self.total_bytes()
+        while total > self.max_bytes:
+            rows = self._conn.execute(
+                "SELECT key, size FROM completions ORDER BY last_access ASC LIMIT 64"
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self._conn.execute("DELETE FROM completions WHERE key = ?", (key,))
+                total -= size
+                self.stats["evictions"] += 1
+                if total <= self.max_bytes:
+                    break
+
+    def summary(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        hit_rate = self.stats["hits"] / lookups if lookups else 0.0
+        return f"hits={self.stats['hits']} misses={self.stats['misses']} hit_rate={hit_rate:.1%} evictions={self.stats['evictions']}"
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,5 +1,4 @@
 from pathlib import Path
-from huggingface_hub import hf_hub_download
 
 # 修正：ダウンロードするモデルを変更
 REPO_ID = "bartowski/Meta-Llama-3.1-8B-Instruct-GGUF"
@@ -12,24 +11,72 @@ FILENAME = "Meta-Llama-3.1-8B-Instruct-Q8_0.gguf"  # 必要に応じてファイ
 BASE_DIR = Path(__file__).parent.resolve()
 MODEL_SAVE_DIR = BASE_DIR / "models"
 MODEL_PATH = MODEL_SAVE_DIR / FILENAME
+# ローカルの GGUF の台帳（model_registry.ModelRegistry）。パス・サイズ・チェックサム・ロードオプションを持つ
+MODEL_REGISTRY_PATH = MODEL_SAVE_DIR / "registry.json"
+# True なら（または環境変数 HF_HUB_OFFLINE=1 なら）モデルの取得にネットワークを使わない
+OFFLINE = False
+# llama_cpp.Llama のロードオプションの既定値（台帳のエントリごとに上書きできる）
+MODEL_LOADER_OPTIONS = {"use_mmap": True, "use_mlock": False}
 
-def get_model_path():
+# ペルソナのシステムプロンプト評価済み KV 状態の保存先
+KV_CACHE_DIR = BASE_DIR / "kv_cache"
+
+# BFI の採点方法: "sample"（従来のサンプリング）/ "argmax" / "expected"（次トークン分布から）
+BFI_SCORING = "sample"
+# "sample" で 2 以上にすると、BFI をこの回数受けた結果を次トークン分布からまとめて作る（bfi.run_bfi_repeated）
+BFI_SAMPLES = 1
+
+# True にするとディベートの各ターンを {"reasoning", "answer": A～D} の JSON に文法で制約する
+DEBATE_JSON_GRAMMAR = False
+
+# シード指定の生成結果を保存する SQLite キャッシュ
+COMPLETION_CACHE_PATH = BASE_DIR / "cache" / "completions.sqlite"
+
+# ディベートの打ち切り条件（agents.StoppingPolicy）。None / False なら常に全ラウンドを行う
+EARLY_STOP_UNANIMOUS_AFTER = None
+EARLY_STOP_STABLE_MAJORITY = False
+EARLY_STOP_MAX_TOKENS = None
+
+# ラウンド2以降のプロンプトに埋め込む他エージェントの回答1件あたりのトークン上限（None なら縮めない）と縮め方
+# （peer_compactor.PeerCompactor: "truncate" / "extractive" / "summary"）
+PEER_TOKEN_BUDGET = None
+PEER_COMPACTION = "truncate"
+
+# ディベートの生成をストリーミングし、JSON の answer が閉じたら（"answer"）／オブジェクトが閉じたら（"object"）
+# デコードを打ち切る（json_stream.STREAM_STOPS）。None なら max_tokens まで通常どおり生成する
+STREAM_STOP = None
+
+# True にするとディベートの生成でプロンプト参照の投機デコード（speculative.PromptLookupDraft）を使う。
+# 検証に全トークンの logits が要るので、モデルは logits_all=True でロードする（n_ctx × 語彙数の logits 分メモリが増える）
+SPECULATIVE_DECODING = False
+# 下書きを探すときに照合する末尾の n-gram の最大長と、1ステップで下書きするトークン数の上限
+PROMPT_LOOKUP_NGRAM = 2
+PROMPT_LOOKUP_TOKENS = 10
+# 下書きを使う最初のラウンド。ラウンド1のプロンプトには写せる文がほとんどなく、検証の分だけ遅くなる
+SPECULATIVE_MIN_ROUND = 2
+
+# 全実行の結果（BFI・MBTI・ディベート）を集める SQLite（results_store.ResultsStore）
+RESULTS_DB_PATH = BASE_DIR / "results" / "results.sqlite"
+
+# 起動済みの llama.cpp server（OpenAI 互換 API）の URL。None ならプロセス内でモデルをロードする
+LLAMA_SERVER_URL = None
+
+# experiment_matrix.py が実行する実験マトリクスの既定値（チーム × データセット × フェーズ × シード）
+EXPERIMENT_MATRIX = {
+    "teams": ["TeamNone", "TeamMixed", "TeamT2"],
+    "datasets": ["mmlu"],
+    "phases": ["pre_bfi", "debate"],
+    "seeds": [0],
+    "n_case": 990,
+}
+
+def get_model_path(name=None):
     """
-    モデルをダウンロードし、ローカルパスを返す。
+    モデルのローカルパスを返す。台帳（model_registry）に登録済みならネットワークを使わずに即座に返し、
+    手元にない場合だけダウンロードする。
     """
-    MODEL_SAVE_DIR.mkdir(parents=True, exist_ok=True)
-    
-    model_path = hf_hub_download(
-        repo_id=REPO_ID,
-        filename=FILENAME,
-        local_dir=MODEL_SAVE_DIR,
-        local_dir_use_symlinks=False,
-        force_filename=FILENAME,
-        resume_download=False
-    )
-    
-    if not Path(model_path).exists():
-        raise FileNotFoundError(f"モデルファイルが見つかりません: {model_path}")
-    
-    print(f"モデル保存先: {MODEL_PATH}")
-    return str(MODEL_PATH)  # 文字列に変換して返す
+    from model_registry import ModelRegistry
+
+    model_path = ModelRegistry().resolve(name)
+    print(f"モデル保存先: {model_path}")
+    return model_path
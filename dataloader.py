@@ -1,5 +1,151 @@
-import pickle
+import json
 import os
+import pickle
+import queue
+import shutil
+import threading
+
+import numpy as np
+
+# 列指向形式のセルの符号化。変わったら既存の変換結果は作り直す
+CELL_FORMAT = "pickle"
+
+
+def shard_bounds(n_items, n_shards):
+    """
+    0..n_items-1 を n_shards 個の連続した範囲 [(start, end), ...] に分ける（サイズの差は高々1）。
+    """
+    n_shards = max(1, min(n_shards, n_items))
+    base, extra = divmod(n_items, n_shards)
+    ranges = []
+    start = 0
+    for i in range(n_shards):
+        end = start + base + (1 if i < extra else 0)
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+class PickleStore:
+    """従来の pickle をまるごと読み込んで保持するストア。"""
+    def __init__(self, fpath):
+        with open(fpath, "rb") as f:
+            self.database = pickle.load(f)
+
+    def __len__(self):
+        return len(self.database["task_info"])
+
+    def task_info(self, idx):
+        return self.database["task_info"][idx]
+
+    def answer(self, idx):
+        return self.database["answer"][idx]
+
+
+class ColumnarStore:
+    """
+    convert_to_columnar で作った列指向のデータセットを mmap で読むストア。
+    列ごとに、セル（pickle したバイト列）を連結した <列>.data.bin と、その開始位置の <列>.offsets.npy を持つ。
+    セルは pickle なので、タプルや int キーの dict などは pickle バックエンドと同じ型で返る。
+    起動時に読むのは meta.json だけで、各問題は参照されたときにそのページだけが読まれる。
+    複数のプロセスが同じファイルを mmap すると、ページキャッシュ上の1つのコピーを共有する。
+    """
+    COLUMNS = ("task_info", "answer")
+
+    def __init__(self, dirpath):
+        with open(os.path.join(dirpath, "meta.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        if self.meta.get("cell_format") != CELL_FORMAT:
+            raise ValueError(f"{dirpath}: cell format {self.meta.get('cell_format')!r} is not {CELL_FORMAT!r}; "
+                             "re-run convert_to_columnar")
+        self.n_rows = self.meta["n_rows"]
+        self.offsets = {}
+        self.data = {}
+        for column in self.COLUMNS:
+            self.offsets[column] = np.load(os.path.join(dirpath, f"{column}.offsets.npy"), mmap_mode="r")
+            data_path = os.path.join(dirpath, f"{column}.data.bin")
+            # 空ファイルは mmap できない
+            if os.path.getsize(data_path) > 0:
+                self.data[column] = np.memmap(data_path, dtype=np.uint8, mode="r")
+            else:
+                self.data[column] = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return self.n_rows
+
+    def _cell(self, column, cell_idx):
+        offsets = self.offsets[column]
+        start, end = int(offsets[cell_idx]), int(offsets[cell_idx + 1])
+        return pickle.loads(self.data[column][start:end].tobytes())
+
+    def task_info(self, idx):
+        width = self.meta["task_info_width"]
+        if not self.meta["task_info_is_tuple"]:
+            return self._cell("task_info", idx)
+        return tuple(self._cell("task_info", idx * width + j) for j in range(width))
+
+    def answer(self, idx):
+        return self._cell("answer", idx)
+
+
+def _write_column(dirpath, column, cells):
+    offsets = [0]
+    with open(os.path.join(dirpath, f"{column}.data.bin"), "wb") as f:
+        for cell in cells:
+            data = pickle.dumps(cell, protocol=pickle.HIGHEST_PROTOCOL)
+            f.write(data)
+            offsets.append(offsets[-1] + len(data))
+    np.save(os.path.join(dirpath, f"{column}.offsets.npy"), np.asarray(offsets, dtype=np.int64))
+
+
+def convert_to_columnar(pickle_path, dirpath):
+    """
+    dataloader 用の pickle（{"task_info": [...], "answer": [...], ...}）を列指向の形式に変換する。
+    task_info の各要素がタプルなら (Q, A, B, C, D) の各フィールドを別のセルとして保存する。
+    task_info / answer 以外のキー（ratio など）は meta.json に入れる。
+    書き込みは一時ディレクトリに行い、古いディレクトリを脇に rename してから一時ディレクトリを rename で置き、
+    古いものはその後で消す。並行して起動したプロセスが書きかけや消しかけのデータを読むことはない
+    （すでに古いファイルを mmap しているプロセスもそのまま読み続けられる）。
+    """
+    with open(pickle_path, "rb") as f:
+        db = pickle.load(f)
+    task_info = list(db["task_info"])
+    answers = list(db["answer"])
+    is_tuple = bool(task_info) and all(isinstance(t, tuple) for t in task_info)
+    width = len(task_info[0]) if is_tuple else 1
+    if is_tuple and any(len(t) != width for t in task_info):
+        raise ValueError(f"{pickle_path}: task_info tuples have different lengths")
+
+    tmp_dir = f"{dirpath}.tmp{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    _write_column(tmp_dir, "task_info", (field for t in task_info for field in t) if is_tuple else task_info)
+    _write_column(tmp_dir, "answer", answers)
+    meta = {
+        "n_rows": len(task_info),
+        "task_info_is_tuple": is_tuple,
+        "task_info_width": width,
+        "cell_format": CELL_FORMAT,
+        "source_mtime": os.path.getmtime(pickle_path),
+        "extra": {k: v for k, v in db.items() if k not in ("task_info", "answer")},
+    }
+    with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, default=str)
+    old_dir = f"{dirpath}.old{os.getpid()}"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    try:
+        os.rename(dirpath, old_dir)
+    except FileNotFoundError:
+        old_dir = None
+    try:
+        os.rename(tmp_dir, dirpath)
+    except OSError:
+        # 別のプロセスが先に変換を終えた
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    if old_dir is not None:
+        shutil.rmtree(old_dir, ignore_errors=True)
+    return dirpath
+
 
 class dataloader:
     FILE_PATH = {
@@ -7,18 +153,37 @@ class dataloader:
         "chess": "./eval_data/chess.pkl",
         "mmlu": "./eval_data/mmlu.pkl",
     }
-    def __init__(self, name: str, n_case: int = 50):
+    def __init__(self, name: str, n_case: int = 50, backend: str = "columnar"):
+        """
+        backend=columnar -> 列指向の mmap 形式で読む（なければ pickle から一度だけ変換する）
+        backend=pickle   -> 従来どおり pickle をまるごと読み込む
+        """
         assert name.lower() in ["math", "chess", "mmlu"], f"dataset {name} is not valid."
+        assert backend in ["columnar", "pickle"], f"backend {backend} not valid."
         self.dataset = name.lower()
         self.n_case = n_case
+        self.backend = backend
         self.database = self._load_dataset()
         self.mode = "question"
+    def _columnar_path(self):
+        return os.path.splitext(self.FILE_PATH[self.dataset])[0] + ".cols"
     def _load_dataset(self):
         fpath = self.FILE_PATH[self.dataset]
         print("data_path:", fpath)
-        with open(fpath, "rb") as f:
-            db = pickle.load(f)
-        return db
+        if self.backend == "pickle":
+            return PickleStore(fpath)
+        dirpath = self._columnar_path()
+        meta_path = os.path.join(dirpath, "meta.json")
+        stale = True
+        if os.path.exists(meta_path):
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            stale = (meta.get("source_mtime") != os.path.getmtime(fpath)
+                     or meta.get("cell_format") != CELL_FORMAT)
+        if stale:
+            print(f"[INFO] Converting {fpath} to columnar format: {dirpath}")
+            convert_to_columnar(fpath, dirpath)
+        return ColumnarStore(dirpath)
     def set_mode(self, mode: str):
         """
         mode=question -> 各問題 (Q,A,B,C,D) のタプル
@@ -28,17 +193,82 @@ class dataloader:
         assert mode in ["all", "question", "answer"], f"mode {mode} not valid."
         self.mode = mode
     def __len__(self):
-        real_count = len(self.database["task_info"])
+        real_count = len(self.database)
         return min(self.n_case, real_count)
     def __getitem__(self, idx):
-        if idx >= len(self):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
             raise IndexError("dataloader out of range")
         if self.mode == "question":
-            return self.database["task_info"][idx]
+            return self.database.task_info(idx)
         elif self.mode == "answer":
-            return self.database["answer"][idx]
+            return self.database.answer(idx)
         else:
             return {
-                "task_info": self.database["task_info"][idx],
-                "answer": self.database["answer"][idx]
+                "task_info": self.database.task_info(idx),
+                "answer": self.database.answer(idx)
             }
+    def shard(self, shard_id: int, n_shards: int):
+        """shard_id 番目のシャード（連続した範囲）の問題番号を range で返す。"""
+        start, end = shard_bounds(len(self), n_shards)[shard_id]
+        return range(start, end)
+    def iter_shard(self, shard_id: int, n_shards: int):
+        """shard_id 番目のシャードの (問題番号, 問題) を順に返す。"""
+        for idx in self.shard(shard_id, n_shards):
+            yield idx, self[idx]
+    def prefetch(self, indices, depth: int = 8):
+        """
+        indices の (問題番号, 問題) を順に返す。バックグラウンドのスレッドが最大 depth 件先まで読み、
+        ディスクからの読み込みやデコードを呼び出し側の処理（推論）と重ねる。
+        """
+        items = queue.Queue(maxsize=depth)
+        done = object()
+        stop = threading.Event()
+
+        def reader():
+            try:
+                for idx in indices:
+                    if stop.is_set():
+                        return
+                    items.put((idx, self[idx]))
+            except Exception as e:
+                items.put(e)
+                return
+            items.put(done)
+
+        thread = threading.Thread(target=reader, name="dataloader-prefetch", daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = items.get()
+                if item is done:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            # 途中で打ち切られた場合に reader が put で止まらないよう空にしておく
+            while thread.is_alive():
+                try:
+                    items.get_nowait()
+                except queue.Empty:
+                    thread.join(0.01)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="評価データセットの pickle を列指向の mmap 形式に変換する")
+    parser.add_argument("names", nargs="*", default=["mmlu"], choices=list(dataloader.FILE_PATH))
+    args = parser.parse_args()
+    for name in args.names:
+        fpath = dataloader.FILE_PATH[name]
+        if not os.path.exists(fpath):
+            print(f"[WARNING] {fpath} not found, skipped")
+            continue
+        dirpath = convert_to_columnar(fpath, os.path.splitext(fpath)[0] + ".cols")
+        print(f"[INFO] {fpath} -> {dirpath}")
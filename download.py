@@ -1,36 +1,37 @@
-from huggingface_hub import hf_hub_download
 from pathlib import Path
+import argparse
 import os
 
-def download_model(repo_id, filename, save_path=None):
+import config
+from model_registry import ModelRegistry
+
+def download_model(repo_id, filename, save_path=None, force=False):
     """
-    モデルをHugging Face Hubからダウンロードし、指定されたパスに保存します。
+    モデルをHugging Face Hubからダウンロードし、指定されたパスに保存して台帳（model_registry）に登録します。
+    既に取得済みのファイルは再ダウンロードしません（force=True のときだけ取り直します）。
     """
     # 保存先ディレクトリの作成（存在しない場合）
     save_path = Path(save_path) if save_path else Path.cwd() / "models"
     save_path.mkdir(parents=True, exist_ok=True)
-    
-    # 明示的にキャッシュを使用しない設定
-    model_path = hf_hub_download(
-        repo_id=repo_id,
-        filename=filename,
-        local_dir=save_path,
-        local_dir_use_symlinks=False,  # シンボリックリンクではなく実ファイルを保存
-        force_download=True,
-        resume_download=False
-    )
-    
+
+    # 台帳は保存先ディレクトリに置く（ディレクトリごと別のノードへ運べば、そのままオフラインで使える）
+    registry = ModelRegistry(save_path / Path(config.MODEL_REGISTRY_PATH).name)
+    if force or filename not in registry.entries:
+        registry.download(filename, repo_id, filename, force=force)
+    model_path = registry.resolve(filename, repo_id=repo_id)
+
     print(f"ダウンロード先: {model_path}")
     print(f"保存先ディレクトリの内容: {os.listdir(save_path)}")
     return model_path
 
 if __name__ == "__main__":
-    REPO_ID = "bartowski/Meta-Llama-3.1-8B-Instruct-GGUF"
-    FILENAME = "Meta-Llama-3.1-8B-Instruct-Q8_0.gguf"
-    SAVE_PATH = "./models"  # カレントディレクトリからの相対パス
+    parser = argparse.ArgumentParser(description="GGUF モデルを取得して台帳に登録する")
+    parser.add_argument("--repo-id", default=config.REPO_ID)
+    parser.add_argument("--filename", default=config.FILENAME)
+    parser.add_argument("--save-path", default="./models", help="カレントディレクトリからの相対パス")
+    parser.add_argument("--force", action="store_true", help="取得済みでもダウンロードし直す")
+    args = parser.parse_args()
 
     # 絶対パスに変換して渡す
-    absolute_path = Path(SAVE_PATH).resolve()
-    download_model(REPO_ID, FILENAME, absolute_path)
-
-    from llama_cpp import Llama
+    absolute_path = Path(args.save_path).resolve()
+    download_model(args.repo_id, args.filename, absolute_path, force=args.force)
@@ -0,0 +1,107 @@
+import json
+import os
+import queue
+import threading
+import time
+
+
+class BufferedWriter:
+    """
+    テキストをキューに積むだけで返し、バックグラウンドスレッドがまとめてファイルに書く
+    （batch_size 件たまるか flush_interval 秒経つごとに1回 write + flush）。
+    close() でキューを書き切ってからファイルを閉じる。
+    """
+    _CLOSE = object()
+
+    def __init__(self, path, append=False, batch_size=64, flush_interval=1.0):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._file = open(path, "a" if append else "w", encoding="utf-8")
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._writer, name=f"{type(self).__name__}-writer", daemon=True)
+        self._thread.start()
+
+    def _put(self, text):
+        self._queue.put(text)
+
+    def _writer(self):
+        closing = False
+        while not closing:
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    text = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if text is self._CLOSE:
+                    closing = True
+                    break
+                batch.append(text)
+            if batch:
+                self._file.write("".join(batch))
+                self._file.flush()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(self._CLOSE)
+            self._thread.join()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TextLog(BufferedWriter):
+    """
+    ディベートログ（テキスト）を書くファイルの代わりに使う。write() はキューに積むだけなので、
+    回答ごと・ラウンドごとの書き込みでディベートのループが止まらない。
+    flush() は何もしない（書き込みスレッドが flush_interval 秒ごとに flush する）。
+    """
+    def write(self, text):
+        self._put(text)
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+class EventLog(BufferedWriter):
+    """
+    ディベートの経過を1イベント1行の JSONL で書き出すログ。
+    emit() はキューに積むだけで、書き込みはバックグラウンドスレッドがまとめて行う（BufferedWriter）。
+
+    イベントの種類（"event" フィールド）:
+        run   : 実行の開始（run_id, 設定）
+        turn  : 1エージェント・1ラウンドの回答（answer, reasoning, トークン数）
+        final : 1問の最終回答と正誤、トークン数
+    """
+    def __init__(self, path, run_id=None, append=False, batch_size=64, flush_interval=1.0):
+        super().__init__(path, append=append, batch_size=batch_size, flush_interval=flush_interval)
+        self.run_id = run_id
+
+    def emit(self, event, **fields):
+        record = {"event": event, "run_id": self.run_id, "ts": round(time.time(), 3), **fields}
+        self._put(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def iter_events(paths, event=None):
+    """
+    複数の JSONL イベントログを1行ずつ読み、イベント（dict）を順に返す。
+    ファイル全体をメモリに載せないので、大きなログや多数の実行でも一定のメモリで集計できる。
+    書きかけの行（中断された実行の最終行など）は飛ばす。
+    """
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if event is None or record.get("event") == event:
+                    yield record
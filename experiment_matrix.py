@@ -0,0 +1,280 @@
+import argparse
+import json
+import os
+from datetime import datetime
+
+import config
+from agents import AgentTriad, BFIAnalyzerAgent, StoppingPolicy
+from bfi import run_bfi_test_with_analyzer
+from dataloader import dataloader
+from event_log import EventLog
+from kv_cache import AgentSessionManager, PersonaStateCache
+from llama_server import LlamaServerClient
+from main import build_agents, load_model, run_mmlu, team_configurations
+from mbti_test import run_mbti_test
+from peer_compactor import PeerCompactor
+from results_store import ResultsStore
+from run_journal import RunJournal
+
+# 1つのチーム・シードについて、この順に実行する（事前テスト → ディベート → 事後テスト）
+PHASES = ["pre_bfi", "pre_mbti", "debate", "post_bfi", "post_mbti"]
+
+
+def cell_key(job):
+    return f"{job['team']}/{job['dataset'] or '-'}/{job['phase']}/seed{job['seed']}"
+
+
+def persona_overlap(a, b):
+    """2つのチームで、同じエージェント（Agent1～3）に同じペルソナが割り当てられている数。"""
+    return sum(pa == pb for pa, pb in zip(a, b))
+
+
+def order_teams(teams, personalities_by_team):
+    """
+    隣り合うチームで同じ (エージェント, ペルソナ) の組ができるだけ多く続くように並べる（貪欲法）。
+    kv_cache のセッションとペルソナのスナップショットは (エージェント名, システムプロンプト) で引かれるので、
+    重なるエージェントはチームが変わってもそのまま再利用される。
+    """
+    remaining = list(teams)
+    ordered = [remaining.pop(0)] if remaining else []
+    while remaining:
+        last = personalities_by_team[ordered[-1]]
+        best = max(remaining, key=lambda t: persona_overlap(last, personalities_by_team[t]))
+        remaining.remove(best)
+        ordered.append(best)
+    return ordered
+
+
+def build_jobs(teams, datasets, phases, seeds, personalities_by_team):
+    """
+    チーム × データセット × フェーズ × シードの各セルをジョブ（dict）にして、実行順に並べる。
+    同じチームのジョブはまとめて流し（ペルソナの KV 状態が温かいうちに使い切る）、チームの順は order_teams で決める。
+    ディベート以外のフェーズはデータセットによらないので dataset=None の1セルになる。
+    """
+    jobs = []
+    for team in order_teams(teams, personalities_by_team):
+        for seed in seeds:
+            for phase in (p for p in PHASES if p in phases):
+                for dataset in (datasets if phase == "debate" else [None]):
+                    jobs.append({"team": team, "dataset": dataset, "phase": phase, "seed": seed})
+    return jobs
+
+
+class MatrixState:
+    """
+    実験マトリクスの完了済みセルを JSONL に記録する（RunJournal と同じく1行ずつ追記して fsync する）。
+    再実行すると、記録のあるセルは飛ばす。ディベートのセルは途中まで終わっていれば各セルのジャーナルから再開する。
+    """
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.done[record["key"]] = record
+
+    def is_done(self, job):
+        return cell_key(job) in self.done
+
+    def mark_done(self, job, **outputs):
+        record = {"key": cell_key(job), **job, "outputs": outputs, "finished_at": datetime.now().isoformat(timespec="seconds")}
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.done[record["key"]] = record
+
+
+class MatrixScheduler:
+    """
+    1つのモデル（llama_cpp.Llama か llama_server.LlamaServerClient）を使い回して、実験マトリクスの全セルを順に実行する。
+    ペルソナのスナップショットとエージェントの KV セッションは全セルで共有する。
+    結果は out_dir の下にセルごとのファイルとして書き（store を渡すと結果ストアにも追記し）、完了したセルは MatrixState に記録する。
+    """
+    def __init__(self, model, out_dir, n_case=990, kv_sessions=None, stopping_policy=None, peer_token_budget=None,
+                 stream_stop=config.STREAM_STOP, store=None, speculative=False):
+        self.model = model
+        self.store = store
+        self.out_dir = out_dir
+        self.n_case = n_case
+        self.kv_sessions = kv_sessions
+        self.stopping_policy = stopping_policy
+        self.compactor = PeerCompactor(model, budget=peer_token_budget, strategy=config.PEER_COMPACTION) if peer_token_budget else None
+        self.stream_stop = stream_stop
+        self.speculative = speculative
+        self.personalities_by_team = dict(team_configurations)
+        self.state = MatrixState(os.path.join(out_dir, "matrix_state.jsonl"))
+        self._agents = {}
+        self._datasets = {}
+
+    def agents_for(self, team):
+        # チームごとのエージェントは1度だけ作り、フェーズ・データセット・シードをまたいで使い回す
+        if team not in self._agents:
+            self._agents[team] = build_agents(self.model, self.personalities_by_team[team], self.kv_sessions,
+                                              stream_stop=self.stream_stop, speculative=self.speculative)
+        return self._agents[team]
+
+    def dataset(self, name):
+        if name not in self._datasets:
+            dl = dataloader(name, n_case=self.n_case)
+            dl.set_mode("all")
+            self._datasets[name] = dl
+        return self._datasets[name]
+
+    def cell_name(self, job):
+        return f"{job['team']}_{job['dataset'] + '_' if job['dataset'] else ''}seed{job['seed']}"
+
+    def run_job(self, job):
+        team, phase, seed = job["team"], job["phase"], job["seed"]
+        agents = self.agents_for(team)
+        test_phase = "Pre" if phase.startswith("pre_") else "Post"
+        results = None
+        if self.store is not None:
+            results = self.store.run(self.cell_name(job), team=team, dataset=job["dataset"],
+                                     model=os.path.basename(self.model.model_path), seed=seed)
+            if phase != "debate":
+                # やり直すセルの書きかけの行を消す（ディベートの行は問題ごとに置き換わる）
+                results.clear(test_phase, test=phase.split("_", 1)[1])
+        if phase.endswith("_bfi"):
+            csv_file = os.path.join(self.out_dir, f"bfi_{test_phase.lower()}_{self.cell_name(job)}.csv")
+            # 途中で落ちたセルの書きかけの行が残らないよう、作り直す
+            if os.path.exists(csv_file):
+                os.remove(csv_file)
+            for agent in agents:
+                run_bfi_test_with_analyzer(agent, BFIAnalyzerAgent(self.model), test_phase, csv_file, scoring=config.BFI_SCORING, seed=seed,
+                                           n_samples=config.BFI_SAMPLES, results=results)
+            return {"csv": csv_file}
+        if phase.endswith("_mbti"):
+            mbti_dir = os.path.join(self.out_dir, f"mbti_{test_phase.lower()}_{self.cell_name(job)}")
+            for agent in agents:
+                run_mbti_test(agent, test_phase, base_csv_file=mbti_dir, results=results)
+            return {"dir": mbti_dir}
+        return self.run_debate_cell(job, agents, results)
+
+    def run_debate_cell(self, job, agents, results=None):
+        dl = self.dataset(job["dataset"])
+        run_id = self.cell_name(job)
+        run_config = {
+            "team_name": job["team"],
+            "personalities": self.personalities_by_team[job["team"]],
+            "dataset": job["dataset"],
+            "n_case": self.n_case,
+            "model": os.path.basename(self.model.model_path),
+            "max_tokens": agents[0].max_tokens,
+            "debate_json_grammar": config.DEBATE_JSON_GRAMMAR,
+            "seed": job["seed"],
+            "stream_stop": self.stream_stop,
+            "speculative": self.speculative,
+        }
+        if self.stopping_policy is not None:
+            run_config["stopping_policy"] = self.stopping_policy.config()
+        if self.compactor is not None:
+            run_config["peer_compaction"] = {"budget": self.compactor.budget, "strategy": self.compactor.strategy}
+        journal = RunJournal.for_run(run_id, run_config, journal_dir=self.out_dir)
+        resuming = len(journal.completed) > 0
+        events = EventLog(os.path.join(self.out_dir, f"events_{run_id}.jsonl"), run_id=run_id, append=resuming)
+        if not resuming:
+            events.emit("run", config=run_config)
+        triad = AgentTriad(*agents, stopping_policy=self.stopping_policy, compactor=self.compactor)
+        results_csv = os.path.join(self.out_dir, f"{job['dataset']}_results_{run_id}.csv")
+        debate_log_file = os.path.join(self.out_dir, f"debate_log_{run_id}.txt")
+        try:
+            num_correct, total = run_mmlu(triad, dl, range(len(dl)), results_csv, debate_log_file, journal=journal,
+                                          seed=job["seed"], events=events, results=results)
+        finally:
+            events.close()
+        return {"csv": results_csv, "log": debate_log_file, "correct": num_correct, "total": total}
+
+    def run(self, jobs, dry_run=False):
+        """jobs を順に実行する。完了済みのセルは飛ばす。(実行したセル数, 飛ばしたセル数) を返す。"""
+        ran = skipped = 0
+        for i, job in enumerate(jobs, start=1):
+            key = cell_key(job)
+            if self.state.is_done(job):
+                print(f"[INFO] [{i}/{len(jobs)}] {key}: already done, skipped")
+                skipped += 1
+                continue
+            print(f"\n===== [{i}/{len(jobs)}] {key} =====\n")
+            if dry_run:
+                continue
+            outputs = self.run_job(job)
+            self.state.mark_done(job, **outputs)
+            ran += 1
+        return ran, skipped
+
+
+# 選択肢のないデータセット（答えは自由記述）
+FREE_FORM_DATASETS = {"math", "chess"}
+
+
+def load_matrix(path, **overrides):
+    """
+    JSON の実験マトリクス（teams / datasets / phases / seeds / n_case のうち必要なものだけ）を config の既定値に重ね、
+    さらに None でない overrides（コマンドラインの指定）を重ねる。
+    config.DEBATE_JSON_GRAMMAR は answer を A～D に制約するので、選択肢のないデータセットのディベートとは併用できない。
+    """
+    matrix = dict(config.EXPERIMENT_MATRIX)
+    if path:
+        with open(path, encoding="utf-8") as f:
+            matrix.update(json.load(f))
+    matrix.update({key: value for key, value in overrides.items() if value is not None})
+    free_form = FREE_FORM_DATASETS.intersection(matrix["datasets"])
+    if config.DEBATE_JSON_GRAMMAR and "debate" in matrix["phases"] and free_form:
+        raise ValueError(f"DEBATE_JSON_GRAMMAR restricts answers to A-D; it cannot be used with {sorted(free_form)} debates")
+    return matrix
+
+
+if __name__ == "__main__":
+    team_names = [name for name, _ in team_configurations]
+    parser = argparse.ArgumentParser(description="チーム × データセット × フェーズ × シードの実験マトリクスを1つのモデルで実行する")
+    parser.add_argument("--matrix", help="実験マトリクスの JSON（省略時は config.EXPERIMENT_MATRIX）")
+    parser.add_argument("--teams", nargs="+", choices=team_names)
+    parser.add_argument("--datasets", nargs="+", choices=list(dataloader.FILE_PATH))
+    parser.add_argument("--phases", nargs="+", choices=PHASES)
+    parser.add_argument("--seeds", nargs="+", type=int)
+    parser.add_argument("--n-case", type=int)
+    parser.add_argument("--out-dir", default="./results/matrix", help="結果の保存先（同じディレクトリで再実行すると完了済みのセルを飛ばす）")
+    parser.add_argument("--server-url", default=config.LLAMA_SERVER_URL)
+    parser.add_argument("--dry-run", action="store_true", help="実行順と完了状況だけを表示する")
+    args = parser.parse_args()
+
+    try:
+        matrix = load_matrix(args.matrix, **{key: getattr(args, key) for key in ("teams", "datasets", "phases", "seeds", "n_case")})
+    except ValueError as e:
+        parser.error(str(e))
+    personalities_by_team = dict(team_configurations)
+    jobs = build_jobs(matrix["teams"], matrix["datasets"], matrix["phases"], matrix["seeds"], personalities_by_team)
+    print(f"[INFO] {len(jobs)} cells: teams={matrix['teams']} datasets={matrix['datasets']} phases={matrix['phases']} seeds={matrix['seeds']}")
+
+    # モデルはここで1度だけロードし（またはサーバに接続し）、全セルで使い回す
+    kv_sessions = None
+    if args.dry_run:
+        model = None
+    elif args.server_url:
+        model = LlamaServerClient(args.server_url)
+    else:
+        model = load_model(speculative=config.SPECULATIVE_DECODING)
+        kv_sessions = AgentSessionManager(PersonaStateCache())
+    stopping_policy = None
+    if config.EARLY_STOP_UNANIMOUS_AFTER is not None or config.EARLY_STOP_STABLE_MAJORITY or config.EARLY_STOP_MAX_TOKENS is not None:
+        stopping_policy = StoppingPolicy(config.EARLY_STOP_UNANIMOUS_AFTER, config.EARLY_STOP_STABLE_MAJORITY, config.EARLY_STOP_MAX_TOKENS)
+    store = None if args.dry_run else ResultsStore()
+    scheduler = MatrixScheduler(model, args.out_dir, n_case=matrix["n_case"], kv_sessions=kv_sessions,
+                                stopping_policy=stopping_policy, peer_token_budget=config.PEER_TOKEN_BUDGET, store=store,
+                                speculative=config.SPECULATIVE_DECODING and not args.server_url)
+    ran, skipped = scheduler.run(jobs, dry_run=args.dry_run)
+    print(f"[INFO] Matrix finished: {ran} cells run, {skipped} skipped")
+    if kv_sessions is not None:
+        print(f"[INFO] KV session stats: {kv_sessions.stats}")
+        kv_sessions.close()
+    if args.server_url and model is not None:
+        model.close()
+    if store is not None:
+        store.close()
@@ -0,0 +1,301 @@
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+
+import numpy as np
+
+_PIECE_RE = re.compile(r"\s*\S+|\s+")
+
+_WORDS = (
+    "the answer follows from the definition because each option must satisfy the condition "
+    "so we compare them carefully and check which one is consistent with the facts given in the question"
+).split()
+
+
+def _seed_from(*parts):
+    digest = hashlib.sha256("\0".join(str(p) for p in parts).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "little")
+
+
+def default_script(kind, prompt, rng, reasoning_words=(20, 80)):
+    """
+    FakeLlama が返すテキストを決める既定のスクリプト。
+        kind="chat"       : {"reasoning": ..., "answer": A～D} の JSON
+        kind="completion" : BFI の質問（"(1-5)?" で終わる）なら " 1"～" 5"、それ以外は短い文章
+    rng は呼び出しごとの random.Random（シードが同じなら同じ出力になる）。
+    """
+    if kind == "chat":
+        reasoning = " ".join(rng.choice(_WORDS) for _ in range(rng.randint(*reasoning_words)))
+        return json.dumps({"reasoning": reasoning.capitalize() + ".", "answer": rng.choice("ABCD")})
+    if prompt.rstrip().endswith(":") and "(1-5)" in prompt:
+        return f" {rng.randint(1, 5)}"
+    return " " + " ".join(rng.choice(_WORDS) for _ in range(rng.randint(*reasoning_words))) + "."
+
+
+# ラウンド2以降のプロンプトに埋め込まれた他エージェントの回答（dict の repr か JSON）の reasoning
+_PEER_RE = re.compile(r"""['"]reasoning['"]:\s*['"]([^'"]+)['"]""")
+
+
+def quoting_script(kind, prompt, rng, reasoning_words=(20, 80), quote_ratio=0.7):
+    """
+    ラウンド2以降の回答が他エージェントの reasoning を引用・言い換えるようすを模擬するスクリプト。
+    プロンプトに他エージェントの回答の reasoning があれば、その一部（全体の quote_ratio 程度）を
+    そのまま写し、残りを新しい語で埋める。プロンプト参照の投機デコードのベンチマークに使う。
+    それ以外は default_script と同じ。
+    """
+    peers = _PEER_RE.findall(prompt) if kind == "chat" else []
+    if not peers:
+        return default_script(kind, prompt, rng, reasoning_words)
+    words = rng.choice(peers).rstrip(".").split()
+    n_quote = max(1, int(len(words) * quote_ratio))
+    start = rng.randint(0, len(words) - n_quote)
+    own = [rng.choice(_WORDS) for _ in range(rng.randint(3, max(3, reasoning_words[0] // 2)))]
+    reasoning = " ".join(own[:len(own) // 2] + words[start:start + n_quote] + own[len(own) // 2:])
+    return json.dumps({"reasoning": reasoning.capitalize() + ".", "answer": rng.choice("ABCD")})
+
+
+class FakeState:
+    """Llama.save_state の返り値と同じ属性を持つ状態。"""
+    def __init__(self, input_ids, n_tokens, n_vocab):
+        self.input_ids = input_ids
+        self.n_tokens = n_tokens
+        self.scores = np.zeros((1, n_vocab), dtype=np.float32)
+        # KV 状態の大きさの目安（1トークンあたり 1KiB とする）
+        self.llama_state = bytes(n_tokens * 1024)
+
+
+class _Scores:
+    """model.scores[i] で、位置 i までのトークン列から決まる logits を返す。"""
+    def __init__(self, model):
+        self.model = model
+
+    def __getitem__(self, i):
+        ids = self.model.input_ids[:i + 1].tolist()
+        rng = np.random.default_rng(_seed_from(self.model.seed, *ids) & 0xFFFFFFFF)
+        return rng.normal(size=self.model.n_vocab()).astype(np.float32)
+
+
+class FakeLlama:
+    """
+    GGUF モデルなしでパイプラインを動かすための llama_cpp.Llama の代役。
+    LlamaAgent・AgentSessionManager・PeerCompactor が使う範囲
+    （create_chat_completion / create_completion / __call__ / tokenize / detokenize / eval /
+    scores / save_state / load_state など）だけを実装する。
+
+    出力は script(kind, prompt, rng) で決まり、seed が同じなら同じ出力になる
+    （seed=-1 のときはインスタンスの乱数列を使うので、インスタンスのシードが同じなら実行ごとに同じ）。
+    トークンは空白区切りの断片で、初めて現れたものから順に ID を振る。
+    prompt_ms / decode_ms を与えると、評価した（プレフィックス再利用で省かれなかった）トークン数に
+    応じて sleep し、llama.cpp の prompt-eval / decode の時間を模擬する。模擬した時間は
+    stats["simulated_s"] に積算されるので、壁時計時間との差が Python 側のオーバーヘッドになる。
+    draft_model（speculative.PromptLookupDraft など）を付けると llama_cpp.Llama.generate と同じ手順で
+    投機デコードする。検証バッチは CPU の llama.cpp と同じく、1トークンのデコードに下書き1トークンあたり
+    prompt_ms を足した時間がかかるものとする。
+    """
+    def __init__(self, seed=0, n_ctx=8192, n_vocab=128256, prompt_ms=0.0, decode_ms=0.0, script=default_script,
+                 model_path="fake-model.gguf", chat_format="llama-3"):
+        self.seed = seed
+        self._n_ctx = n_ctx
+        self._n_vocab = n_vocab
+        self.prompt_ms = prompt_ms
+        self.decode_ms = decode_ms
+        self.script = script
+        self.model_path = model_path
+        self.chat_format = chat_format
+        # llama_cpp.Llama と同じく、全トークンの logits を持つかどうかはインスタンスの _logits_all に置く
+        self._logits_all = True
+        self.draft_model = None
+        self._verifying = False
+        self.ctx = None
+        self.input_ids = np.zeros(n_ctx, dtype=np.intc)
+        self.n_tokens = 0
+        self.scores = _Scores(self)
+        self._rng = random.Random(seed)
+        self._vocab = {}
+        self._pieces = [b"", b""]
+        self._vocab_lock = threading.Lock()
+        self.stats = {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "simulated_s": 0.0}
+
+    def n_ctx(self):
+        return self._n_ctx
+
+    def n_vocab(self):
+        return self._n_vocab
+
+    @property
+    def _input_ids(self):
+        return self.input_ids[:self.n_tokens]
+
+    def token_bos(self):
+        return 1
+
+    def tokenize(self, text, add_bos=True, special=False):
+        tokens = [self.token_bos()] if add_bos else []
+        with self._vocab_lock:
+            for piece in _PIECE_RE.findall(text.decode("utf-8", errors="ignore")):
+                data = piece.encode("utf-8")
+                token = self._vocab.get(data)
+                if token is None:
+                    token = len(self._pieces)
+                    if token >= self._n_vocab:
+                        raise ValueError(f"FakeLlama vocabulary exhausted ({self._n_vocab} pieces)")
+                    self._vocab[data] = token
+                    self._pieces.append(data)
+                tokens.append(token)
+        return tokens
+
+    def detokenize(self, tokens, prev_tokens=None, special=False):
+        return b"".join(self._pieces[t] for t in tokens)
+
+    def _sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+            self.stats["simulated_s"] += seconds
+
+    def eval(self, tokens):
+        tokens = list(tokens)
+        if self.n_tokens + len(tokens) > self._n_ctx:
+            raise ValueError(f"Requested tokens ({self.n_tokens + len(tokens)}) exceed context window of {self._n_ctx}")
+        self.input_ids[self.n_tokens:self.n_tokens + len(tokens)] = tokens
+        self.n_tokens += len(tokens)
+        if self._verifying:
+            self._sleep((self.decode_ms + (len(tokens) - 1) * self.prompt_ms) / 1000)
+            return
+        per_token = self.prompt_ms if len(tokens) > 1 else self.decode_ms
+        self._sleep(len(tokens) * per_token / 1000)
+
+    def save_state(self):
+        return FakeState(self.input_ids.copy(), self.n_tokens, self._n_vocab)
+
+    def load_state(self, state):
+        self.input_ids[:] = state.input_ids
+        self.n_tokens = state.n_tokens
+
+    def reset(self):
+        self.n_tokens = 0
+
+    def _rng_for(self, kind, prompt, seed):
+        if seed is None or seed == -1:
+            return random.Random(self._rng.getrandbits(64))
+        return random.Random(_seed_from(self.seed, kind, seed, prompt))
+
+    def _eval_prompt(self, prompt_tokens):
+        # llama.cpp と同じく、コンテキストに残っている共通プレフィックスは評価し直さない（最後の1つは必ず評価する）
+        n_past = 0
+        for a, b in zip(self._input_ids.tolist(), prompt_tokens):
+            if a != b:
+                break
+            n_past += 1
+        n_past = min(n_past, len(prompt_tokens) - 1)
+        self.n_tokens = n_past
+        self.eval(prompt_tokens[n_past:])
+
+    def _decode_step(self, tokens, i, limit):
+        """
+        tokens[i-1] を評価して tokens[i] を確定する。draft_model があれば下書きも同じバッチで評価し、
+        tokens と一致した先頭部分を受理する（一致しなかった分はコンテキストから捨てる）。受理した数を返す。
+        """
+        if self.draft_model is None:
+            self.eval([tokens[i - 1]])
+            return 0
+        self.input_ids[self.n_tokens] = tokens[i - 1]
+        draft = [int(t) for t in self.draft_model(self.input_ids[:self.n_tokens + 1])][:self._n_ctx - self.n_tokens - 1]
+        accepted = 0
+        while accepted < len(draft) and i + accepted < limit and draft[accepted] == tokens[i + accepted]:
+            accepted += 1
+        self._verifying = True
+        try:
+            self.eval([tokens[i - 1]] + draft)
+        finally:
+            self._verifying = False
+        self.n_tokens -= len(draft) - accepted
+        return accepted
+
+    def _generate(self, kind, prompt, max_tokens=16, stop=None, seed=None):
+        """
+        (トークン断片, finish_reason) を順に返すジェネレータ。断片ごとに1トークン分デコードする
+        （投機デコード中は受理した下書きの分だけまとめて確定する）。
+        最後に返したトークンは llama.cpp と同じく評価しない。
+        """
+        prompt_tokens = self.tokenize(prompt.encode("utf-8"), add_bos=True, special=True)
+        self.stats["calls"] += 1
+        self.stats["prompt_tokens"] += len(prompt_tokens)
+        self._eval_prompt(prompt_tokens)
+        text = self.script(kind, prompt, self._rng_for(kind, prompt, seed))
+        tokens = self.tokenize(text.encode("utf-8"), add_bos=False)
+        stops = [stop] if isinstance(stop, str) else list(stop or [])
+        generated = ""
+        limit = min(len(tokens), max_tokens)
+        ready = 1
+        for i, token in enumerate(tokens[:max_tokens]):
+            if i >= ready:
+                ready = i + 1 + self._decode_step(tokens, i, limit)
+            piece = self.detokenize([token]).decode("utf-8")
+            self.stats["completion_tokens"] += 1
+            candidate = generated + piece
+            cut = min((candidate.find(s) for s in stops if s in candidate), default=-1)
+            if cut >= 0:
+                yield candidate[len(generated):max(cut, len(generated))], "stop"
+                return
+            generated += piece
+            finish = None
+            if i == len(tokens) - 1:
+                finish = "stop"
+            elif i == max_tokens - 1:
+                finish = "length"
+            yield piece, finish
+        if not tokens or max_tokens <= 0:
+            yield "", "stop"
+
+    def _usage(self, prompt_tokens, completion_tokens):
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens}
+
+    def format_chat(self, messages):
+        parts = [f"<|start_header_id|>{m['role']}<|end_header_id|>\n\n{m['content']}<|eot_id|>" for m in messages]
+        return "".join(parts) + "<|start_header_id|>assistant<|end_header_id|>\n\n"
+
+    def create_chat_completion(self, messages, max_tokens=None, temperature=0.2, top_p=0.95, stop=None, seed=None,
+                               grammar=None, stream=False, **kwargs):
+        prompt = self.format_chat(messages)
+        max_tokens = max_tokens if max_tokens and max_tokens > 0 else self._n_ctx
+        if stream:
+            return self._stream_chat(prompt, max_tokens, stop, seed)
+        before = dict(self.stats)
+        pieces = []
+        finish_reason = None
+        for piece, finish_reason in self._generate("chat", prompt, max_tokens, stop, seed):
+            pieces.append(piece)
+        return {
+            "object": "chat.completion",
+            "model": self.model_path,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(pieces)}, "finish_reason": finish_reason}],
+            "usage": self._usage(self.stats["prompt_tokens"] - before["prompt_tokens"],
+                                 self.stats["completion_tokens"] - before["completion_tokens"]),
+        }
+
+    def _stream_chat(self, prompt, max_tokens, stop, seed):
+        yield {"object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"role": "assistant"}, "finish_reason": None}]}
+        for piece, finish_reason in self._generate("chat", prompt, max_tokens, stop, seed):
+            delta = {"content": piece} if piece else {}
+            yield {"object": "chat.completion.chunk", "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+
+    def create_completion(self, prompt, max_tokens=16, temperature=0.8, top_p=0.95, stop=None, seed=None, **kwargs):
+        before = dict(self.stats)
+        pieces = []
+        finish_reason = None
+        for piece, finish_reason in self._generate("completion", prompt, max_tokens, stop, seed):
+            pieces.append(piece)
+        return {
+            "object": "text_completion",
+            "model": self.model_path,
+            "choices": [{"index": 0, "text": "".join(pieces), "logprobs": None, "finish_reason": finish_reason}],
+            "usage": self._usage(self.stats["prompt_tokens"] - before["prompt_tokens"],
+                                 self.stats["completion_tokens"] - before["completion_tokens"]),
+        }
+
+    def __call__(self, prompt, **kwargs):
+        return self.create_completion(prompt, **kwargs)
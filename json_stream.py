@@ -0,0 +1,105 @@
+import json
+
+STREAM_STOPS = ["answer", "object"]
+
+
+class JsonFieldScanner:
+    """
+    生成中のテキストを少しずつ受け取り、最上位の JSON オブジェクトのフィールドを読み進める。
+    値が閉じたフィールド（文字列・数値など。入れ子のオブジェクトや配列は読み飛ばす）だけを fields に入れる。
+    オブジェクトの閉じ括弧まで来たら closed が True になる。
+        scanner = JsonFieldScanner()
+        for piece in stream:
+            scanner.feed(piece)
+            if "answer" in scanner.fields:
+                break
+    "{" より前のテキストは無視するので、前置きの文章があっても読める。
+    """
+    def __init__(self):
+        self.fields = {}
+        self.closed = False
+        self._started = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._buf = []
+        self._expect = "key"
+        self._key = None
+        self._scalar = []
+
+    def _set(self, value):
+        if self._key is not None:
+            self.fields[self._key] = value
+        self._key = None
+
+    def _finish_scalar(self):
+        raw = "".join(self._scalar)
+        self._scalar = []
+        try:
+            self._set(json.loads(raw))
+        except json.JSONDecodeError:
+            self._set(raw)
+
+    def _finish_string(self):
+        raw = "".join(self._buf)
+        self._buf = []
+        try:
+            value = json.loads(f'"{raw}"')
+        except json.JSONDecodeError:
+            value = raw
+        if self._expect == "key":
+            self._key = value
+        else:
+            self._set(value)
+
+    def feed(self, text):
+        for ch in text:
+            if self.closed:
+                break
+            if not self._started:
+                if ch == "{":
+                    self._started = True
+                    self._depth = 1
+                continue
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        self._finish_string()
+                    continue
+                if self._depth == 1:
+                    self._buf.append(ch)
+                continue
+            if self._scalar and (ch in ",}" or ch.isspace()):
+                self._finish_scalar()
+            if ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self.closed = True
+            elif self._depth == 1 and ch == ":":
+                self._expect = "value"
+            elif self._depth == 1 and ch == ",":
+                self._expect = "key"
+                self._key = None
+            elif self._depth == 1 and self._expect == "value" and not ch.isspace():
+                self._scalar.append(ch)
+        return self
+
+    def done(self, stop):
+        """stop（"answer" / "object"）の条件を満たしたら True。"""
+        if stop == "answer":
+            return "answer" in self.fields
+        return self.closed
+
+
+def parse_partial(text):
+    """テキストの先頭の JSON オブジェクトから、閉じたフィールドだけを dict で返す（途中で切れていてもよい）。"""
+    return JsonFieldScanner().feed(text).fields
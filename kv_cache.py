@@ -0,0 +1,231 @@
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+import config
+from agents import suppress_stdout_stderr
+
+
+def persona_state_key(model, system_message):
+    """
+    モデルファイル・chat_format・n_ctx・システムプロンプトからスナップショットのキーを作る。
+    """
+    model_path = getattr(model, "model_path", "")
+    model_size = os.path.getsize(model_path) if model_path and os.path.exists(model_path) else 0
+    h = hashlib.sha256()
+    for part in (os.path.basename(model_path), str(model_size), str(model.chat_format), str(model.n_ctx()), system_message):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def compact_state(model, state):
+    """
+    scores を保存に必要な行だけに縮めて保存サイズを抑える。
+    logits_all=False の場合、scores は最終トークン以外使われないので1行にする
+    （load_state ではブロードキャストで埋められ、生成時は最後のトークンが必ず再評価される）。
+    logits_all=True（投機デコード用のロード）の場合も、save_state は n_ctx 行すべてを写すので、
+    使われている先頭 n_tokens 行だけを残す（load_state が書き戻すのも先頭 n_tokens 行だけ）。
+    """
+    if getattr(model, "_logits_all", False):
+        if state.scores.shape[0] > state.n_tokens:
+            state.scores = state.scores[:state.n_tokens].copy()
+        return state
+    if state.scores.shape[0] <= 1:
+        return state
+    state.scores = np.zeros((1, state.scores.shape[1]), dtype=state.scores.dtype)
+    return state
+
+
+class PersonaStateCache:
+    """
+    ペルソナのシステムプロンプトを評価した直後の llama.cpp 状態をペルソナごとに1つ作り、
+    ディスクに保存しておく。reset_history 直後の最初の生成ではこの状態を復元し、
+    プレフィックスの再評価を省く（llama.cpp の prefix-match により差分だけが評価される）。
+    """
+    def __init__(self, cache_dir=config.KV_CACHE_DIR):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def _state_path(self, key):
+        return self.cache_dir / f"persona_{key}.state"
+
+    def _build_state(self, model, system_message):
+        # システムプロンプトだけを chat template で評価させ、その時点の状態を保存する
+        with suppress_stdout_stderr():
+            model.create_chat_completion(
+                [{"role": "system", "content": system_message}],
+                max_tokens=1,
+                temperature=0.0,
+            )
+            state = model.save_state()
+        return compact_state(model, state)
+
+    def get_state(self, model, system_message):
+        with self._lock:
+            return self._get_state(model, system_message)
+
+    def _get_state(self, model, system_message):
+        key = persona_state_key(model, system_message)
+        if key in self._states:
+            return self._states[key]
+        path = self._state_path(key)
+        state = None
+        if path.exists():
+            try:
+                with open(path, "rb") as f:
+                    state = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError) as e:
+                print(f"[WARNING] Failed to load persona state {path.name}: {e}")
+        if state is None:
+            state = self._build_state(model, system_message)
+            tmp_path = path.with_name(f"{path.name}.{os.getpid()}_{threading.get_ident()}.tmp")
+            with open(tmp_path, "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+            print(f"[INFO] Persona state saved: {path.name} ({state.n_tokens} tokens)")
+        self._states[key] = state
+        return state
+
+    def prepare(self, agent, messages):
+        """
+        生成の直前に呼ばれる。会話がリセット直後（システム＋最初のユーザ発言のみ）なら
+        ペルソナのスナップショットを復元する。
+        """
+        if len(messages) > 2 or messages[0]["role"] != "system":
+            return
+        state = self.get_state(agent.model, messages[0]["content"])
+        agent.model.load_state(state)
+
+    def commit(self, agent):
+        """生成の直後に呼ばれる。ペルソナキャッシュでは何もしない。"""
+        pass
+
+
+def state_nbytes(state):
+    return len(state.llama_state) + state.scores.nbytes + state.input_ids.nbytes
+
+
+class AgentSessionManager:
+    """
+    同じ Llama インスタンスを交互に使う複数エージェントのために、エージェントごとの KV 状態
+    （セッション）を保持する。生成の前にそのエージェントの状態を復元し、生成後に保存するので、
+    llama.cpp の prefix-match により新しく追加されたターンだけが評価される。
+    セッションは RAM 上で LRU 管理し、max_ram_bytes を超えた分はディスクに退避する。
+    会話がリセットされた直後はセッションを破棄し、ペルソナのスナップショットから始める。
+    """
+    def __init__(self, persona_cache=None, max_ram_bytes=2 * 1024 ** 3, spill_dir=config.KV_CACHE_DIR / "sessions"):
+        self.persona_cache = persona_cache if persona_cache is not None else PersonaStateCache()
+        self.max_ram_bytes = max_ram_bytes
+        Path(spill_dir).mkdir(parents=True, exist_ok=True)
+        # セッションはプロセス内でのみ有効なので、プロセスごとの一時ディレクトリに退避する
+        self.spill_dir = Path(tempfile.mkdtemp(prefix=f"{os.getpid()}_", dir=spill_dir))
+        self._finalizer = weakref.finalize(self, shutil.rmtree, str(self.spill_dir), True)
+        self._ram = OrderedDict()
+        self._ram_bytes = 0
+        self._spilled = set()
+        # モデルごとに、現在コンテキストに載っているセッションのキー
+        self._active = {}
+        self.stats = {"ram_hits": 0, "disk_hits": 0, "misses": 0, "spills": 0}
+        # RoundExecutor で複数のモデルから同時に呼ばれることがあるため
+        self._lock = threading.RLock()
+
+    def _session_key(self, agent):
+        digest = hashlib.sha256(agent.system_message.encode("utf-8")).hexdigest()[:16]
+        return f"{agent.name}_{digest}"
+
+    def _spill_path(self, key):
+        return self.spill_dir / f"{key}.state"
+
+    def _put(self, key, state):
+        self.discard(key)
+        nbytes = state_nbytes(state)
+        self._ram[key] = (state, nbytes)
+        self._ram_bytes += nbytes
+        # 予算を超えたら古いものからディスクへ退避（直近に保存したものは常に RAM に残す）
+        while self._ram_bytes > self.max_ram_bytes and len(self._ram) > 1:
+            old_key, (old_state, old_nbytes) = self._ram.popitem(last=False)
+            self._ram_bytes -= old_nbytes
+            with open(self._spill_path(old_key), "wb") as f:
+                pickle.dump(old_state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            self._spilled.add(old_key)
+            self.stats["spills"] += 1
+
+    def _get(self, key):
+        if key in self._ram:
+            self._ram.move_to_end(key)
+            self.stats["ram_hits"] += 1
+            return self._ram[key][0]
+        if key in self._spilled:
+            with open(self._spill_path(key), "rb") as f:
+                state = pickle.load(f)
+            self.stats["disk_hits"] += 1
+            self._put(key, state)
+            return state
+        self.stats["misses"] += 1
+        return None
+
+    def discard(self, key):
+        if key in self._ram:
+            _, nbytes = self._ram.pop(key)
+            self._ram_bytes -= nbytes
+        if key in self._spilled:
+            self._spilled.discard(key)
+            self._spill_path(key).unlink(missing_ok=True)
+
+    def _context_holds(self, model, key):
+        """
+        モデルのコンテキストにこのセッションがそのまま残っているか。
+        BFI などセッション外の評価で上書きされていれば False。
+        """
+        if self._active.get(id(model)) != key or key not in self._ram:
+            return False
+        state = self._ram[key][0]
+        n = state.n_tokens
+        return model.n_tokens >= n and np.array_equal(model.input_ids[:n], state.input_ids[:n])
+
+    def prepare(self, agent, messages):
+        with self._lock:
+            self._prepare(agent, messages)
+
+    def _prepare(self, agent, messages):
+        key = self._session_key(agent)
+        model_id = id(agent.model)
+        if len(messages) <= 2:
+            # リセット直後：古いセッションは使えないのでペルソナのスナップショットから始める
+            self.discard(key)
+            if self._active.get(model_id) != key:
+                self.persona_cache.prepare(agent, messages)
+        elif not self._context_holds(agent.model, key):
+            state = self._get(key)
+            if state is not None:
+                agent.model.load_state(state)
+            else:
+                self.persona_cache.prepare(agent, messages[:1])
+        # 直前にこのエージェントが使ったコンテキストが残っていれば何も復元しない
+        self._active[model_id] = key
+
+    def commit(self, agent):
+        key = self._session_key(agent)
+        with suppress_stdout_stderr():
+            state = agent.model.save_state()
+        with self._lock:
+            self._put(key, compact_state(agent.model, state))
+            self._active[id(agent.model)] = key
+
+    def close(self):
+        """退避ファイルを削除する。"""
+        self._ram.clear()
+        self._ram_bytes = 0
+        self._spilled.clear()
+        self._finalizer()
@@ -0,0 +1,273 @@
+import http.client
+import json
+import math
+import queue
+import socket
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+class ServerError(RuntimeError):
+    """サーバがエラーを返した、または応答を解釈できなかった。"""
+
+
+class _NoDelayMixin:
+    # ヘッダと本文が別々の send になるので、Nagle と遅延 ACK が重なって1往復ごとに ~40ms 待たないようにする
+    def connect(self):
+        super().connect()
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class _HTTPConnection(_NoDelayMixin, http.client.HTTPConnection):
+    pass
+
+
+class _HTTPSConnection(_NoDelayMixin, http.client.HTTPSConnection):
+    pass
+
+
+class ConnectionPool:
+    """
+    1つのホストへの keep-alive な http.client 接続を最大 max_size 本まで使い回すプール。
+    複数のスレッド（RoundExecutor）や LlamaServerClient で共有できる。
+    """
+    def __init__(self, url, max_size=8, timeout=600.0):
+        parts = urlsplit(url)
+        self.scheme = parts.scheme or "http"
+        self.host = parts.hostname or "127.0.0.1"
+        self.port = parts.port or (443 if self.scheme == "https" else 80)
+        self.base_path = parts.path.rstrip("/")
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self.stats = {"opened": 0, "reused": 0}
+
+    def _new_connection(self):
+        cls = _HTTPSConnection if self.scheme == "https" else _HTTPConnection
+        self.stats["opened"] += 1
+        return cls(self.host, self.port, timeout=self.timeout)
+
+    def acquire(self):
+        self._slots.acquire()
+        try:
+            conn = self._idle.get_nowait()
+            self.stats["reused"] += 1
+            return conn
+        except queue.Empty:
+            return self._new_connection()
+
+    def release(self, conn, reusable=True):
+        if reusable:
+            self._idle.put(conn)
+        else:
+            conn.close()
+        self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class LlamaServerClient:
+    """
+    llama.cpp の server（OpenAI 互換 API）を llama_cpp.Llama の代わりに使うクライアント。
+    LlamaAgent・PeerCompactor が使う create_chat_completion（ストリーミングを含む）/ create_completion /
+    tokenize / detokenize / n_ctx と、次トークン確率（next_token_distribution）を HTTP で行う。
+    モデルはサーバ側で1度だけロードされ、並列スロットで複数の実験プロセスの要求を処理する。
+    プロンプトの KV キャッシュもサーバのスロットが持つので（cache_prompt）、
+    kv_cache.AgentSessionManager のような状態の保存・復元はしない。
+
+    サーバの応答の timings（llama.cpp server が返す）を _eval_timings に積算するので、
+    metrics.UsageTimer の prompt-eval / decode の時間とトークン数もそのまま使える。
+    同じクライアントを複数スレッドから同時に使うと使用量の切り分けが混ざるため、並行実行では
+    エージェントごとに pool を共有したクライアントを作る（with_shared_pool）。
+    """
+    is_remote = True
+
+    def __init__(self, url, model=None, n_ctx=None, pool=None, pool_size=8, timeout=600.0, retries=2):
+        self.url = url.rstrip("/")
+        self.pool = pool if pool is not None else ConnectionPool(self.url, max_size=pool_size, timeout=timeout)
+        self.retries = retries
+        self.chat_format = "server"
+        self.n_tokens = 0
+        self._eval_timings = {"prompt_eval_tokens": 0, "prompt_eval_ms": 0.0, "decode_tokens": 0, "decode_ms": 0.0}
+        self._props = None
+        self._n_ctx = n_ctx
+        self.model = model or self.props().get("model_alias") or self.props().get("model_path") or "llama-server"
+        self.model_path = self.props().get("model_path") or self.model
+
+    def with_shared_pool(self):
+        """同じ接続プールを使う別のクライアント（エージェントごとの使用量を分けるため）。"""
+        return LlamaServerClient(self.url, model=self.model, n_ctx=self._n_ctx, pool=self.pool, retries=self.retries)
+
+    def _request(self, method, path, payload=None, stream=False):
+        """
+        JSON を送って応答を返す。stream=True なら (接続, 応答) を返し、呼び出し側が読み終えたら release する。
+        接続エラー（keep-alive の切断など）は新しい接続で retries 回までやり直す。
+        """
+        body = json.dumps(payload).encode("utf-8") if payload is not None else None
+        headers = {"Content-Type": "application/json", "Connection": "keep-alive"}
+        last_error = None
+        for attempt in range(self.retries + 1):
+            conn = self.pool.acquire()
+            try:
+                conn.request(method, self.pool.base_path + path, body=body, headers=headers)
+                response = conn.getresponse()
+            except (http.client.HTTPException, ConnectionError, OSError) as e:
+                self.pool.release(conn, reusable=False)
+                last_error = e
+                time.sleep(0.05 * attempt)
+                continue
+            if response.status >= 400:
+                detail = response.read().decode("utf-8", errors="replace")
+                self.pool.release(conn, reusable=not response.will_close)
+                raise ServerError(f"{method} {path} -> HTTP {response.status}: {detail[:500]}")
+            if stream:
+                return conn, response
+            data = response.read()
+            self.pool.release(conn, reusable=not response.will_close)
+            try:
+                return json.loads(data)
+            except json.JSONDecodeError as e:
+                raise ServerError(f"{method} {path}: invalid JSON response") from e
+        raise ServerError(f"{method} {path}: {last_error}")
+
+    def props(self):
+        if self._props is None:
+            try:
+                self._props = self._request("GET", "/props")
+            except ServerError:
+                # OpenAI 互換のみのサーバには /props がない
+                self._props = {}
+        return self._props
+
+    def n_ctx(self):
+        if self._n_ctx is None:
+            settings = self.props().get("default_generation_settings", {})
+            self._n_ctx = int(settings.get("n_ctx") or self.props().get("n_ctx") or 8192)
+        return self._n_ctx
+
+    def tokenize(self, text, add_bos=True, special=False):
+        content = text.decode("utf-8", errors="ignore") if isinstance(text, bytes) else text
+        return self._request("POST", "/tokenize", {"content": content, "add_special": add_bos, "parse_special": special})["tokens"]
+
+    def detokenize(self, tokens, prev_tokens=None, special=False):
+        return self._request("POST", "/detokenize", {"tokens": list(tokens)})["content"].encode("utf-8")
+
+    def _add_timings(self, timings):
+        if not timings:
+            return
+        self._eval_timings["prompt_eval_tokens"] += int(timings.get("prompt_n", 0))
+        self._eval_timings["prompt_eval_ms"] += float(timings.get("prompt_ms", 0.0))
+        self._eval_timings["decode_tokens"] += int(timings.get("predicted_n", 0))
+        self._eval_timings["decode_ms"] += float(timings.get("predicted_ms", 0.0))
+
+    def _sampling(self, max_tokens, temperature, top_p, stop, seed, grammar):
+        payload = {"temperature": temperature, "top_p": top_p, "cache_prompt": True}
+        if max_tokens is not None:
+            payload["max_tokens"] = max_tokens
+        if stop:
+            payload["stop"] = stop
+        if seed is not None and seed != -1:
+            payload["seed"] = seed
+        if grammar is not None:
+            payload["grammar"] = grammar if isinstance(grammar, str) else getattr(grammar, "_grammar", str(grammar))
+        return payload
+
+    def _finish(self, output):
+        self._add_timings(output.get("timings"))
+        usage = output.get("usage") or {}
+        self.n_tokens = int(usage.get("prompt_tokens", 0)) + int(usage.get("completion_tokens", 0))
+        return output
+
+    def create_chat_completion(self, messages, max_tokens=None, temperature=0.2, top_p=0.95, stop=None, seed=None,
+                               grammar=None, stream=False, **kwargs):
+        payload = {"model": self.model, "messages": messages, **self._sampling(max_tokens, temperature, top_p, stop, seed, grammar)}
+        if stream:
+            payload["stream"] = True
+            payload["stream_options"] = {"include_usage": True}
+            # 途中で切断しても使用量がわかるよう、チャンクごとに（累積の）timings を付けてもらう
+            payload["timings_per_token"] = True
+            return self._stream("/v1/chat/completions", payload)
+        return self._finish(self._request("POST", "/v1/chat/completions", payload))
+
+    def create_completion(self, prompt, max_tokens=16, temperature=0.8, top_p=0.95, stop=None, seed=None, **kwargs):
+        payload = {"model": self.model, "prompt": prompt, **self._sampling(max_tokens, temperature, top_p, stop, seed, None)}
+        return self._finish(self._request("POST", "/v1/completions", payload))
+
+    def __call__(self, prompt, **kwargs):
+        return self.create_completion(prompt, **kwargs)
+
+    def _stream(self, path, payload):
+        """
+        Server-Sent Events を1チャンクずつ返すジェネレータ。途中で close() されたら接続を捨てる
+        （サーバは切断を検知して生成を止める）。最後まで読めた接続はプールに戻す。
+        チャンクの timings は累積値なので、最後に受け取ったものを1回だけ積算する。
+        usage が届く前に打ち切った場合の n_tokens は、評価したプロンプトと生成したトークンの数になる。
+        """
+        conn, response = self._request("POST", path, payload, stream=True)
+        finished = False
+        timings = None
+        usage = None
+        try:
+            for raw in response:
+                line = raw.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    finished = True
+                    break
+                chunk = json.loads(data)
+                timings = chunk.get("timings") or timings
+                usage = chunk.get("usage") or usage
+                if chunk.get("choices"):
+                    yield chunk
+                elif chunk.get("usage"):
+                    # include_usage の最後のチャンク（choices が空）
+                    yield {**chunk, "choices": [{"index": 0, "delta": {}, "finish_reason": None}]}
+        finally:
+            if finished:
+                response.read()
+            self.pool.release(conn, reusable=finished and not response.will_close)
+            if usage is not None:
+                self._finish({"usage": usage, "timings": timings})
+            elif timings is not None:
+                self._add_timings(timings)
+                self.n_tokens = int(timings.get("prompt_n", 0)) + int(timings.get("predicted_n", 0))
+
+    def next_token_distribution(self, prompt, options, top_k=20):
+        """
+        prompt の直後のトークンが options（先頭の空白を除いて比べる）のどれかである確率を、
+        上位 top_k の logprobs から求めて options 内で正規化して返す。上位に入らなかった選択肢は 0 とみなす。
+        """
+        payload = {
+            "model": self.model, "prompt": prompt, "max_tokens": 1, "temperature": 0.0,
+            "logprobs": top_k, "cache_prompt": True,
+        }
+        output = self._finish(self._request("POST", "/v1/completions", payload))
+        # 次トークンを選ぶ直前（プロンプトだけを評価した状態）のトークン数にしておく
+        self.n_tokens = int((output.get("usage") or {}).get("prompt_tokens", 0))
+        top = output["choices"][0].get("logprobs", {}).get("top_logprobs") or [{}]
+        first = top[0]
+        if isinstance(first, list):
+            first = {entry["token"]: entry["logprob"] for entry in first}
+        wanted = {option.strip(): option for option in options}
+        logprobs = {}
+        for token, logprob in first.items():
+            key = token.strip()
+            if key in wanted and (key not in logprobs or logprob > logprobs[key]):
+                logprobs[key] = logprob
+        if not logprobs:
+            return {key: 1.0 / len(wanted) for key in wanted}
+        best = max(logprobs.values())
+        weights = {key: math.exp(logprobs[key] - best) if key in logprobs else 0.0 for key in wanted}
+        total = sum(weights.values())
+        return {key: w / total for key, w in weights.items()}
+
+    def close(self):
+        self.pool.close()
@@ -2,13 +2,67 @@ import sys
 import re
 import csv
 import os
+import argparse
+import asyncio
 from datetime import datetime
 from llama_cpp import Llama
-from agents import LlamaAgent, AgentTriad, ConsensusAgent, BFIAnalyzerAgent
+from agents import LlamaAgent, AgentTriad, ConsensusAgent, BFIAnalyzerAgent, OutputFormat, StoppingPolicy
 from bfi import run_bfi_test_with_analyzer
 from dataloader import dataloader
+from kv_cache import PersonaStateCache, AgentSessionManager
+from run_journal import RunJournal
+from round_executor import RoundExecutor
+from completion_cache import CompletionCache, derive_seed
+from event_log import EventLog, TextLog
+from metrics import TokenLedger, CallProfiler, summarize_usage
+from native_log import native_log
+from llama_server import LlamaServerClient
+from model_registry import ModelRegistry
+from results_store import ResultsStore
+from peer_compactor import PeerCompactor, STRATEGIES
+from json_stream import STREAM_STOPS
+from speculative import PromptLookupDraft
 import config
 
+# BigFive前提の性格特性辞書
+bigfive_prompts = {
+    "AgentT1": (
+        "You are a character with high Openness and high Agreeableness, paired with moderate Extraversion and moderate Conscientiousness. "
+        "Your imaginative mind and warm, cooperative nature drive you to explore innovative ideas while nurturing harmonious interactions. "
+        "You remain calm (low Neuroticism) even when facing challenges. "
+        "Answer thoughtfully and creatively, ensuring your responses reflect empathy and originality."
+    ),
+    "AgentT2": (
+        "You are a character with high Conscientiousness and high Extraversion, complemented by moderate Openness and low Agreeableness. "
+        "Your decisive, organized, and assertive demeanor makes you a pragmatic leader who values efficiency and clarity. "
+        "You maintain composure (low Neuroticism) and focus on delivering clear, goal-oriented responses without excessive sentiment. "
+        "Answer in a direct and methodical manner, staying true to your results-driven mindset."
+    ),
+    "AgentT3": (
+        "You are a character with high Openness and high Neuroticism, along with moderate levels of Conscientiousness, Extraversion, and Agreeableness. "
+        "Your rich inner life fuels a deep creative insight, though it is often accompanied by intense emotional sensitivity and occasional self-doubt. "
+        "Embrace your introspective and passionate nature; answer with nuanced, reflective responses that capture both your visionary ideas and your candid vulnerability."
+    ),
+    "AgentNone": (
+        ""
+    )
+}
+
+# 実験するチーム構成を定義
+# それぞれの構成は (チーム名, [agent1_personality, agent2_personality, agent3_personality]) のタプルとする
+team_configurations = [
+    ("TeamNone", [bigfive_prompts["AgentNone"], bigfive_prompts["AgentNone"], bigfive_prompts["AgentNone"]]),
+    ("TeamMixed", [bigfive_prompts["AgentT1"], bigfive_prompts["AgentT2"], bigfive_prompts["AgentT3"]]),
+    ("TeamT2", [bigfive_prompts["AgentT2"], bigfive_prompts["AgentT2"], bigfive_prompts["AgentT2"]])
+]
+
+MMLU_FIELDNAMES = [
+    "task_index", "question", "final_answer", "correct_answer", "is_correct", "token_count",
+    "prompt_tokens", "completion_tokens", "prompt_eval_tokens", "prompt_tps", "decode_tps",
+    "rounds", "stop_reason"
+]
+USAGE_COLUMNS = ["prompt_tokens", "completion_tokens", "prompt_eval_tokens", "prompt_tps", "decode_tps"]
+
 def summarize_conversation(history, max_prompt_tokens=4000):
     if len(history) > 100:
         system_msg = history[0]
@@ -17,6 +71,9 @@ def summarize_conversation(history, max_prompt_tokens=4000):
     return "\n".join(history)
 
 def format_mmlu_question(question_tuple):
+    # math / chess のように選択肢のない問題は問題文だけを渡す
+    if isinstance(question_tuple, str):
+        return f"Question: {question_tuple}"
     question, opt1, opt2, opt3, opt4 = question_tuple
     return (
         f"Question: {question}\n"
@@ -47,168 +104,451 @@ def calculate_total_tokens(round_responses):
     return total
 
 
-if __name__ == "__main__":
-    # 1. モデルのロード
-    llama = Llama(
-        model_path=config.get_model_path(),
+def load_model(n_threads=8, use_mmap=None, model_path=None, use_mlock=None, speculative=False, name=None):
+    """
+    Llama モデルをロードする。パスとロードオプションは台帳（model_registry）の name（省略時は config.FILENAME）の
+    エントリから引くので、登録済みならネットワークに触れずに mmap するだけで起動する。model_path を指定した場合は
+    そのファイルのエントリの設定を使い、台帳にないファイルなら config.MODEL_LOADER_OPTIONS だけを使う。
+    use_mmap=True なら重みはページキャッシュ経由で複数プロセス間で共有される。
+    use_mmap / use_mlock を指定すると台帳の設定より優先する。
+    speculative=True なら投機デコードの検証ができるよう logits_all=True でロードする
+    （下書きはモデルには付けず、エージェントが生成の間だけ付ける）。
+    """
+    if model_path is None:
+        model_path = config.get_model_path(name)
+        loader_options = ModelRegistry().loader_options(name)
+    else:
+        # 台帳の設定は、そのファイルが登録されている場合だけ使う
+        registry = ModelRegistry()
+        name = registry.name_for_path(model_path)
+        loader_options = registry.loader_options(name) if name else dict(config.MODEL_LOADER_OPTIONS)
+    options = {"n_gpu_layers": -1, "chat_format": "llama-3", "n_ctx": 8192, **loader_options}
+    if use_mmap is not None:
+        options["use_mmap"] = use_mmap
+    if use_mlock is not None:
+        options["use_mlock"] = use_mlock
+    if speculative:
+        options["logits_all"] = True
+    return Llama(
+        model_path=model_path,
         verbose=True,
-        n_threads=8,
-        n_gpu_layers=-1,
-        chat_format="llama-3",
-        n_ctx=8192
+        n_threads=n_threads,
+        **options
     )
 
-    # 2. BigFive前提の性格特性辞書
-    bigfive_prompts = {
-        "AgentT1": (
-            "You are a character with high Openness and high Agreeableness, paired with moderate Extraversion and moderate Conscientiousness. "
-            "Your imaginative mind and warm, cooperative nature drive you to explore innovative ideas while nurturing harmonious interactions. "
-            "You remain calm (low Neuroticism) even when facing challenges. "
-            "Answer thoughtfully and creatively, ensuring your responses reflect empathy and originality."
-        ),
-        "AgentT2": (
-            "You are a character with high Conscientiousness and high Extraversion, complemented by moderate Openness and low Agreeableness. "
-            "Your decisive, organized, and assertive demeanor makes you a pragmatic leader who values efficiency and clarity. "
-            "You maintain composure (low Neuroticism) and focus on delivering clear, goal-oriented responses without excessive sentiment. "
-            "Answer in a direct and methodical manner, staying true to your results-driven mindset."
-        ),
-        "AgentT3": (
-            "You are a character with high Openness and high Neuroticism, along with moderate levels of Conscientiousness, Extraversion, and Agreeableness. "
-            "Your rich inner life fuels a deep creative insight, though it is often accompanied by intense emotional sensitivity and occasional self-doubt. "
-            "Embrace your introspective and passionate nature; answer with nuanced, reflective responses that capture both your visionary ideas and your candid vulnerability."
-        ),
-        "AgentNone": (
-            ""
+def build_agents(llama, personalities, kv_sessions=None, completion_cache=None, stream_stop=config.STREAM_STOP, profiler=None,
+                 speculative=False):
+    """
+    Agent1～Agent3 を作成する（各チームごとに名前は同じく Agent1, Agent2, Agent3 とする）。
+    llama にリストを渡すと、各エージェントがそれぞれのモデル（コンテキスト）を使う。
+    speculative=True なら各エージェントにプロンプト参照の下書き（受理率はエージェントごとに数える）を持たせる。
+    """
+    output_format = OutputFormat.JSON if config.DEBATE_JSON_GRAMMAR else OutputFormat.PLAIN
+    models = llama if isinstance(llama, list) else [llama] * len(personalities)
+    return [
+        LlamaAgent(f"Agent{i+1}", personality, model, max_tokens=1024, kv_cache=kv_sessions, output_format=output_format,
+                   completion_cache=completion_cache, stream_stop=stream_stop, profiler=profiler,
+                   draft_model=PromptLookupDraft() if speculative else None)
+        for i, (personality, model) in enumerate(zip(personalities, models))
+    ]
+
+def make_round1_prompt(question_text, multiple_choice=True):
+    if not multiple_choice:
+        # math / chess は選択肢がないので、answer には最終的な答えだけを書かせる
+        return (
+            "please answer the question with step-by-step reasoning. "
+            f"{question_text} "
+            "Put only the final answer (no explanation) in \"answer\". "
+            "Output your answer in JSON format with the format: {\"reasoning\": \"\", \"answer\": \"\"}. Do not output any extra text."
         )
-    }
+    return (
+        "please answer the question with step-by-step reasoning. There is only one correct option. "
+        f"{question_text} "
+        "Output your answer in JSON format with the format: {\"reasoning\": \"\", \"answer\": \"\"}. Do not output any extra text."
+    )
 
-    # 3. 実験するチーム構成を定義
-    # それぞれの構成は (チーム名, [agent1_personality, agent2_personality, agent3_personality]) のタプルとする
-    team_configurations = [
-        ("TeamNone", [bigfive_prompts["AgentNone"], bigfive_prompts["AgentNone"], bigfive_prompts["AgentNone"]]),
-        ("TeamMixed", [bigfive_prompts["AgentT1"], bigfive_prompts["AgentT2"], bigfive_prompts["AgentT3"]]),
-        ("TeamT2", [bigfive_prompts["AgentT2"], bigfive_prompts["AgentT2"], bigfive_prompts["AgentT2"]])
-    ]
+def make_debate_prompt(other_resps):
+    return (
+        "These are the solutions to the question from other agents:\n"
+        f"One agent solution: {other_resps[0]}\n"
+        f"Another agent solution: {other_resps[1]}\n\n"
+        "Using the reasoning from the other agents as additional advice, can you give an updated answer? "
+        "Carefully review your own solution and that of the others."#and put your answer in the form (X) at the end of your response. "
+        "Output your answer in JSON format with the format: {\"reasoning\": \"\", \"answer\": \"\"}. Please strictly output in JSON format."
+    )
 
-    # それぞれのチーム構成ごとに実験を実施
-    #for team_name, personalities in team_configurations: 
-    team_name = "Teammixed"
-    personalities = [bigfive_prompts["AgentT1"], bigfive_prompts["AgentT2"], bigfive_prompts["AgentT3"]]
-    print(f"\n===== Running experiment for {team_name} =====\n")
-    # エージェントの定義（各チームごとに名前は同じく Agent1, Agent2, Agent3 とする）
-    agent1 = LlamaAgent("Agent1", personalities[0], llama, max_tokens=1024)
-    agent2 = LlamaAgent("Agent2", personalities[1], llama, max_tokens=1024)
-    agent3 = LlamaAgent("Agent3", personalities[2], llama, max_tokens=1024)
-    all_persona_agents = [agent1, agent2, agent3]
-    
-    # 議論前BFIテスト（必要に応じて実施・保存）
-    for ag in all_persona_agents:
-            run_bfi_test_with_analyzer(ag, BFIAnalyzerAgent(llama), "Pre", f"bfi_results_pre_{team_name}_{datetime.now().strftime('%Y%m%d_%H')}.csv")
-    
-    # 4. MMLUデータセットの読み込み
-    print("\n=== Loading tasks from MMLU dataset ===")
-    dl = dataloader("mmlu", n_case=990)
-    dl.set_mode("all")
-    
-    # 5. 3エージェントによるディベート
-    from collections import defaultdict
-    triad = AgentTriad(agent1, agent2, agent3)
-    print(f"\n=== 3-Agent Debate on MMLU tasks for {team_name} ===")
-    
-    # チーム毎のディベートログファイルを実験日時付きで保存
-    team_timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    debate_log_file = f"./results/debate_log_{team_name}_{team_timestamp}.txt"
-    with open(debate_log_file, "w", encoding="utf-8") as log_f:
-    
-        results_csv = f"./results/mmlu_results_{team_name}_{team_timestamp}.csv"
-        os.makedirs("./results", exist_ok=True)
-        fieldnames = ["task_index", "question", "final_answer", "correct_answer", "is_correct", "token_count"]
-    
+def log_round(triad, turn, log_f):
+    # 並行実行した場合も、出力はエージェントの順に揃える
+    for agent in triad.agents:
+        resp = triad.round_responses[turn][agent.name]
+        print(f"{agent.name} (Turn {turn}): {resp}\n")
+        log_f.write(f"{agent.name} (Turn {turn}): {resp}\n")
+    if triad.executor is not None:
+        summary = triad.executor.last_round_summary()
+        print(summary)
+        log_f.write(summary + "\n")
+
+def run_debate(triad, question_text, log_f, seed_key=None, multiple_choice=True):
+    """
+    1問について3ラウンドのディベートを行い、最終回答（多数決）を返す。
+    各ラウンドの回答は triad.round_responses に残る。
+    seed_key（例: (実行シード, 問題番号)）を渡すと、(問題, エージェント, ラウンド) ごとに決定的なシードを使う。
+    multiple_choice=False（math / chess）なら選択肢を前提にしないプロンプトを使う。
+    """
+    all_persona_agents = triad.agents
+
+    def round_seeds(turn):
+        if seed_key is None:
+            return None
+        return [derive_seed(*seed_key, agent.name, turn) for agent in all_persona_agents]
+
+    # 各エージェントの会話履歴をリセット
+    for agent in all_persona_agents:
+        agent.reset_history()
+
+    # ターン1：初回回答
+    print("\n=== Round 1 ===")
+    log_f.write("\n=== Round 1 ===\n")
+    round1_prompt = make_round1_prompt(question_text, multiple_choice)
+    triad.round_responses = {}
+    triad.round_usage = {}
+    triad.stop_reason = None
+    triad.round_responses[1] = triad.run_round([round1_prompt] * len(all_persona_agents), label=1, seeds=round_seeds(1))
+    log_round(triad, 1, log_f)
+
+    # ターン2とターン3（打ち切り条件を満たしたら残りのラウンドを省く）
+    for turn in range(2, 4):
+        if triad.should_stop(turn-1):
+            print(f"\n[Early stop] policy={triad.stop_reason} after round {turn-1}")
+            log_f.write(f"\n[Early stop] policy={triad.stop_reason} after round {turn-1}\n")
+            break
+        print(f"\n=== Round {turn} ===")
+        log_f.write(f"\n=== Round {turn} ===\n")
+        prompts = []
+        for agent in all_persona_agents:
+            other_resps = triad.peer_responses(turn-1, agent)
+            prompts.append(make_debate_prompt(other_resps))
+        triad.round_responses[turn] = triad.run_round(prompts, label=turn, seeds=round_seeds(turn))
+        log_round(triad, turn, log_f)
+
+    # 最終回答の多数決（3ターン目の各エージェントの回答から括弧内の値を抽出）
+    final_answer = triad.get_final_consensus()
+    print(f"\n[Final Consensus Answer] answer: {final_answer}\n")
+    log_f.write(f"\n[Final Consensus Answer] answer: {final_answer}\n")
+    return final_answer
+
+def emit_question_events(events, task_index, triad, final_answer, correct_ans, is_correct, token_count, usage):
+    """1問分の turn イベント（ラウンド×エージェント）と final イベントをイベントログに積む。"""
+    for turn, responses in triad.round_responses.items():
+        for agent_name, resp in responses.items():
+            agent_usage = triad.round_usage.get(turn, {}).get(agent_name) or {}
+            events.emit(
+                "turn",
+                task_index=task_index,
+                round=turn,
+                agent=agent_name,
+                answer=triad.extract_answer(resp),
+                reasoning=resp.get("reasoning", "") if isinstance(resp, dict) else resp,
+                words=count_tokens(resp),
+                prompt_tokens=agent_usage.get("prompt_tokens", 0),
+                completion_tokens=agent_usage.get("completion_tokens", 0),
+                prompt_eval_tokens=agent_usage.get("prompt_eval_tokens", 0),
+                cached=agent_usage.get("cached", False),
+            )
+    events.emit(
+        "final",
+        task_index=task_index,
+        rounds=len(triad.round_responses),
+        stop_reason=triad.stop_reason,
+        final_answer=final_answer,
+        correct_answer=correct_ans,
+        is_correct=is_correct,
+        token_count=token_count,
+        **usage
+    )
+
+def record_question(idx, question_tuple, correct_ans, triad, final_answer, log_f, ledger, write_row, events=None, journal=None,
+                    results=None):
+    """
+    ディベートを終えた1問の使用量をログに書き、結果の行を write_row に渡し、
+    イベントログ・ジャーナル・結果ストア（results_store.RunRecorder）に記録する。正解なら True を返す。
+    """
+    # ディベート全体のトークン数を算出（token_count は従来の単語数、usage はモデルが実際に処理したトークン数）
+    token_count = calculate_total_tokens(triad.round_responses)
+    usage = summarize_usage(u for turn_usage in triad.round_usage.values() for u in turn_usage.values())
+    ledger.add_question(idx+1, triad.round_usage)
+    print(f"Total token count for debate: {token_count}")
+    log_f.write(f"Total token count for debate: {token_count}\n")
+    usage_line = (
+        f"Model tokens for debate: prompt {usage['prompt_tokens']} (evaluated {usage['prompt_eval_tokens']}), "
+        f"completion {usage['completion_tokens']}, prompt-eval {usage['prompt_tps']} tok/s, decode {usage['decode_tps']} tok/s"
+    )
+    if usage["draft_tokens"]:
+        usage_line += f", draft accepted {usage['draft_accepted']}/{usage['draft_tokens']} ({usage['draft_acceptance'] * 100:.1f}%)"
+    print(usage_line)
+    log_f.write(usage_line + "\n")
+    question_usage = {k: usage[k] for k in USAGE_COLUMNS}
+
+    is_correct = (final_answer == str(correct_ans).strip().upper()) if correct_ans else False
+    question = question_tuple if isinstance(question_tuple, str) else question_tuple[0]
+    row = {
+        "task_index": idx+1,
+        "question": question,
+        "final_answer": final_answer,
+        "correct_answer": correct_ans,
+        "is_correct": is_correct,
+        "token_count": token_count,
+        **question_usage,
+        "rounds": len(triad.round_responses),
+        "stop_reason": triad.stop_reason or ""
+    }
+    write_row(row)
+    if results is not None:
+        results.add_question(row)
+    # 先にジャーナルに記録する（ここで落ちても再開時にこの問題のイベントを二重に出さない）
+    if journal is not None:
+        journal.record_task(idx+1, question, triad.round_responses, final_answer, correct_ans, is_correct, token_count,
+                            usage=question_usage, rounds=len(triad.round_responses), stop_reason=triad.stop_reason or "")
+    if events is not None:
+        emit_question_events(events, idx+1, triad, final_answer, correct_ans, is_correct, token_count, question_usage)
+    return is_correct
+
+def run_mmlu(triad, dl, indices, results_csv, debate_log_file, journal=None, seed=None, events=None, results=None):
+    """
+    dl の indices に含まれる問題についてディベートを行い、結果を results_csv に、
+    ディベートの経過を debate_log_file に書き出す。(正解数, 採点対象数) を返す。
+    journal（run_journal.RunJournal）を渡すと、完了済みの問題は飛ばし、
+    1問終わるごとに結果をジャーナルに追記する。正解率はジャーナル全体から再計算する。
+    seed を渡すと各生成のシードを (seed, 問題番号, エージェント, ラウンド) から決める。
+    events（event_log.EventLog）を渡すと、各回答と最終回答を構造化イベントとしても記録する。
+    results（results_store.RunRecorder）を渡すと、各問の結果を結果ストアにも追記する。
+    """
+    os.makedirs(os.path.dirname(results_csv) or ".", exist_ok=True)
+    os.makedirs(os.path.dirname(debate_log_file) or ".", exist_ok=True)
+    resuming = journal is not None and len(journal.completed) > 0
+    # ディベートログは回答ごとに書くので、書き込みはバックグラウンドの TextLog に任せる
+    with TextLog(debate_log_file, append=resuming) as log_f:
         with open(results_csv, "w", newline="", encoding="utf-8") as f:
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer = csv.DictWriter(f, fieldnames=MMLU_FIELDNAMES)
             writer.writeheader()
+            if resuming:
+                # 再開時は完了済みの行をジャーナルから書き直す（CSV はジャーナルに従う）
+                writer.writerows(journal.result_rows(MMLU_FIELDNAMES))
             num_correct = 0
             total = 0
-    
-            for idx in range(len(dl)):
-                item = dl[idx]
+            ledger = TokenLedger()
+
+            todo = [idx for idx in indices if journal is None or not journal.is_done(idx+1)]
+            # 問題の読み込みはバックグラウンドで先読みし、ディベート（推論）と重ねる
+            for idx, item in dl.prefetch(todo):
                 question_tuple = item["task_info"]
                 correct_ans = item["answer"]
                 question_text = format_mmlu_question(question_tuple)
                 print(f"\n--- MMLU Q{idx+1} ---\n{question_text}\n")
                 log_f.write(f"--- MMLU Q{idx+1} ---\n{question_text}\n")
-    
-                # 各エージェントの会話履歴をリセット
-                for agent in all_persona_agents:
-                    agent.reset_history()
-    
-                # ターン1：初回回答
-                print("\n=== Round 1 ===")
-                log_f.write("\n=== Round 1 ===\n")
-                round1_prompt = (
-                    "please answer the question with step-by-step reasoning. There is only one correct option. "
-                    f"{question_text} "
-                    "Output your answer in JSON format with the format: {\"reasoning\": \"\", \"answer\": \"\"}. Do not output any extra text."
-                )
-                triad.round_responses = {}
-                triad.round_responses[1] = {}
-                for agent in all_persona_agents:
-                    resp = agent.generate_response(round1_prompt)
-                    triad.round_responses[1][agent.name] = resp
-                    print(f"{agent.name} (Turn 1): {resp}\n")
-                    log_f.write(f"{agent.name} (Turn 1): {resp}\n")
-    
-                # ターン2とターン3
-                for turn in range(2, 4):
-                    print(f"\n=== Round {turn} ===")
-                    log_f.write(f"\n=== Round {turn} ===\n")
-                    triad.round_responses[turn] = {}
-                    for agent in all_persona_agents:
-                        other_resps = [triad.round_responses[turn-1][a.name] for a in all_persona_agents if a.name != agent.name]
-                        debate_prompt = (
-                            "These are the solutions to the question from other agents:\n"
-                            f"One agent solution: {other_resps[0]}\n"
-                            f"Another agent solution: {other_resps[1]}\n\n"
-                            "Using the reasoning from the other agents as additional advice, can you give an updated answer? "
-                            "Carefully review your own solution and that of the others."#and put your answer in the form (X) at the end of your response. "
-                            "Output your answer in JSON format with the format: {\"reasoning\": \"\", \"answer\": \"\"}. Please strictly output in JSON format."
-                        )
-                        resp = agent.generate_response(debate_prompt)
-                        triad.round_responses[turn][agent.name] = resp
-                        print(f"{agent.name} (Turn {turn}): {resp}\n")
-                        log_f.write(f"{agent.name} (Turn {turn}): {resp}\n")
-    
-                # 最終回答の多数決（3ターン目の各エージェントの回答から括弧内の値を抽出）
-                final_answer = triad.get_final_consensus()
-                print(f"\n[Final Consensus Answer] answer: {final_answer}\n")
-                log_f.write(f"\n[Final Consensus Answer] answer: {final_answer}\n")
-    
-                # ディベート全体のトークン数を算出
-                token_count = calculate_total_tokens(triad.round_responses)
-                print(f"Total token count for debate: {token_count}")
-                log_f.write(f"Total token count for debate: {token_count}\n")
-    
-                is_correct = (final_answer == correct_ans.upper()) if correct_ans else False
-                writer.writerow({
-                    "task_index": idx+1,
-                    "question": question_tuple[0],
-                    "final_answer": final_answer,
-                    "correct_answer": correct_ans,
-                    "is_correct": is_correct,
-                    "token_count": token_count
-                })
+
+                seed_key = None if seed is None else (seed, idx+1)
+                final_answer = run_debate(triad, question_text, log_f, seed_key=seed_key,
+                                          multiple_choice=not isinstance(question_tuple, str))
+
+                def write_row(row):
+                    writer.writerow(row)
+                    f.flush()
+                    log_f.flush()
+
+                is_correct = record_question(idx, question_tuple, correct_ans, triad, final_answer, log_f, ledger, write_row,
+                                             events=events, journal=journal, results=results)
                 if correct_ans:
                     total += 1
                     if is_correct:
                         num_correct += 1
-    
+
+            if journal is not None:
+                num_correct, total = journal.accuracy()
             if total > 0:
                 accuracy = num_correct / total
                 print(f"\nOverall accuracy: {accuracy*100:.1f}% ({num_correct}/{total})")
                 log_f.write(f"\nOverall accuracy: {accuracy*100:.1f}% ({num_correct}/{total})\n")
-    
+
+            if ledger.records:
+                print(ledger.report())
+                log_f.write(ledger.report() + "\n")
+                ledger.write_summary(os.path.splitext(results_csv)[0] + "_usage.csv")
+
         print(f"\nResults saved: {results_csv}\n")
         log_f.write(f"\nResults saved: {results_csv}\n")
+    return num_correct, total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="3エージェントによる MMLU ディベート実験")
+    parser.add_argument("--resume", metavar="RUN_ID", help="ジャーナルから中断した実行を再開する（例: Teammixed_20250212_105424）")
+    parser.add_argument("--n-case", type=int, default=990)
+    parser.add_argument("--parallel-agents", action="store_true", help="エージェントごとにコンテキストを持たせ、ラウンド内の生成を並行実行する")
+    parser.add_argument("--seed", type=int, default=None, help="指定すると (問題, エージェント, ラウンド) ごとに決定的なシードで生成する")
+    parser.add_argument("--completion-cache", action="store_true", help="シード指定の生成結果を SQLite にキャッシュして再実行時に再利用する")
+    parser.add_argument("--serial-baseline-every", type=int, default=10, help="並行実行時、この回数に1回はラウンドを直列で実行して比較の基準にする（0 で無効）")
+    parser.add_argument("--stop-unanimous-after", type=int, default=config.EARLY_STOP_UNANIMOUS_AFTER, metavar="K",
+                        help="ラウンド K 以降に3体の回答が一致したら残りのラウンドを省く")
+    parser.add_argument("--stop-stable-majority", action="store_true", default=config.EARLY_STOP_STABLE_MAJORITY,
+                        help="多数派の回答が2ラウンド続けて同じなら残りのラウンドを省く")
+    parser.add_argument("--max-question-tokens", type=int, default=config.EARLY_STOP_MAX_TOKENS,
+                        help="1問あたりのトークン（prompt + completion）の上限。超えそうなら残りのラウンドを省く")
+    parser.add_argument("--peer-token-budget", type=int, default=config.PEER_TOKEN_BUDGET,
+                        help="ラウンド2以降のプロンプトに埋め込む他エージェントの回答1件あたりのトークン上限")
+    parser.add_argument("--peer-compaction", choices=STRATEGIES, default=config.PEER_COMPACTION,
+                        help="上限を超えた回答の縮め方")
+    parser.add_argument("--stream-stop", choices=STREAM_STOPS, default=config.STREAM_STOP,
+                        help="ストリーミングで生成し、answer が閉じた時点（answer）か JSON が閉じた時点（object）でデコードを打ち切る")
+    parser.add_argument("--server-url", default=config.LLAMA_SERVER_URL,
+                        help="モデルをロードせず、起動済みの llama.cpp server（OpenAI 互換 API）を使う（例: http://127.0.0.1:8080）")
+    parser.add_argument("--profile", action="store_true",
+                        help="モデル呼び出しごとの待ち時間・評価時間・トークン数（llama.cpp のログのタイミングを含む）を記録する")
+    parser.add_argument("--async-questions", type=int, default=None, metavar="N",
+                        help="--server-url のサーバに対して最大 N 問のディベートを asyncio で同時に進める（結果は問題番号の順に書き出す）")
+    parser.add_argument("--offline", action="store_true", default=config.OFFLINE,
+                        help="モデルの取得にネットワークを使わない（台帳か models ディレクトリにあるファイルだけを使う）")
+    parser.add_argument("--mlock", action="store_true", default=None, help="モデルの重みを mlock して RAM に固定する")
+    parser.add_argument("--speculative", action="store_true", default=config.SPECULATIVE_DECODING,
+                        help="ディベートの生成でプロンプト参照（n-gram）の投機デコードを使い、ラウンドごとの受理率を記録する")
+    args = parser.parse_args()
+    config.OFFLINE = args.offline
+    if args.async_questions is not None and not args.server_url:
+        parser.error("--async-questions requires --server-url")
+    if args.speculative and args.server_url:
+        parser.error("--speculative decodes in-process; configure drafting on the llama.cpp server instead")
+
+    profiler = None
+    if args.profile:
+        # llama.cpp が fd に直接書くログを取り込み、呼び出しごとのタイミングを読み取る
+        native_log.install()
+        profiler = CallProfiler()
+
+    # 1. モデルのロード
+    n_threads = 8
+    executor = None
+    if args.server_url:
+        # モデルはサーバ側で常駐しているので、このプロセスではロードしない。
+        # 並行実行ではエージェントごとのクライアント（接続プールは共有）でサーバの並列スロットを使う
+        # 問題を同時に進める場合は、同時に走る呼び出しの数だけ接続を持てるようにする
+        llama = LlamaServerClient(args.server_url, pool_size=max(8, 3 * (args.async_questions or 0)))
+        agent_models = [llama] + [llama.with_shared_pool() for _ in range(2)] if args.parallel_agents else llama
+        if args.parallel_agents:
+            executor = RoundExecutor(max_workers=3, baseline_every=args.serial_baseline_every)
+    elif args.parallel_agents:
+        # エージェントごとにコンテキストを作り、スレッドを分け合う。
+        # 重みは mmap で共有されるので、追加のコンテキストは KV キャッシュ分のメモリで済む
+        per_agent_threads = max(1, n_threads // 3)
+        llama = load_model(n_threads=per_agent_threads, use_mlock=args.mlock, speculative=args.speculative)
+        agent_models = [llama] + [load_model(n_threads=per_agent_threads, model_path=llama.model_path, use_mlock=args.mlock,
+                                             speculative=args.speculative)
+                                  for _ in range(2)]
+        executor = RoundExecutor(max_workers=3, baseline_every=args.serial_baseline_every)
+    else:
+        llama = load_model(n_threads=n_threads, use_mlock=args.mlock, speculative=args.speculative)
+        agent_models = llama
+
+    # それぞれのチーム構成ごとに実験を実施
+    #for team_name, personalities in team_configurations: 
+    team_name = "Teammixed"
+    personalities = [bigfive_prompts["AgentT1"], bigfive_prompts["AgentT2"], bigfive_prompts["AgentT3"]]
+    print(f"\n===== Running experiment for {team_name} =====\n")
+    # ペルソナごとのシステムプロンプト評価済み状態（ディスクに保存され、再起動後も再利用される）と、
+    # 同じ Llama を交互に使う各エージェントの KV セッション
+    # （サーバを使う場合、プロンプトの KV キャッシュはサーバのスロットが持つ）
+    kv_sessions = None
+    if not args.server_url:
+        persona_cache = PersonaStateCache()
+        kv_sessions = AgentSessionManager(persona_cache)
+    completion_cache = None
+    if args.completion_cache:
+        if args.seed is None:
+            print("[WARNING] --completion-cache only caches seeded calls; pass --seed to enable it")
+        completion_cache = CompletionCache()
+    all_persona_agents = build_agents(agent_models, personalities, kv_sessions, completion_cache, stream_stop=args.stream_stop,
+                                      profiler=profiler, speculative=args.speculative)
+
+    # 実行 ID（チーム名＋開始日時）。再開時は同じ ID のジャーナル・結果ファイルを引き継ぐ
+    run_id = args.resume or f"{team_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    run_config = {
+        "team_name": team_name,
+        "personalities": personalities,
+        "dataset": "mmlu",
+        "n_case": args.n_case,
+        "model": os.path.basename(llama.model_path),
+        "max_tokens": all_persona_agents[0].max_tokens,
+        "debate_json_grammar": config.DEBATE_JSON_GRAMMAR,
+        "seed": args.seed,
+        "stream_stop": args.stream_stop,
+        "speculative": args.speculative,
+    }
+    stopping_policy = None
+    if args.stop_unanimous_after is not None or args.stop_stable_majority or args.max_question_tokens is not None:
+        stopping_policy = StoppingPolicy(args.stop_unanimous_after, args.stop_stable_majority, args.max_question_tokens)
+        run_config["stopping_policy"] = stopping_policy.config()
+    compactor = None
+    if args.peer_token_budget is not None:
+        compactor = PeerCompactor(llama, budget=args.peer_token_budget, strategy=args.peer_compaction, completion_cache=completion_cache)
+        run_config["peer_compaction"] = {"budget": args.peer_token_budget, "strategy": args.peer_compaction}
+    journal = RunJournal.for_run(run_id, run_config)
+    # 全実行の結果を集める SQLite（CSV と同じ内容を、チーム・エージェント・フェーズで引けるように追記する）
+    store = ResultsStore()
+    results = store.run(run_id, team=team_name, dataset="mmlu", model=run_config["model"], seed=args.seed, run_config=run_config)
+    
+    # 議論前BFIテスト（必要に応じて実施・保存）。再開時は実施済みなので行わない
+    if not args.resume:
+        for ag in all_persona_agents:
+                run_bfi_test_with_analyzer(ag, BFIAnalyzerAgent(llama), "Pre", f"bfi_results_pre_{team_name}_{datetime.now().strftime('%Y%m%d_%H')}.csv", scoring=config.BFI_SCORING, seed=args.seed,
+                                           n_samples=config.BFI_SAMPLES, results=results)
+    else:
+        print(f"[INFO] Resuming {run_id}: {len(journal.completed)} questions already done")
+    
+    # 4. MMLUデータセットの読み込み
+    print("\n=== Loading tasks from MMLU dataset ===")
+    dl = dataloader("mmlu", n_case=args.n_case)
+    dl.set_mode("all")
+    
+    # 5. 3エージェントによるディベート
+    triad = AgentTriad(*all_persona_agents, executor=executor, stopping_policy=stopping_policy, compactor=compactor)
+    print(f"\n=== 3-Agent Debate on MMLU tasks for {team_name} ===")
+    
+    # チーム毎のディベートログファイルを実行 ID（実験日時付き）で保存
+    debate_log_file = f"./results/debate_log_{run_id}.txt"
+    results_csv = f"./results/mmlu_results_{run_id}.csv"
+    # 集計用の構造化イベントログ（token_check.py で複数の実行をまとめて解析できる）
+    events = EventLog(f"./results/events_{run_id}.jsonl", run_id=run_id, append=bool(args.resume))
+    if not args.resume:
+        events.emit("run", config=run_config)
+    if args.async_questions:
+        from async_debate import run_mmlu_async
+        asyncio.run(run_mmlu_async(llama, personalities, dl, range(len(dl)), results_csv, debate_log_file,
+                                   max_inflight=args.async_questions, journal=journal, seed=args.seed, events=events, results=results,
+                                   stopping_policy=stopping_policy, compactor=compactor,
+                                   completion_cache=completion_cache, stream_stop=args.stream_stop, profiler=profiler))
+    else:
+        run_mmlu(triad, dl, range(len(dl)), results_csv, debate_log_file, journal=journal, seed=args.seed, events=events,
+                 results=results)
+    events.close()
+    store.close()
+    if kv_sessions is not None:
+        print(f"[INFO] KV session stats: {kv_sessions.stats}")
+        kv_sessions.close()
+    if args.server_url:
+        print(f"[INFO] Server connections: {llama.pool.stats}")
+        llama.close()
+    if completion_cache is not None:
+        print(f"[INFO] Completion cache: {completion_cache.summary()}")
+        completion_cache.close()
+    if compactor is not None:
+        print(f"[INFO] Peer compaction: {compactor.summary()}")
+    if executor is not None:
+        for turn, stat in executor.summary().items():
+            print(f"[INFO] Round {turn}: parallel {stat['parallel_s']} s, serial {stat['serial_s']} s, speedup x{stat['speedup']}")
+        executor.close()
+    if profiler is not None:
+        print(profiler.report())
+        csv_file, prom_file = profiler.write(f"./results/profile_{run_id}")
+        print(f"[INFO] Call profile saved: {csv_file}, {prom_file}")
     
     # 6. 議論後BFIテストの実施（コメントアウト）
     # for ag in all_persona_agents:
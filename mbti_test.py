@@ -7,7 +7,7 @@ import re
 from datetime import datetime
 from enum import Enum
 
-from agents import LlamaAgent, MBTIAnswer
+from agents import LlamaAgent
 
 # JSONファイルからMBTI質問を読み込む
 with open("translated_mbti_ch2en.json", "r", encoding="utf-8") as f:
@@ -15,18 +15,18 @@ with open("translated_mbti_ch2en.json", "r", encoding="utf-8") as f:
 
 TOTAL_QUESTIONS = len(MBTI_QUESTIONS)
 
-def run_mbti_test(agent: LlamaAgent, test_phase: str, base_csv_file="results"):
+def run_mbti_test(agent: LlamaAgent, test_phase: str, base_csv_file="results", results=None):
     """
     translated_mbti_ch2en.jsonを参照し、MBTIの質問(1~93)に対して
     Llamaエージェントを使ってA/Bを答えさせる。
+    各質問は A/B の次トークン確率を比べる1回の順伝播で回答させ、確率も記録する。
     回答を集計し、MBTIタイプを判定後、CSVに書き込む。
+    results（results_store.RunRecorder）を渡すと、結果ストアにも追記する。
     """
 
-    # MBTIモードON
-    agent.set_mbti_mode(True)
-
-    # A/Bの回答を保持
+    # A/Bの回答と確率を保持
     answer_list = []
+    item_rows = []
 
     for q_idx in range(1, TOTAL_QUESTIONS + 1):
         question_data = MBTI_QUESTIONS.get(str(q_idx))
@@ -42,35 +42,24 @@ def run_mbti_test(agent: LlamaAgent, test_phase: str, base_csv_file="results"):
             "Answer with only 'A' or 'B'."
         )
 
-        chosen_option = None
-        max_tries = 3
-
-        for attempt in range(max_tries):
-            response = agent.generate_response(user_prompt)
-            print(f"[DEBUG] Agent {agent.name} Q{q_idx} Response: '{response}'")
-
-            # 'A' または 'B' のみを抽出
-            if response in [MBTIAnswer.A.value, MBTIAnswer.B.value]:
-                chosen_option = response
-                break
-            else:
-                # 再試行用の追加プロンプト
-                user_prompt += "\nYour format was incorrect. Please respond with only 'A' or 'B'."
+        answer, probs = agent.answer_mbti(user_prompt)
+        chosen_option = answer.value
+        print(f"[DEBUG] Agent {agent.name} Q{q_idx} Response: '{chosen_option}' (A={probs['A']:.3f}, B={probs['B']:.3f})")
 
-        if not chosen_option:
-            print(f"[ERROR] {agent.name} failed Q{q_idx} after {max_tries} attempts. Test aborted.")
-            agent.set_mbti_mode(False)
-            return  # テストを中断
-
-        answer_list.append(chosen_option)
-
-    # MBTIモードOFF
-    agent.set_mbti_mode(False)
+        answer_list.append((q_idx, chosen_option))
+        item_rows.append({
+            "AgentName": agent.name,
+            "TestPhase": test_phase,
+            "Question": q_idx,
+            "Answer": chosen_option,
+            "P_A": round(probs["A"], 6),
+            "P_B": round(probs["B"], 6),
+        })
 
     # 回答から軸を集計 (E/I, S/N, T/F, J/P)
     axis_count = {"E": 0, "I": 0, "S": 0, "N": 0, "T": 0, "F": 0, "J": 0, "P": 0}
 
-    for q_idx, chosen_option in enumerate(answer_list, start=1):
+    for q_idx, chosen_option in answer_list:
         question_data = MBTI_QUESTIONS.get(str(q_idx))
         if not question_data:
             continue
@@ -108,4 +97,17 @@ def run_mbti_test(agent: LlamaAgent, test_phase: str, base_csv_file="results"):
         }
         writer.writerow(row)
 
+    # 同じ秒に終わった他のエージェントの行を消さないよう、結果と同じく追記する（ヘッダは最初の1回だけ）
+    items_csv = os.path.join(base_csv_file, f"mbti_items_{timestamp}.csv")
+    write_header = not os.path.exists(items_csv)
+    with open(items_csv, "a", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=["AgentName", "TestPhase", "Question", "Answer", "P_A", "P_B"])
+        if write_header:
+            writer.writeheader()
+        writer.writerows(item_rows)
+
+    if results is not None:
+        results.add_mbti(agent.name, test_phase, final_mbti)
+        results.add_mbti_items(item_rows)
+
     print(f"[INFO] MBTI test done for {agent.name} (phase={test_phase}). Result={final_mbti}. Saved to {csv_file}")
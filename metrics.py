@@ -0,0 +1,246 @@
+import csv
+import time
+
+from native_log import native_log, parse_native_timings
+
+USAGE_FIELDS = ["prompt_tokens", "completion_tokens", "prompt_eval_tokens", "prompt_eval_ms", "decode_ms", "wall_ms",
+                "draft_tokens", "draft_accepted"]
+
+
+def instrument_model(model):
+    """
+    model.eval をラップして、プロンプト評価（複数トークン）とデコード（1トークン）の
+    トークン数と時間を model._eval_timings に積算する。何度呼んでも1回だけラップする。
+    llama.cpp 側の性能カウンタはコンテキスト作成時に no_perf=True だと取れないため、ここで計る。
+    プレフィックス再利用で評価を省いたトークンは数えないので、実際の計算量がわかる。
+    投機デコード中の検証バッチ（直前のトークン + 下書き）は複数トークンでもデコードの1ステップとして数え、
+    一緒に評価した下書きのトークン数を draft_eval_tokens に積算する。
+    """
+    if getattr(model, "_eval_timings", None) is not None:
+        return model._eval_timings
+    timings = {"prompt_eval_tokens": 0, "prompt_eval_ms": 0.0, "decode_tokens": 0, "decode_ms": 0.0, "draft_eval_tokens": 0}
+    original_eval = model.eval
+
+    def timed_eval(tokens):
+        start = time.perf_counter()
+        try:
+            return original_eval(tokens)
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            draft = getattr(model, "draft_model", None)
+            verify = draft is not None and hasattr(draft, "take_pending") and draft.take_pending(len(tokens))
+            if len(tokens) > 1 and not verify:
+                timings["prompt_eval_tokens"] += len(tokens)
+                timings["prompt_eval_ms"] += elapsed
+            else:
+                timings["decode_tokens"] += 1
+                timings["decode_ms"] += elapsed
+                timings["draft_eval_tokens"] += len(tokens) - 1
+
+    model.eval = timed_eval
+    model._eval_timings = timings
+    return timings
+
+
+def draft_usage(before, after, completion_tokens):
+    """
+    PromptLookupDraft.stats の差分と生成トークン数から、1回の呼び出しの下書き数・受理数を求める。
+    最初のトークンはプロンプト評価から、各ステップは（受理した下書き + 1）トークンを確定するので
+    受理数は completion_tokens - 1 - ステップ数（途中で止めた場合に備えて 0～下書き数に収める）。
+    """
+    steps = after["steps"] - before["steps"]
+    drafted = after["drafted"] - before["drafted"]
+    accepted = max(0, min(drafted, completion_tokens - 1 - steps))
+    return {"draft_steps": steps, "draft_tokens": drafted, "draft_accepted": accepted}
+
+
+class UsageTimer:
+    """
+    モデル呼び出し1回分の使用量（トークン数・時間）を計測する。
+        timer = UsageTimer(model)
+        output = model.create_chat_completion(...)
+        usage = timer.finish(output)
+    同じモデルを同時に複数スレッドから使わない前提（RoundExecutor はモデルごとに直列化する）。
+    queued_at（time.perf_counter() の値）を渡すと、そこから呼び出し開始までを queue_ms とする。
+    cache_hit_tokens はプロンプトのうち KV キャッシュのプレフィックスを再利用して評価を省いたトークン数。
+    native_log をインストールしていれば、呼び出し中に llama.cpp が出力したタイミングも native_* に入れる。
+    モデルに下書き（speculative.PromptLookupDraft）が付いていれば、下書きしたトークン数（draft_tokens）と
+    受理されたトークン数（draft_accepted）も入れる。
+    """
+    def __init__(self, model, queued_at=None):
+        self.model = model
+        self.timings = instrument_model(model)
+        self.before = dict(self.timings)
+        self.draft = getattr(model, "draft_model", None)
+        self.draft_before = dict(self.draft.stats) if hasattr(self.draft, "stats") else None
+        self.native_mark = native_log.mark() if native_log.installed else None
+        self.start = time.perf_counter()
+        self.queue_ms = (self.start - queued_at) * 1000 if queued_at is not None else 0.0
+
+    def finish(self, output, cached=False):
+        usage = output.get("usage", {}) if isinstance(output, dict) else {}
+        result = {
+            "prompt_tokens": int(usage.get("prompt_tokens", 0)),
+            "completion_tokens": int(usage.get("completion_tokens", 0)),
+            "wall_ms": (time.perf_counter() - self.start) * 1000,
+            "queue_ms": self.queue_ms,
+            "cached": cached,
+        }
+        for field in ("prompt_eval_tokens", "prompt_eval_ms", "decode_ms"):
+            result[field] = 0 if cached else self.timings[field] - self.before[field]
+        result["cache_hit_tokens"] = 0 if cached else max(0, result["prompt_tokens"] - result["prompt_eval_tokens"])
+        if self.draft_before is not None and not cached:
+            result.update(draft_usage(self.draft_before, self.draft.stats, result["completion_tokens"]))
+        if self.native_mark is not None and not cached:
+            native = parse_native_timings(native_log.lines_since(self.native_mark))
+            if native is not None:
+                result.update(native)
+        return result
+
+
+def summarize_usage(usages):
+    """
+    複数の呼び出しの使用量を合計し、prompt-eval / decode のスループット（tokens/s）と
+    投機デコードの受理率（draft_acceptance = 受理数 / 下書き数）を付けて返す。
+    """
+    total = {field: 0 for field in USAGE_FIELDS}
+    total["calls"] = 0
+    for usage in usages:
+        if not usage:
+            continue
+        total["calls"] += 1
+        for field in USAGE_FIELDS:
+            total[field] += usage.get(field, 0)
+    total["prompt_tps"] = round(total["prompt_eval_tokens"] / total["prompt_eval_ms"] * 1000, 2) if total["prompt_eval_ms"] else 0.0
+    total["decode_tps"] = round(total["completion_tokens"] / total["decode_ms"] * 1000, 2) if total["decode_ms"] else 0.0
+    total["draft_acceptance"] = round(total["draft_accepted"] / total["draft_tokens"], 3) if total["draft_tokens"] else 0.0
+    for field in ("prompt_eval_ms", "decode_ms", "wall_ms"):
+        total[field] = round(total[field], 1)
+    return total
+
+
+class TokenLedger:
+    """
+    ディベート全体の使用量を (問題, ラウンド, エージェント) ごとに記録し、
+    エージェント別・ラウンド別・問題別に集計する。
+    """
+    def __init__(self):
+        self.records = []
+
+    def add_question(self, task_index, round_usage):
+        for turn, usages in round_usage.items():
+            for agent_name, usage in usages.items():
+                if usage:
+                    self.records.append({"task_index": task_index, "round": turn, "agent": agent_name, **usage})
+
+    def by(self, key):
+        groups = {}
+        for record in self.records:
+            groups.setdefault(record[key], []).append(record)
+        return {k: summarize_usage(v) for k, v in sorted(groups.items())}
+
+    def write_summary(self, csv_file):
+        fieldnames = ["group", "key", "calls"] + USAGE_FIELDS + ["prompt_tps", "decode_tps", "draft_acceptance"]
+        with open(csv_file, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            for group in ("agent", "round"):
+                for key, summary in self.by(group).items():
+                    writer.writerow({"group": group, "key": key, **summary})
+            writer.writerow({"group": "total", "key": "all", **summarize_usage(self.records)})
+
+    def report(self):
+        lines = []
+        for group in ("agent", "round"):
+            for key, s in self.by(group).items():
+                line = (
+                    f"{group}={key}: prompt {s['prompt_tokens']} (evaluated {s['prompt_eval_tokens']}), "
+                    f"completion {s['completion_tokens']}, prompt-eval {s['prompt_tps']} tok/s, decode {s['decode_tps']} tok/s"
+                )
+                if s["draft_tokens"]:
+                    line += f", draft accepted {s['draft_accepted']}/{s['draft_tokens']} ({s['draft_acceptance'] * 100:.1f}%)"
+                lines.append(line)
+        return "\n".join(lines)
+
+
+PROFILE_FIELDS = [
+    "agent", "round", "kind", "queue_ms", "wall_ms", "prompt_eval_ms", "decode_ms",
+    "prompt_tokens", "completion_tokens", "prompt_eval_tokens", "cache_hit_tokens", "cached",
+    "native_prompt_eval_ms", "native_prompt_eval_tokens", "native_decode_ms", "native_decode_tokens",
+    "draft_steps", "draft_tokens", "draft_accepted",
+]
+PROFILE_METRICS = ["queue_ms", "wall_ms", "prompt_eval_ms", "decode_ms", "prompt_tokens", "completion_tokens", "cache_hit_tokens"]
+
+
+def percentile(values, q):
+    """values の q パーセンタイル（線形補間）。"""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    pos = (len(values) - 1) * q / 100
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+class CallProfiler:
+    """
+    LlamaAgent のモデル呼び出し1回ごとの使用量（UsageTimer.finish の結果）を記録する。
+    LlamaAgent.profiler に渡すと、各呼び出しの後に record() が呼ばれる。
+    write() で呼び出しごとの CSV と、(エージェント, ラウンド) ごとの p50/p95 を
+    Prometheus のテキスト形式（summary）で書き出す。
+    """
+    def __init__(self):
+        self.records = []
+
+    def record(self, agent_name, kind, usage, round=None):
+        if usage:
+            self.records.append({"agent": agent_name, "round": "" if round is None else round, "kind": kind, **usage})
+
+    def by_agent_round(self):
+        groups = {}
+        for record in self.records:
+            groups.setdefault((record["agent"], str(record["round"])), []).append(record)
+        return groups
+
+    def write_csv(self, csv_file):
+        with open(csv_file, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=PROFILE_FIELDS, extrasaction="ignore")
+            writer.writeheader()
+            for record in self.records:
+                writer.writerow({k: round(v, 3) if isinstance(v, float) else v for k, v in record.items()})
+
+    def prometheus_text(self):
+        lines = []
+        groups = self.by_agent_round()
+        for metric in PROFILE_METRICS:
+            name = f"llama_call_{metric}"
+            lines.append(f"# HELP {name} {metric} per LlamaAgent model call")
+            lines.append(f"# TYPE {name} summary")
+            for (agent, turn), records in sorted(groups.items()):
+                values = [r.get(metric, 0) or 0 for r in records]
+                labels = f'agent="{agent}",round="{turn}"'
+                for q in (50, 95):
+                    lines.append(f'{name}{{{labels},quantile="{q / 100}"}} {percentile(values, q):.3f}')
+                lines.append(f"{name}_sum{{{labels}}} {sum(values):.3f}")
+                lines.append(f"{name}_count{{{labels}}} {len(values)}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path_prefix):
+        """<path_prefix>.csv と <path_prefix>.prom を書き出し、そのパスを返す。"""
+        csv_file, prom_file = f"{path_prefix}.csv", f"{path_prefix}.prom"
+        self.write_csv(csv_file)
+        with open(prom_file, "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text())
+        return csv_file, prom_file
+
+    def report(self):
+        lines = []
+        for (agent, turn), records in sorted(self.by_agent_round().items()):
+            wall = [r.get("wall_ms", 0) for r in records]
+            queue = [r.get("queue_ms", 0) for r in records]
+            lines.append(
+                f"agent={agent} round={turn or '-'}: {len(records)} calls, wall p50 {percentile(wall, 50):.1f} ms / "
+                f"p95 {percentile(wall, 95):.1f} ms, queue p95 {percentile(queue, 95):.1f} ms"
+            )
+        return "\n".join(lines)
@@ -0,0 +1,223 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+import config
+
+HASH_CHUNK_BYTES = 16 * 1024 * 1024
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def is_offline():
+    """config.OFFLINE か、huggingface_hub と同じ環境変数（HF_HUB_OFFLINE=1）が指定されていればネットワークを使わない。"""
+    return config.OFFLINE or os.environ.get("HF_HUB_OFFLINE", "").lower() in ("1", "true", "yes")
+
+
+def file_sha256(path, chunk_bytes=HASH_CHUNK_BYTES, progress=True):
+    """ファイルを chunk_bytes ずつ読んで SHA-256 を求める（数 GB の GGUF でもメモリに載せない）。"""
+    h = hashlib.sha256()
+    size = os.path.getsize(path)
+    done = 0
+    last_report = time.monotonic()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_bytes)
+            if not chunk:
+                break
+            h.update(chunk)
+            done += len(chunk)
+            if progress and time.monotonic() - last_report > 5:
+                print(f"[INFO] Verifying {os.path.basename(path)}: {done * 100 // max(1, size)}%")
+                last_report = time.monotonic()
+    return h.hexdigest()
+
+
+class ModelRegistry:
+    """
+    ローカルの GGUF ファイルを名前で引くための台帳（JSON）。エントリにはパス・サイズ・mtime・SHA-256・
+    取得元（repo_id / filename）と、llama_cpp.Llama に渡すロードオプション（use_mmap / use_mlock など）を持つ。
+
+    resolve はネットワークに触れずに台帳だけでパスを返す。チェックサムの検証は最初の1回だけ行い、
+    以後はサイズと mtime が記録と同じならそのまま信用する（変わっていたら検証し直す）。
+    台帳にないかファイルが消えている場合だけ、オフラインでなければ Hugging Face Hub から取得する。
+    """
+    def __init__(self, path=config.MODEL_REGISTRY_PATH):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self.entries = {}
+        if self.path.exists():
+            with open(self.path, encoding="utf-8") as f:
+                self.entries = json.load(f).get("models", {})
+
+    def _save(self):
+        # 一時ファイルに書いてから置き換え、書きかけの台帳が残らないようにする
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"models": self.entries}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, self.path)
+
+    def _resolve_path(self, entry):
+        path = Path(entry["path"])
+        return path if path.is_absolute() else (self.path.parent / path)
+
+    @staticmethod
+    def _stat(path):
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+
+    def register(self, name, path, repo_id=None, filename=None, sha256=None, verify=True, **loader_options):
+        """
+        path のファイルを name で登録する。verify=True なら SHA-256 を計算し、sha256 が与えられていれば照合する。
+        models ディレクトリ内のファイルは台帳からの相対パスで記録する（ディレクトリごと別のノードに運べる）。
+        """
+        path = Path(path).resolve()
+        if not path.exists():
+            raise FileNotFoundError(f"model file not found: {path}")
+        size, mtime_ns = self._stat(path)
+        digest = None
+        if verify:
+            digest = file_sha256(path)
+            if sha256 and digest != sha256:
+                raise ValueError(f"checksum mismatch for {path}: {digest} != {sha256}")
+        try:
+            stored_path = str(path.relative_to(self.path.parent.resolve()))
+        except ValueError:
+            stored_path = str(path)
+        with self._lock:
+            previous = self.entries.get(name, {})
+            self.entries[name] = {
+                "path": stored_path,
+                "repo_id": repo_id or previous.get("repo_id"),
+                "filename": filename or previous.get("filename") or path.name,
+                "size": size,
+                "mtime_ns": mtime_ns,
+                "sha256": digest or sha256 or previous.get("sha256"),
+                "verified_at": datetime.now().isoformat(timespec="seconds") if digest else previous.get("verified_at"),
+                "loader": {**previous.get("loader", {}), **loader_options},
+            }
+            self._save()
+        return self.entries[name]
+
+    def verify(self, name, force=False):
+        """
+        登録済みのファイルを確認する。サイズと mtime が記録どおりで検証済みなら何もしない（force=True なら必ずハッシュを取る）。
+        サイズが変わっていれば壊れているとみなす。mtime だけが変わった場合（コピーなど）はハッシュを取り直して照合する。
+        """
+        entry = self.entries[name]
+        path = self._resolve_path(entry)
+        if not path.exists():
+            raise FileNotFoundError(f"model file for {name!r} not found: {path}")
+        size, mtime_ns = self._stat(path)
+        if size != entry["size"]:
+            raise ValueError(f"model file for {name!r} changed size ({size} != {entry['size']}); re-download or re-register it")
+        if not force and entry.get("verified_at") and mtime_ns == entry["mtime_ns"]:
+            return entry
+        digest = file_sha256(path)
+        if entry.get("sha256") and digest != entry["sha256"]:
+            raise ValueError(f"checksum mismatch for {name!r}: {digest} != {entry['sha256']}")
+        with self._lock:
+            entry.update(sha256=digest, mtime_ns=mtime_ns, verified_at=datetime.now().isoformat(timespec="seconds"))
+            self._save()
+        return entry
+
+    def download(self, name, repo_id, filename, force=False):
+        """Hugging Face Hub から取得して登録する。LFS の etag（SHA-256）があれば照合する。"""
+        if is_offline():
+            raise FileNotFoundError(f"model {name!r} is not available locally and offline mode is enabled")
+        from huggingface_hub import get_hf_file_metadata, hf_hub_download, hf_hub_url
+
+        save_dir = self.path.parent
+        save_dir.mkdir(parents=True, exist_ok=True)
+        expected = None
+        try:
+            etag = (get_hf_file_metadata(hf_hub_url(repo_id, filename)).etag or "").strip('"')
+            expected = etag if _SHA256_RE.match(etag) else None
+        except Exception as e:
+            print(f"[WARNING] Could not fetch checksum for {repo_id}/{filename}: {e}")
+        path = hf_hub_download(repo_id=repo_id, filename=filename, local_dir=save_dir, force_download=force)
+        return self.register(name, path, repo_id=repo_id, filename=filename, sha256=expected)
+
+    def resolve(self, name=None, repo_id=None, filename=None):
+        """
+        name（省略時は config.FILENAME）のモデルのローカルパスを返す。登録済みで確認済みならネットワークにもディスクの
+        中身にも触れない。未登録でも models ディレクトリに同名のファイルがあればそれを検証して登録する。
+        """
+        name = name or config.FILENAME
+        entry = self.entries.get(name)
+        if entry is not None and self._resolve_path(entry).exists():
+            return str(self._resolve_path(self.verify(name)))
+        filename = filename or (entry or {}).get("filename") or name
+        local = self.path.parent / filename
+        if local.exists():
+            print(f"[INFO] Registering existing model file {local}")
+            return str(self._resolve_path(self.register(name, local, repo_id=repo_id, filename=filename)))
+        repo_id = repo_id or (entry or {}).get("repo_id") or config.REPO_ID
+        return str(self._resolve_path(self.download(name, repo_id, filename)))
+
+    def name_for_path(self, path):
+        """path のファイルを登録している名前（なければ None）。"""
+        path = Path(path).resolve()
+        for name, entry in self.entries.items():
+            if self._resolve_path(entry).resolve() == path:
+                return name
+        return None
+
+    def loader_options(self, name=None):
+        """llama_cpp.Llama に渡すロードオプション（config.MODEL_LOADER_OPTIONS にエントリの設定を重ねたもの）。"""
+        entry = self.entries.get(name or config.FILENAME, {})
+        return {**config.MODEL_LOADER_OPTIONS, **entry.get("loader", {})}
+
+    def set_loader_options(self, name, **options):
+        with self._lock:
+            self.entries[name].setdefault("loader", {}).update(options)
+            self._save()
+
+
+def _parse_value(text):
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return text
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ローカルの GGUF モデルの台帳を管理する")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("list", help="登録済みのモデルを表示する")
+    p_add = sub.add_parser("add", help="手元のファイルを登録する（オフラインのノードに持ち込んだファイルなど）")
+    p_add.add_argument("path")
+    p_add.add_argument("--name", help="省略時はファイル名")
+    p_add.add_argument("--sha256", help="照合するチェックサム")
+    p_add.add_argument("--repo-id")
+    p_verify = sub.add_parser("verify", help="チェックサムを計算し直して照合する")
+    p_verify.add_argument("name", nargs="?", default=config.FILENAME)
+    p_resolve = sub.add_parser("resolve", help="パスを表示する（必要なら取得する）")
+    p_resolve.add_argument("name", nargs="?", default=config.FILENAME)
+    p_set = sub.add_parser("set", help="ロードオプションを設定する（例: use_mlock=true）")
+    p_set.add_argument("name")
+    p_set.add_argument("options", nargs="+", metavar="KEY=VALUE")
+    args = parser.parse_args()
+
+    registry = ModelRegistry()
+    if args.command == "list":
+        for name, entry in registry.entries.items():
+            status = "verified" if entry.get("verified_at") else "unverified"
+            print(f"{name}: {entry['path']} ({entry['size'] / 2**30:.2f} GiB, {status}, loader={entry.get('loader', {})})")
+    elif args.command == "add":
+        entry = registry.register(args.name or os.path.basename(args.path), args.path, repo_id=args.repo_id, sha256=args.sha256)
+        print(f"[INFO] Registered {entry['path']} sha256={entry['sha256']}")
+    elif args.command == "verify":
+        entry = registry.verify(args.name, force=True)
+        print(f"[INFO] {args.name}: OK sha256={entry['sha256']}")
+    elif args.command == "resolve":
+        print(registry.resolve(args.name))
+    elif args.command == "set":
+        registry.set_loader_options(args.name, **{k: _parse_value(v) for k, v in (o.split("=", 1) for o in args.options)})
+        print(f"[INFO] {args.name}: loader={registry.loader_options(args.name)}")
@@ -0,0 +1,130 @@
+import ctypes
+import itertools
+import os
+import re
+import threading
+from collections import deque
+
+# llama.cpp が呼び出しごとに出力するタイミング（llama_perf_context_print / 旧版は llama_print_timings）
+_PROMPT_EVAL_RE = re.compile(r"prompt eval time\s*=\s*([\d.]+) ms /\s*(\d+) tokens")
+_EVAL_RE = re.compile(r"(?<!prompt )eval time\s*=\s*([\d.]+) ms /\s*(\d+) (?:runs|tokens)")
+
+try:
+    _libc = ctypes.CDLL(None)
+except OSError:
+    _libc = None
+
+
+def _flush_native():
+    # C 側の stdio バッファに残っている出力を、fd を差し替える前に書き出す
+    if _libc is not None:
+        try:
+            _libc.fflush(None)
+        except AttributeError:
+            pass
+
+
+def parse_native_timings(lines):
+    """
+    ネイティブログの行から llama.cpp のタイミングを取り出す。
+    1回分（prompt eval と eval の組が1つだけ）でなければ、どの呼び出しのものか決められないので None。
+    """
+    prompt = [m for m in map(_PROMPT_EVAL_RE.search, lines) if m]
+    decode = [m for m in map(_EVAL_RE.search, lines) if m]
+    if len(prompt) != 1 or len(decode) != 1:
+        return None
+    return {
+        "native_prompt_eval_ms": float(prompt[0].group(1)),
+        "native_prompt_eval_tokens": int(prompt[0].group(2)),
+        "native_decode_ms": float(decode[0].group(1)),
+        "native_decode_tokens": int(decode[0].group(2)),
+    }
+
+
+class NativeLogCapture:
+    """
+    llama.cpp など C 側が fd 1/2 に直接書く出力を、パイプ経由で読んでリングバッファ（直近 max_lines 行）に溜める。
+    install() でパイプと読み取りスレッドを用意し、redirect() / restore() で fd 1/2 をパイプに付け替える
+    （agents.suppress_stdout_stderr が抑制区間の出入りで呼ぶ）。
+    各行には通し番号が付き、mark() で取った番号以降の行を lines_since() で取り出せる。
+    mark() / lines_since() は sync() でパイプに目印を流し、それまでの出力を読み終えるのを待ってから返す。
+    """
+    def __init__(self, max_lines=4096):
+        self.lines = deque(maxlen=max_lines)
+        self.installed = False
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._markers = {}
+        self._marker_ids = itertools.count()
+        self._saved_fds = None
+
+    def install(self):
+        if self.installed:
+            return self
+        self._read_fd, self._write_fd = os.pipe()
+        self._thread = threading.Thread(target=self._reader, name="native-log-reader", daemon=True)
+        self._thread.start()
+        self.installed = True
+        return self
+
+    def _reader(self):
+        pending = b""
+        while True:
+            chunk = os.read(self._read_fd, 65536)
+            if not chunk:
+                return
+            pending += chunk
+            *complete, pending = pending.split(b"\n")
+            for raw in complete:
+                line = raw.decode("utf-8", errors="replace")
+                if line.startswith("\0sync:"):
+                    event = self._markers.pop(line, None)
+                    if event is not None:
+                        event.set()
+                    continue
+                with self._lock:
+                    self._seq += 1
+                    self.lines.append((self._seq, line))
+
+    def redirect(self):
+        if not self.installed or self._saved_fds is not None:
+            return
+        _flush_native()
+        self._saved_fds = (os.dup(1), os.dup(2))
+        os.dup2(self._write_fd, 1)
+        os.dup2(self._write_fd, 2)
+
+    def restore(self):
+        if self._saved_fds is None:
+            return
+        _flush_native()
+        out_fd, err_fd = self._saved_fds
+        os.dup2(out_fd, 1)
+        os.dup2(err_fd, 2)
+        os.close(out_fd)
+        os.close(err_fd)
+        self._saved_fds = None
+
+    def sync(self, timeout=1.0):
+        """ここまでにパイプへ書かれた出力をすべて読み終えるまで待つ。"""
+        if not self.installed:
+            return
+        _flush_native()
+        marker = f"\0sync:{next(self._marker_ids)}"
+        event = threading.Event()
+        self._markers[marker] = event
+        os.write(self._write_fd, (marker + "\n").encode("utf-8"))
+        event.wait(timeout)
+
+    def mark(self):
+        self.sync()
+        with self._lock:
+            return self._seq
+
+    def lines_since(self, seq):
+        self.sync()
+        with self._lock:
+            return [line for n, line in self.lines if n > seq]
+
+
+native_log = NativeLogCapture()
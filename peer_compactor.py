@@ -0,0 +1,165 @@
+import hashlib
+import json
+import re
+import threading
+from collections import OrderedDict
+
+from agents import AgentTriad, suppress_stdout_stderr
+
+STRATEGIES = ["truncate", "extractive", "summary"]
+
+# 結論を述べている文を優先して残すための手がかり
+_CONCLUSION_RE = re.compile(r"\b(therefore|thus|so|hence|answer|correct|conclude|because)\b", re.IGNORECASE)
+_SENTENCE_RE = re.compile(r"(?<=[.!?。])\s+")
+
+
+class PeerCompactor:
+    """
+    ラウンド2以降のディベートプロンプトに埋め込む他エージェントの回答を、
+    1件あたり budget トークン（モデルのトークナイザで数える）以内に収める。
+    収まっている回答はそのまま使い、超える回答は {"reasoning", "answer"} の JSON に作り直す。
+    answer は常に残し、reasoning を strategy に従って縮める。
+        truncate   : reasoning の先頭から予算いっぱいまで
+        extractive : 結論を述べる文・最後の文・最初の文を優先して、元の順序のまま予算内で選ぶ
+        summary    : モデルに短い要約を書かせる（回答ごとに1回だけ。結果はメモリと completion_cache に保存）
+    各回答は2体のエージェントに見せるので、縮めた結果は回答の内容ごとにキャッシュして使い回す。
+    """
+    def __init__(self, model, budget=256, strategy="truncate", completion_cache=None, max_entries=1024):
+        assert strategy in STRATEGIES, f"strategy {strategy} not valid."
+        self.model = model
+        self.budget = budget
+        self.strategy = strategy
+        self.completion_cache = completion_cache
+        self.max_entries = max_entries
+        self._compacted = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"kept": 0, "compacted": 0, "cache_hits": 0, "tokens_in": 0, "tokens_out": 0}
+
+    def count_tokens(self, text):
+        return len(self.model.tokenize(text.encode("utf-8"), add_bos=False))
+
+    def _truncate_tokens(self, text, n_tokens):
+        tokens = self.model.tokenize(text.encode("utf-8"), add_bos=False)
+        if len(tokens) <= n_tokens:
+            return text
+        return self.model.detokenize(tokens[:max(0, n_tokens)]).decode("utf-8", errors="ignore").rstrip() + " ..."
+
+    def _extract(self, reasoning, answer, n_tokens):
+        sentences = [s for s in _SENTENCE_RE.split(reasoning.strip()) if s]
+        if not sentences:
+            return ""
+        last = len(sentences) - 1
+
+        def score(i, sentence):
+            s = 0
+            if _CONCLUSION_RE.search(sentence) or (answer and re.search(rf"\(?\b{re.escape(answer)}\b\)?", sentence)):
+                s += 2
+            if i == last:
+                s += 2
+            if i == 0:
+                s += 1
+            return s
+
+        ranked = sorted(range(len(sentences)), key=lambda i: (-score(i, sentences[i]), i))
+        chosen = []
+        used = 0
+        for i in ranked:
+            cost = self.count_tokens(sentences[i])
+            if used + cost > n_tokens:
+                continue
+            chosen.append(i)
+            used += cost
+        if not chosen:
+            return self._truncate_tokens(sentences[ranked[0]], n_tokens)
+        return " ".join(sentences[i] for i in sorted(chosen))
+
+    def _summarize(self, reasoning, n_tokens):
+        key = None
+        if self.completion_cache is not None:
+            key = self.completion_cache.make_key(self.model, "peer_summary", {"reasoning": reasoning, "budget": n_tokens})
+            cached = self.completion_cache.get(key)
+            if cached is not None:
+                return cached
+        prompt = (
+            "Summarize the following reasoning in a few sentences, keeping the key facts and the conclusion.\n\n"
+            f"Reasoning: {reasoning}\n\nSummary:"
+        )
+        with suppress_stdout_stderr():
+            output = self.model.create_completion(prompt, max_tokens=n_tokens, temperature=0.0, stop=["\n\n"])
+        summary = output["choices"][0]["text"].strip()
+        # 要約が予算を超えることはないが、空なら先頭を切り詰めたものにする
+        summary = summary or self._truncate_tokens(reasoning, n_tokens)
+        if key is not None:
+            self.completion_cache.put(key, "peer_summary", summary)
+        return summary
+
+    def _split(self, resp):
+        """回答から (reasoning, answer) を取り出す。"""
+        answer = AgentTriad.extract_answer(resp)
+        if isinstance(resp, dict):
+            return str(resp.get("reasoning", "")), answer
+        m_json = re.search(r'(\{.*\})', resp, re.DOTALL)
+        if m_json:
+            try:
+                data = json.loads(m_json.group(1))
+                if isinstance(data, dict):
+                    return str(data.get("reasoning", "")), answer
+            except json.JSONDecodeError:
+                pass
+        return resp, answer
+
+    def compact(self, resp):
+        """1件の回答を予算内の文字列にして返す。"""
+        text = str(resp)
+        digest = hashlib.sha256(f"{self.strategy}\0{self.budget}\0{text}".encode("utf-8")).hexdigest()
+        with self._lock:
+            if digest in self._compacted:
+                self._compacted.move_to_end(digest)
+                self.stats["cache_hits"] += 1
+                return self._compacted[digest]
+
+        n_tokens = self.count_tokens(text)
+        if n_tokens <= self.budget:
+            compacted = text
+            outcome = "kept"
+        else:
+            reasoning, answer = self._split(resp)
+            # JSON の枠と answer の分を差し引いた残りを reasoning に使う
+            overhead = self.count_tokens(json.dumps({"reasoning": "", "answer": answer}, ensure_ascii=False))
+            n_reasoning = max(0, self.budget - overhead - 2)
+            if self.strategy == "truncate":
+                short = self._truncate_tokens(reasoning, n_reasoning)
+            elif self.strategy == "extractive":
+                short = self._extract(reasoning, answer, n_reasoning)
+            else:
+                short = self._summarize(reasoning, n_reasoning)
+            compacted = json.dumps({"reasoning": short, "answer": answer}, ensure_ascii=False)
+            # 切れ目でトークン化が変わり予算をわずかに超えることがあるので、収まるまで削る
+            for _ in range(8):
+                if self.count_tokens(compacted) <= self.budget or not short:
+                    break
+                excess = self.count_tokens(compacted) - self.budget
+                short = self._truncate_tokens(short, max(0, self.count_tokens(short) - excess - 2)).removesuffix(" ...")
+                compacted = json.dumps({"reasoning": short, "answer": answer}, ensure_ascii=False)
+            if self.count_tokens(compacted) >= n_tokens:
+                # 予算が JSON の枠より小さいなど、縮めても短くならない場合は元のまま
+                compacted = text
+                outcome = "kept"
+            else:
+                outcome = "compacted"
+        n_out = self.count_tokens(compacted)
+
+        # RoundExecutor のスレッドから同時に呼ばれるので、統計もロックの中で更新する
+        with self._lock:
+            self.stats[outcome] += 1
+            self.stats["tokens_in"] += n_tokens
+            self.stats["tokens_out"] += n_out
+            self._compacted[digest] = compacted
+            while len(self._compacted) > self.max_entries:
+                self._compacted.popitem(last=False)
+        return compacted
+
+    def summary(self):
+        saved = self.stats["tokens_in"] - self.stats["tokens_out"]
+        return (f"kept={self.stats['kept']} compacted={self.stats['compacted']} cache_hits={self.stats['cache_hits']} "
+                f"peer tokens {self.stats['tokens_in']} -> {self.stats['tokens_out']} (saved {saved})")
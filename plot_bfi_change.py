@@ -1,12 +1,30 @@
+import argparse
+
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 
-# CSVファイルの読み込み
-df = pd.read_csv("bfi_results_pre_TeamMixed_20250212_0953.csv")  # 適切なファイルパスに変更
+from results_store import BFI_TRAIT_COLUMNS, ResultsStore
+
+parser = argparse.ArgumentParser(description="エージェントごとの Big Five スコアの分布を箱ひげ図にする")
+parser.add_argument("--team", help="結果ストアから読むチーム（例: Teammixed）")
+parser.add_argument("--phase", default="Pre", help="Pre / Post")
+parser.add_argument("--run-id", help="特定の実行だけを使う")
+parser.add_argument("--csv", help="結果ストアではなく、以前の実行が書いた BFI の CSV を読む")
+args = parser.parse_args()
+
+# 結果ストア（全実行の BFI の行）から、チーム・フェーズ・実行で絞り込んで読む
+if args.csv:
+    df = pd.read_csv(args.csv)
+else:
+    store = ResultsStore()
+    df = pd.DataFrame(store.bfi_scores(team=args.team, phase=args.phase, run_id=args.run_id))
+    store.close()
+if df.empty:
+    raise SystemExit("[WARNING] No BFI results matched")
 
 # 数値データのみ抽出
-bigfive_traits = ["Extraversion", "Agreeableness", "Conscientiousness", "Neuroticism", "Openness"]
+bigfive_traits = BFI_TRAIT_COLUMNS
 
 # エージェントごとにループしてプロット
 agents = df["AgentName"].unique()
@@ -0,0 +1,275 @@
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import config
+
+BFI_TRAIT_COLUMNS = ["Extraversion", "Agreeableness", "Conscientiousness", "Neuroticism", "Openness"]
+DEBATE_COLUMNS = [
+    "task_index", "question", "final_answer", "correct_answer", "is_correct", "token_count",
+    "prompt_tokens", "completion_tokens", "prompt_eval_tokens", "prompt_tps", "decode_tps",
+    "rounds", "stop_reason"
+]
+
+_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS runs ("
+    " run_id TEXT PRIMARY KEY, team TEXT, dataset TEXT, model TEXT, seed INTEGER, config TEXT, created REAL)",
+    "CREATE TABLE IF NOT EXISTS bfi_scores ("
+    " run_id TEXT, team TEXT, agent TEXT, phase TEXT, sample INTEGER,"
+    " extraversion REAL, agreeableness REAL, conscientiousness REAL, neuroticism REAL, openness REAL, created REAL)",
+    "CREATE TABLE IF NOT EXISTS bfi_items ("
+    " run_id TEXT, team TEXT, agent TEXT, phase TEXT, question INTEGER, score REAL,"
+    " p1 REAL, p2 REAL, p3 REAL, p4 REAL, p5 REAL, created REAL)",
+    "CREATE TABLE IF NOT EXISTS mbti_results ("
+    " run_id TEXT, team TEXT, agent TEXT, phase TEXT, mbti TEXT, created REAL)",
+    "CREATE TABLE IF NOT EXISTS mbti_items ("
+    " run_id TEXT, team TEXT, agent TEXT, phase TEXT, question INTEGER, answer TEXT, p_a REAL, p_b REAL, created REAL)",
+    "CREATE TABLE IF NOT EXISTS debate_results ("
+    " run_id TEXT, team TEXT, dataset TEXT, task_index INTEGER, question TEXT, final_answer TEXT, correct_answer TEXT,"
+    " is_correct INTEGER, token_count INTEGER, prompt_tokens INTEGER, completion_tokens INTEGER, prompt_eval_tokens INTEGER,"
+    " prompt_tps REAL, decode_tps REAL, rounds INTEGER, stop_reason TEXT, created REAL,"
+    " PRIMARY KEY (run_id, task_index))",
+    "CREATE INDEX IF NOT EXISTS idx_bfi_scores_key ON bfi_scores(team, agent, phase)",
+    "CREATE INDEX IF NOT EXISTS idx_bfi_scores_run ON bfi_scores(run_id)",
+    "CREATE INDEX IF NOT EXISTS idx_bfi_items_key ON bfi_items(team, agent, phase, question)",
+    "CREATE INDEX IF NOT EXISTS idx_mbti_results_key ON mbti_results(team, agent, phase)",
+    "CREATE INDEX IF NOT EXISTS idx_mbti_items_key ON mbti_items(team, agent, phase, question)",
+    "CREATE INDEX IF NOT EXISTS idx_debate_results_key ON debate_results(team, dataset)",
+]
+
+
+def _where(filters):
+    """None でない条件だけを AND でつなぐ。値がリスト・タプルなら IN にする。"""
+    clauses = []
+    params = []
+    for column, value in filters.items():
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple)):
+            clauses.append(f"{column} IN ({', '.join('?' * len(value))})")
+            params.extend(value)
+        else:
+            clauses.append(f"{column} = ?")
+            params.append(value)
+    return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+
+class ResultsStore:
+    """
+    全実行の結果（BFI・MBTI・ディベート）を1つの SQLite に集める。
+    書き込みは実行ごとの RunRecorder（run()）から1件（または1回分）ずつ追記し、すぐに commit する。
+    読み出しは bfi_scores / mbti_results / debate_results / accuracy で、チーム・エージェント・フェーズ・
+    データセットで絞り込める（それぞれ索引つき）。返り値は dict のリストなので、そのまま pandas.DataFrame にできる。
+    """
+    def __init__(self, path=config.RESULTS_DB_PATH):
+        os.makedirs(os.path.dirname(str(path)) or ".", exist_ok=True)
+        self.path = str(path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        for statement in _SCHEMA:
+            self._conn.execute(statement)
+        self._conn.commit()
+
+    def _write(self, sql, rows):
+        with self._lock:
+            self._conn.executemany(sql, rows)
+            self._conn.commit()
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return [dict(row) for row in self._conn.execute(sql, params).fetchall()]
+
+    def run(self, run_id, team=None, dataset=None, model=None, seed=None, run_config=None):
+        """実行を登録し（登録済みならそのまま）、その実行の結果を書き込む RunRecorder を返す。"""
+        self._write(
+            "INSERT OR IGNORE INTO runs (run_id, team, dataset, model, seed, config, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(run_id, team, dataset, model, seed, json.dumps(run_config or {}, ensure_ascii=False), time.time())],
+        )
+        return RunRecorder(self, run_id, team, dataset)
+
+    def runs(self, team=None, dataset=None):
+        where, params = _where({"team": team, "dataset": dataset})
+        rows = self._query(f"SELECT * FROM runs{where} ORDER BY created", params)
+        for row in rows:
+            row["config"] = json.loads(row["config"] or "{}")
+        return rows
+
+    def bfi_scores(self, team=None, agent=None, phase=None, run_id=None):
+        where, params = _where({"team": team, "agent": agent, "phase": phase, "run_id": run_id})
+        rows = self._query(
+            "SELECT run_id, team, agent, phase, sample, extraversion, agreeableness, conscientiousness, neuroticism, openness"
+            f" FROM bfi_scores{where} ORDER BY created, rowid", params,
+        )
+        # CSV と同じ列名（plot_bfi_change.py などが使う）
+        return [
+            {"run_id": r["run_id"], "team": r["team"], "AgentName": r["agent"], "TestPhase": r["phase"], "sample": r["sample"],
+             **{trait: r[trait.lower()] for trait in BFI_TRAIT_COLUMNS}}
+            for r in rows
+        ]
+
+    def bfi_items(self, team=None, agent=None, phase=None, run_id=None):
+        where, params = _where({"team": team, "agent": agent, "phase": phase, "run_id": run_id})
+        return self._query(f"SELECT * FROM bfi_items{where} ORDER BY created, rowid", params)
+
+    def mbti_results(self, team=None, agent=None, phase=None, run_id=None):
+        where, params = _where({"team": team, "agent": agent, "phase": phase, "run_id": run_id})
+        return self._query(f"SELECT * FROM mbti_results{where} ORDER BY created, rowid", params)
+
+    def mbti_items(self, team=None, agent=None, phase=None, run_id=None):
+        where, params = _where({"team": team, "agent": agent, "phase": phase, "run_id": run_id})
+        return self._query(f"SELECT * FROM mbti_items{where} ORDER BY created, rowid", params)
+
+    def debate_results(self, team=None, dataset=None, run_id=None):
+        where, params = _where({"team": team, "dataset": dataset, "run_id": run_id})
+        return self._query(f"SELECT * FROM debate_results{where} ORDER BY run_id, task_index", params)
+
+    def accuracy(self, by=("team", "dataset")):
+        """正解のある問題について、by の列ごとの (正解数, 採点対象数, 正解率) を返す。"""
+        columns = ", ".join(by)
+        return self._query(
+            f"SELECT {columns}, SUM(is_correct) AS correct, COUNT(*) AS total, AVG(is_correct) AS accuracy"
+            f" FROM debate_results WHERE correct_answer IS NOT NULL AND correct_answer != ''"
+            f" GROUP BY {columns} ORDER BY {columns}"
+        )
+
+    def import_csv(self, csv_file, run_id=None, team=None, dataset=None):
+        """
+        以前の実行が書いた CSV（BFI / BFI の項目 / MBTI / MBTI の項目 / ディベートの結果）を取り込む。
+        種類はヘッダから判定する。run_id を省略するとファイル名（拡張子なし）を使う。取り込んだ行数を返す。
+        同じファイルを取り込み直しても重複しないよう、その実行のファイルに含まれるフェーズの行を先に消す
+        （ディベートの結果は (run_id, task_index) で置き換わる）。
+        """
+        run_id = run_id or os.path.splitext(os.path.basename(csv_file))[0]
+        with open(csv_file, newline="", encoding="utf-8") as f:
+            rows = list(csv.DictReader(f))
+        if not rows:
+            return 0
+        header = set(rows[0])
+        recorder = self.run(run_id, team=team, dataset=dataset)
+
+        def clear(table):
+            with self._lock:
+                self._conn.executemany(f"DELETE FROM {table} WHERE run_id = ? AND phase = ?",
+                                       [(run_id, phase) for phase in {row["TestPhase"] for row in rows}])
+                self._conn.commit()
+
+        if {"P1", "P5", "Question"} <= header:
+            clear("bfi_items")
+            for row in rows:
+                recorder.add_bfi_items(row["AgentName"], row["TestPhase"], [float(row["Score"])],
+                                       [{k: float(row[f"P{k}"]) for k in range(1, 6)}], questions=[int(row["Question"])])
+        elif set(BFI_TRAIT_COLUMNS) <= header:
+            clear("bfi_scores")
+            for row in rows:
+                recorder.add_bfi_scores(row["AgentName"], row["TestPhase"], [{t: float(row[t]) for t in BFI_TRAIT_COLUMNS}])
+        elif {"P_A", "P_B"} <= header:
+            clear("mbti_items")
+            recorder.add_mbti_items(rows)
+        elif "MBTI" in header:
+            clear("mbti_results")
+            for row in rows:
+                recorder.add_mbti(row["AgentName"], row["TestPhase"], row["MBTI"])
+        elif "task_index" in header:
+            for row in rows:
+                row["is_correct"] = row.get("is_correct") in ("True", "1", "true")
+                recorder.add_question(row)
+        else:
+            raise ValueError(f"{csv_file}: unknown results format")
+        return len(rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RunRecorder:
+    """1つの実行（run_id・チーム・データセット）の結果を ResultsStore に追記する。"""
+    def __init__(self, store, run_id, team=None, dataset=None):
+        self.store = store
+        self.run_id = run_id
+        self.team = team
+        self.dataset = dataset
+
+    def clear(self, phase, test="bfi"):
+        """この実行の phase の BFI（test="bfi"）または MBTI（test="mbti"）の行を消す（途中で落ちたセルをやり直す前に）。"""
+        with self.store._lock:
+            for table in (f"{test}_scores", f"{test}_items") if test == "bfi" else (f"{test}_results", f"{test}_items"):
+                self.store._conn.execute(f"DELETE FROM {table} WHERE run_id = ? AND phase = ?", (self.run_id, phase))
+            self.store._conn.commit()
+
+    def add_bfi_scores(self, agent, phase, trait_rows):
+        """trait_rows は特性 → スコアの dict のリスト（1回1行。繰り返し受けた場合は複数行）。"""
+        now = time.time()
+        self.store._write(
+            "INSERT INTO bfi_scores (run_id, team, agent, phase, sample, extraversion, agreeableness, conscientiousness,"
+            " neuroticism, openness, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(self.run_id, self.team, agent, phase, i, *(float(row[t]) for t in BFI_TRAIT_COLUMNS), now)
+             for i, row in enumerate(trait_rows)],
+        )
+
+    def add_bfi_items(self, agent, phase, scores, distributions, questions=None):
+        now = time.time()
+        questions = questions or range(1, len(scores) + 1)
+        self.store._write(
+            "INSERT INTO bfi_items (run_id, team, agent, phase, question, score, p1, p2, p3, p4, p5, created)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(self.run_id, self.team, agent, phase, q, float(score), *(float(dist[k]) for k in range(1, 6)), now)
+             for q, score, dist in zip(questions, scores, distributions)],
+        )
+
+    def add_mbti(self, agent, phase, mbti):
+        self.store._write(
+            "INSERT INTO mbti_results (run_id, team, agent, phase, mbti, created) VALUES (?, ?, ?, ?, ?, ?)",
+            [(self.run_id, self.team, agent, phase, mbti, time.time())],
+        )
+
+    def add_mbti_items(self, item_rows):
+        """mbti_test の項目の行（AgentName, TestPhase, Question, Answer, P_A, P_B）をまとめて追記する。"""
+        now = time.time()
+        self.store._write(
+            "INSERT INTO mbti_items (run_id, team, agent, phase, question, answer, p_a, p_b, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(self.run_id, self.team, r["AgentName"], r["TestPhase"], int(r["Question"]), r["Answer"],
+              float(r["P_A"]), float(r["P_B"]), now) for r in item_rows],
+        )
+
+    def add_question(self, row):
+        """ディベート1問の結果（main.MMLU_FIELDNAMES の行）。同じ問題を書き直した場合は置き換える。"""
+        values = [row.get(column) for column in DEBATE_COLUMNS]
+        values[DEBATE_COLUMNS.index("is_correct")] = int(bool(row.get("is_correct")))
+        self.store._write(
+            f"INSERT OR REPLACE INTO debate_results (run_id, team, dataset, {', '.join(DEBATE_COLUMNS)}, created)"
+            f" VALUES (?, ?, ?, {', '.join('?' * len(DEBATE_COLUMNS))}, ?)",
+            [(self.run_id, self.team, self.dataset, *values, time.time())],
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="結果ストア（SQLite）への CSV の取り込みと集計")
+    parser.add_argument("--db", default=str(config.RESULTS_DB_PATH))
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_import = sub.add_parser("import", help="以前の実行の CSV を取り込む")
+    p_import.add_argument("csv_files", nargs="+")
+    p_import.add_argument("--team")
+    p_import.add_argument("--dataset")
+    sub.add_parser("runs", help="登録されている実行を表示する")
+    sub.add_parser("accuracy", help="チーム・データセットごとの正解率を表示する")
+    args = parser.parse_args()
+
+    store = ResultsStore(args.db)
+    if args.command == "import":
+        for csv_file in args.csv_files:
+            n = store.import_csv(csv_file, team=args.team, dataset=args.dataset)
+            print(f"[INFO] {csv_file}: {n} rows imported")
+    elif args.command == "runs":
+        for run in store.runs():
+            print(f"{run['run_id']}: team={run['team']} dataset={run['dataset']} model={run['model']} seed={run['seed']}")
+    elif args.command == "accuracy":
+        for row in store.accuracy():
+            print(f"{row['team']} / {row['dataset']}: {row['accuracy']*100:.1f}% ({row['correct']}/{row['total']})")
+    store.close()
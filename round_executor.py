@@ -0,0 +1,81 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class RoundExecutor:
+    """
+    1ラウンド内で互いに独立したエージェントの生成を並行して実行する。
+    エージェントごとに別の Llama コンテキスト（同じ GGUF を mmap したもの）を持たせると並列に動く。
+    同じ Llama インスタンスを共有するエージェント同士は、コンテキストを壊さないよう直列に実行する。
+    llama.cpp の推論中は GIL が解放されるのでスレッドで十分。
+    calls は (agent, prompt, seed) のリストで、結果は常に渡された順で返す。
+
+    並行実行中の各呼び出し時間は互いの競合で伸びるため、その合計は直列実行の目安にならない。
+    そこで baseline_every ラウンドに1回（ラウンド番号ごとに数える）は実際に直列で実行し、
+    ラウンド番号ごとの平均壁時計時間を並行・直列で比較する。
+    """
+    def __init__(self, max_workers=3, baseline_every=10):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.baseline_every = baseline_every
+        self.round_stats = []
+        self._round_counts = {}
+
+    def _run_group(self, calls, label=None, queued_at=None):
+        # queued_at はラウンドを受け付けた時刻。同じモデルの前の呼び出しを待った時間も queue_ms に入る
+        return [agent.generate_response(prompt, seed=seed, round=label, queued_at=queued_at) for agent, prompt, seed in calls]
+
+    def run(self, calls, label=None):
+        count = self._round_counts.get(label, 0)
+        self._round_counts[label] = count + 1
+        serial = self.baseline_every > 0 and count % self.baseline_every == 0
+
+        start = time.perf_counter()
+        if serial:
+            results = self._run_group(calls, label, start)
+        else:
+            # 同じモデルを使う呼び出しは1つのグループにまとめて直列に実行する
+            groups = {}
+            for i, call in enumerate(calls):
+                groups.setdefault(id(call[0].model), []).append((i, call))
+            futures = [
+                (group, self.pool.submit(self._run_group, [call for _, call in group], label, start))
+                for group in groups.values()
+            ]
+            results = [None] * len(calls)
+            for group, future in futures:
+                for (i, _), response in zip(group, future.result()):
+                    results[i] = response
+        wall = time.perf_counter() - start
+
+        self.round_stats.append({
+            "round": label,
+            "mode": "serial" if serial else "parallel",
+            "wall_s": round(wall, 3),
+        })
+        return results
+
+    def last_round_summary(self):
+        stat = self.round_stats[-1]
+        return f"[Round {stat['round']}] {stat['mode']} wall {stat['wall_s']:.2f}s"
+
+    def summary(self):
+        """
+        ラウンド番号ごとに {"parallel_s": 平均, "serial_s": 平均, "speedup": 比} を返す。
+        """
+        result = {}
+        for label in self._round_counts:
+            walls = {"parallel": [], "serial": []}
+            for stat in self.round_stats:
+                if stat["round"] == label:
+                    walls[stat["mode"]].append(stat["wall_s"])
+            parallel = round(sum(walls["parallel"]) / len(walls["parallel"]), 3) if walls["parallel"] else None
+            serial = round(sum(walls["serial"]) / len(walls["serial"]), 3) if walls["serial"] else None
+            result[label] = {
+                "parallel_s": parallel,
+                "serial_s": serial,
+                "speedup": round(serial / parallel, 2) if parallel and serial else None,
+            }
+        return result
+
+    def close(self):
+        self.pool.shutdown()
@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+from datetime import datetime
+
+
+def config_hash(run_config):
+    """実験設定（dict）から再開可否の判定に使うハッシュを作る。"""
+    payload = json.dumps(run_config, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class RunJournal:
+    """
+    長時間のディベート実験の途中経過を JSONL で記録するジャーナル。
+    1行目に実行情報（run_id, 設定ハッシュ）、以降は1問ごとに結果を1行ずつ追記する。
+    各行は O_APPEND で一度に書き込み fsync するので、途中で落ちても
+    書き終わった問題までは必ず残る（書きかけの最終行は読み込み時に無視する）。
+    """
+    def __init__(self, path, run_id, run_config):
+        self.path = path
+        self.run_id = run_id
+        self.config_hash = config_hash(run_config)
+        self.completed = {}
+        if os.path.exists(path):
+            self._load()
+        else:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._append({
+                "type": "run",
+                "run_id": run_id,
+                "config_hash": self.config_hash,
+                "config": run_config,
+                "started_at": datetime.now().isoformat(timespec="seconds"),
+            })
+
+    @classmethod
+    def for_run(cls, run_id, run_config, journal_dir="./results"):
+        return cls(os.path.join(journal_dir, f"journal_{run_id}.jsonl"), run_id, run_config)
+
+    def _load(self):
+        with open(self.path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    # 書きかけの行を閉じ、次の追記が同じ行に連結されないようにする
+                    with open(self.path, "ab") as fa:
+                        fa.write(b"\n")
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # 書き込み途中で中断された行
+                    continue
+                if record.get("type") == "run":
+                    if record.get("config_hash") != self.config_hash:
+                        raise ValueError(
+                            f"journal {self.path} was written with a different configuration "
+                            f"({record.get('config_hash')[:12]} != {self.config_hash[:12]})"
+                        )
+                elif record.get("type") == "task":
+                    self.completed[record["task_index"]] = record
+
+    def _append(self, record):
+        data = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def is_done(self, task_index):
+        return task_index in self.completed
+
+    def record_task(self, task_index, question, round_responses, final_answer, correct_answer, is_correct, token_count, usage=None, **extra):
+        record = {
+            "type": "task",
+            "task_index": task_index,
+            "question": question,
+            "round_responses": round_responses,
+            "final_answer": final_answer,
+            "correct_answer": correct_answer,
+            "is_correct": is_correct,
+            "token_count": token_count,
+            "usage": usage or {},
+            **extra,
+        }
+        self._append(record)
+        self.completed[task_index] = record
+
+    def result_rows(self, fieldnames):
+        """結果 CSV の行（task_index 順）をジャーナルから作り直す。"""
+        rows = []
+        for i in sorted(self.completed):
+            record = {**self.completed[i].get("usage", {}), **self.completed[i]}
+            rows.append({k: record.get(k, "") for k in fieldnames})
+        return rows
+
+    def accuracy(self):
+        """ジャーナルに記録された全問題から (正解数, 採点対象数) を再計算する。"""
+        scored = [r for r in self.completed.values() if r["correct_answer"]]
+        return sum(1 for r in scored if r["is_correct"]), len(scored)
@@ -0,0 +1,131 @@
+import argparse
+import csv
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import multiprocessing
+
+import config
+from dataloader import shard_bounds
+from main import MMLU_FIELDNAMES, team_configurations
+from results_store import ResultsStore
+
+
+def shard_ranges(n_items, n_shards):
+    """
+    0..n_items-1 を n_shards 個の連続した範囲に分ける（サイズの差は高々1）。
+    """
+    return shard_bounds(n_items, n_shards)
+
+
+def run_shard(shard_id, start, end, model_path, n_threads, team_name, personalities, n_case, shard_dir, run_id,
+              results_db=config.RESULTS_DB_PATH):
+    """
+    ワーカープロセスで実行される。モデルを mmap でロードし、[start, end) の問題をディベートする。
+    各問の結果は結果ストア（results_db）の run_id の実行に直接追記する。シャードごとに問題番号が
+    重ならないので全シャードが同じ run_id に書け、複数プロセスからの書き込みは SQLite の WAL が捌く。
+    """
+    from agents import AgentTriad
+    from dataloader import dataloader
+    from kv_cache import PersonaStateCache, AgentSessionManager
+    from event_log import EventLog
+    from main import load_model, build_agents, run_mmlu
+
+    llama = load_model(n_threads=n_threads, use_mmap=True, model_path=model_path)
+    kv_sessions = AgentSessionManager(PersonaStateCache())
+    triad = AgentTriad(*build_agents(llama, personalities, kv_sessions))
+    dl = dataloader("mmlu", n_case=n_case)
+    dl.set_mode("all")
+
+    results_csv = os.path.join(shard_dir, f"mmlu_results_shard{shard_id:03d}.csv")
+    debate_log_file = os.path.join(shard_dir, f"debate_log_shard{shard_id:03d}.txt")
+    events_file = os.path.join(shard_dir, f"events_shard{shard_id:03d}.jsonl")
+    store = ResultsStore(results_db)
+    results = store.run(run_id, team=team_name, dataset="mmlu", model=os.path.basename(model_path))
+    try:
+        with EventLog(events_file, run_id=f"{team_name}_shard{shard_id:03d}") as events:
+            run_mmlu(triad, dl, range(start, end), results_csv, debate_log_file, events=events, results=results)
+    finally:
+        store.close()
+        kv_sessions.close()
+    return shard_id, results_csv, debate_log_file, events_file
+
+
+def merge_shards(shard_outputs, results_csv, debate_log_file, events_file=None):
+    """
+    各シャードの結果 CSV を task_index 順に、ディベートログとイベントログをシャード順に結合する。
+    """
+    rows = []
+    for _, shard_csv, *_ in shard_outputs:
+        with open(shard_csv, newline="", encoding="utf-8") as f:
+            rows.extend(csv.DictReader(f))
+    rows.sort(key=lambda row: int(row["task_index"]))
+
+    num_correct = sum(1 for row in rows if row["correct_answer"] and row["is_correct"] == "True")
+    total = sum(1 for row in rows if row["correct_answer"])
+    with open(results_csv, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=MMLU_FIELDNAMES)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    with open(debate_log_file, "w", encoding="utf-8") as log_f:
+        for shard_id, _, shard_log, *_ in sorted(shard_outputs):
+            with open(shard_log, encoding="utf-8") as f:
+                log_f.write(f.read())
+        if total > 0:
+            log_f.write(f"\nMerged accuracy: {num_correct / total * 100:.1f}% ({num_correct}/{total})\n")
+
+    if events_file is not None:
+        with open(events_file, "w", encoding="utf-8") as out:
+            for shard_id, _, _, shard_events in sorted(shard_outputs):
+                with open(shard_events, encoding="utf-8") as f:
+                    shutil.copyfileobj(f, out)
+    return num_correct, total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MMLU ディベートを複数プロセスに分割して実行する")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads-per-worker", type=int, default=0, help="0 ならコア数をワーカー数で割った値")
+    parser.add_argument("--n-case", type=int, default=990)
+    parser.add_argument("--team", default="TeamMixed", choices=[name for name, _ in team_configurations])
+    args = parser.parse_args()
+
+    personalities = dict(team_configurations)[args.team]
+    n_threads = args.threads_per_worker or max(1, (os.cpu_count() or 1) // args.workers)
+    # モデルの取得は親プロセスで一度だけ行い、各ワーカーは同じファイルを mmap する
+    model_path = config.get_model_path()
+
+    from dataloader import dataloader
+    n_items = len(dataloader("mmlu", n_case=args.n_case))
+    ranges = shard_ranges(n_items, args.workers)
+
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    run_id = f"{args.team}_{timestamp}"
+    shard_dir = f"./results/shards_{args.team}_{timestamp}"
+    os.makedirs(shard_dir, exist_ok=True)
+    print(f"[INFO] {n_items} questions -> {len(ranges)} shards x {n_threads} threads")
+    # 実行の設定は親プロセスで登録しておく（ワーカーの登録は INSERT OR IGNORE なので上書きしない）
+    store = ResultsStore()
+    store.run(run_id, team=args.team, dataset="mmlu", model=os.path.basename(model_path),
+              run_config={"team_name": args.team, "personalities": personalities, "dataset": "mmlu", "n_case": args.n_case,
+                          "model": os.path.basename(model_path), "workers": len(ranges)})
+    store.close()
+
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=len(ranges), mp_context=ctx) as pool:
+        futures = [
+            pool.submit(run_shard, i, start, end, model_path, n_threads, args.team, personalities, args.n_case, shard_dir,
+                        run_id)
+            for i, (start, end) in enumerate(ranges)
+        ]
+        shard_outputs = [future.result() for future in futures]
+
+    results_csv = f"./results/mmlu_results_{args.team}_{timestamp}.csv"
+    debate_log_file = f"./results/debate_log_{args.team}_{timestamp}.txt"
+    events_file = f"./results/events_{args.team}_{timestamp}.jsonl"
+    num_correct, total = merge_shards(shard_outputs, results_csv, debate_log_file, events_file)
+    if total > 0:
+        print(f"\nOverall accuracy: {num_correct / total * 100:.1f}% ({num_correct}/{total})")
+    print(f"\nResults saved: {results_csv} (results store run_id={run_id})\n")
@@ -0,0 +1,50 @@
+import threading
+
+from llama_cpp.llama_speculative import LlamaPromptLookupDecoding
+
+import config
+
+
+def supports_drafting(model):
+    """
+    model が投機デコードの検証に使えるか（全トークンの logits を保持しているか）。
+    llama_cpp.Llama は draft_model か logits_all=True を指定してロードしたときだけ検証できる。
+    """
+    return bool(getattr(model, "_logits_all", False))
+
+
+class PromptLookupDraft(LlamaPromptLookupDecoding):
+    """
+    プロンプト参照（n-gram）によるドラフト。直近 max_ngram_size トークンと一致する箇所をコンテキストから探し、
+    その続きの最大 num_pred_tokens トークンを下書きとして返す。ラウンド2以降は他エージェントの reasoning を
+    引用・言い換えることが多いので、プロンプト中の文をそのまま下書きにでき、1回の評価で複数トークンを確定できる。
+
+    llama_cpp.Llama.generate はデコードの各ステップで draft(input_ids) を呼び、[直前のトークン] + 下書きを
+    まとめて評価して一致した分だけ受理する。ここではステップ数と下書きのトークン数を stats に数え、
+    metrics.UsageTimer がその差分から受理率を出す（受理数 = 生成トークン数 - 1 - ステップ数）。
+    pending は直後の検証バッチの長さで、metrics.instrument_model がプロンプト評価と区別するのに使う。
+    min_round より前のラウンドでは使わない（ラウンドの指定がない呼び出しでは常に使う）。
+    """
+    def __init__(self, max_ngram_size=config.PROMPT_LOOKUP_NGRAM, num_pred_tokens=config.PROMPT_LOOKUP_TOKENS,
+                 min_round=config.SPECULATIVE_MIN_ROUND):
+        super().__init__(max_ngram_size=max_ngram_size, num_pred_tokens=num_pred_tokens)
+        self.min_round = min_round
+        self.stats = {"steps": 0, "drafted": 0}
+        self._pending = threading.local()
+
+    def __call__(self, input_ids, /, **kwargs):
+        draft = super().__call__(input_ids, **kwargs)
+        self.stats["steps"] += 1
+        self.stats["drafted"] += len(draft)
+        self._pending.size = len(draft) + 1
+        return draft
+
+    def applies_to(self, round):
+        return round is None or not isinstance(round, int) or round >= self.min_round
+
+    def take_pending(self, n_tokens):
+        """長さ n_tokens の評価が直前の下書きの検証バッチなら True を返し、記録を消す。"""
+        size = getattr(self._pending, "size", 0)
+        self._pending.size = 0
+        # コンテキストの残りが足りないと llama_cpp は下書きを切り詰めるので、それより短いバッチも検証とみなす
+        return 0 < n_tokens <= size
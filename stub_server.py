@@ -0,0 +1,202 @@
+import argparse
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from fake_backend import FakeLlama
+from metrics import instrument_model
+
+
+class _Slots:
+    """並列スロット。スロットごとに FakeLlama（= 別のコンテキスト）を1つ持つ。"""
+    def __init__(self, n_parallel, **fake_kwargs):
+        self.models = [FakeLlama(**fake_kwargs) for _ in range(n_parallel)]
+        self._free = queue.Queue()
+        for model in self.models:
+            # 1つのモデルを共有するスロットと同じく、トークン ID はどのスロットでも同じにする
+            first = self.models[0]
+            model._vocab, model._pieces, model._vocab_lock = first._vocab, first._pieces, first._vocab_lock
+            instrument_model(model)
+            self._free.put(model)
+
+    def acquire(self):
+        return self._free.get()
+
+    def release(self, model):
+        self._free.put(model)
+
+
+def _timings(model, before):
+    after = model._eval_timings
+    return {
+        "prompt_n": after["prompt_eval_tokens"] - before["prompt_eval_tokens"],
+        "prompt_ms": after["prompt_eval_ms"] - before["prompt_eval_ms"],
+        "predicted_n": after["decode_tokens"] - before["decode_tokens"],
+        "predicted_ms": after["decode_ms"] - before["decode_ms"],
+    }
+
+
+def _sampling_kwargs(body):
+    return {
+        "max_tokens": body.get("max_tokens"),
+        "temperature": body.get("temperature", 0.8),
+        "top_p": body.get("top_p", 0.95),
+        "stop": body.get("stop"),
+        "seed": body.get("seed", -1),
+    }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """llama.cpp server の OpenAI 互換 API のうち、llama_server.LlamaServerClient が使う部分だけを返す。"""
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        elif self.path == "/props":
+            model = self.server.slots.models[0]
+            self._send_json(200, {
+                "model_path": model.model_path,
+                "total_slots": len(self.server.slots.models),
+                "default_generation_settings": {"n_ctx": model.n_ctx()},
+            })
+        else:
+            self._send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+
+    def do_POST(self):
+        routes = {
+            "/tokenize": self._tokenize,
+            "/detokenize": self._detokenize,
+            "/v1/chat/completions": self._chat,
+            "/v1/completions": self._completion,
+        }
+        handler = routes.get(self.path)
+        if handler is None:
+            self._send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+            return
+        body = self._read_body()
+        model = self.server.slots.acquire()
+        try:
+            handler(model, body)
+        finally:
+            self.server.slots.release(model)
+
+    def _tokenize(self, model, body):
+        tokens = model.tokenize(body["content"].encode("utf-8"), add_bos=body.get("add_special", False))
+        self._send_json(200, {"tokens": tokens})
+
+    def _detokenize(self, model, body):
+        self._send_json(200, {"content": model.detokenize(body["tokens"]).decode("utf-8")})
+
+    def _chat(self, model, body):
+        before = dict(model._eval_timings)
+        if body.get("stream"):
+            self._stream_chat(model, body, before)
+            return
+        output = model.create_chat_completion(body["messages"], **_sampling_kwargs(body))
+        self._send_json(200, {**output, "timings": _timings(model, before)})
+
+    def _write_chunk(self, payload):
+        data = f"data: {json.dumps(payload) if not isinstance(payload, str) else payload}\n\n".encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _stream_chat(self, model, body, before):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        prompt_tokens = model.stats["prompt_tokens"]
+        completion_tokens = model.stats["completion_tokens"]
+        stream = model.create_chat_completion(body["messages"], stream=True, **_sampling_kwargs(body))
+        try:
+            for chunk in stream:
+                if body.get("timings_per_token"):
+                    chunk = {**chunk, "timings": _timings(model, before)}
+                self._write_chunk(chunk)
+            usage = {
+                "prompt_tokens": model.stats["prompt_tokens"] - prompt_tokens,
+                "completion_tokens": model.stats["completion_tokens"] - completion_tokens,
+            }
+            self._write_chunk({"object": "chat.completion.chunk", "choices": [], "usage": usage, "timings": _timings(model, before)})
+            self._write_chunk("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # クライアントが途中で切断した（回答が決まって生成を打ち切った）
+            self.close_connection = True
+        finally:
+            stream.close()
+
+    def _completion(self, model, body):
+        before = dict(model._eval_timings)
+        top_k = body.get("logprobs")
+        if not top_k:
+            output = model.create_completion(body["prompt"], **_sampling_kwargs(body))
+            self._send_json(200, {**output, "timings": _timings(model, before)})
+            return
+        # 次トークンの上位 top_k の logprobs（既知の断片の中から選ぶ）
+        tokens = model.tokenize(body["prompt"].encode("utf-8"), add_bos=True, special=True)
+        model._eval_prompt(tokens)
+        logits = model.scores[model.n_tokens - 1][:len(model._pieces)].astype(np.float64)
+        logits[:2] = -np.inf
+        logprobs = logits - logits.max() - np.log(np.exp(logits - logits.max()).sum())
+        best = np.argsort(-logprobs)[:top_k]
+        top = {model.detokenize([int(i)]).decode("utf-8"): float(logprobs[i]) for i in best}
+        text = model.detokenize([int(best[0])]).decode("utf-8")
+        self._send_json(200, {
+            "object": "text_completion",
+            "choices": [{"index": 0, "text": text, "logprobs": {"top_logprobs": [top]}, "finish_reason": "length"}],
+            "usage": {"prompt_tokens": len(tokens), "completion_tokens": 1, "total_tokens": len(tokens) + 1},
+            "timings": _timings(model, before),
+        })
+
+
+def start_stub_server(host="127.0.0.1", port=0, n_parallel=1, **fake_kwargs):
+    """
+    スタブサーバをバックグラウンドのスレッドで起動し、(server, url) を返す。
+    port=0 なら空いているポートを使う。止めるときは server.shutdown()。
+    """
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.slots = _Slots(n_parallel, **fake_kwargs)
+    thread = threading.Thread(target=server.serve_forever, name="stub-llama-server", daemon=True)
+    thread.start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="fake_backend.FakeLlama を llama.cpp server 互換の HTTP API で提供するスタブ")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--parallel", type=int, default=1, help="並列スロット数")
+    parser.add_argument("--prompt-ms", type=float, default=0.0)
+    parser.add_argument("--decode-ms", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    server, url = start_stub_server(args.host, args.port, args.parallel, seed=args.seed, prompt_ms=args.prompt_ms, decode_ms=args.decode_ms)
+    print(f"[INFO] Stub llama server listening on {url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,59 @@
+import asyncio
+
+from adaptive_limiter import AdaptiveLimiter
+
+
+def _usage(wall_ms, completion_tokens=10, **extra):
+    return {"wall_ms": wall_ms, "completion_tokens": completion_tokens, **extra}
+
+
+def test_additive_increase_when_latency_is_flat():
+    limiter = AdaptiveLimiter(initial=2, max_limit=4)
+    for _ in range(2):
+        limiter.observe(_usage(100))
+    assert limiter.limit == 3
+    for _ in range(3 + 4):
+        limiter.observe(_usage(100))
+    assert limiter.limit == 4  # max_limit で止まる
+    assert [(old, new) for _, old, new, _ in limiter.history] == [(2, 3), (3, 4)]
+
+
+def test_multiplicative_decrease_when_latency_grows():
+    limiter = AdaptiveLimiter(initial=8, min_limit=2, tolerance=0.5, backoff=0.5, alpha=1.0)
+    limiter.observe(_usage(100))
+    for _ in range(7):
+        limiter.observe(_usage(300))
+    assert limiter.limit == 4
+    for _ in range(4):
+        limiter.observe(_usage(300))
+    assert limiter.limit == 2
+    for _ in range(2):
+        limiter.observe(_usage(300))
+    assert limiter.limit == 2  # min_limit より下げない
+
+
+def test_cached_and_empty_usage_are_ignored():
+    limiter = AdaptiveLimiter(initial=1)
+    limiter.observe(None)
+    limiter.observe(_usage(5, cached=True))
+    assert limiter.ewma is None and limiter.limit == 1
+    limiter.observe(_usage(50, completion_tokens=0))
+    assert limiter.ewma == 50.0
+
+
+def test_concurrency_never_exceeds_limit():
+    limiter = AdaptiveLimiter(initial=3, max_limit=3)
+    peak = 0
+
+    async def call():
+        nonlocal peak
+        async with limiter:
+            peak = max(peak, limiter.in_flight)
+            await asyncio.sleep(0.001)
+
+    async def main():
+        await asyncio.gather(*(call() for _ in range(20)))
+
+    asyncio.run(main())
+    assert peak == 3
+    assert limiter.in_flight == 0
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from bfi import (BFI_QUESTIONS, BFI_SCALE, BFI_TRAITS, REVERSE_MAPPING, REVERSE_SCORED, compute_bfi_scores,
+                 compute_bfi_scores_matrix, sample_item_scores, score_from_distribution)
+
+N_ITEMS = len(BFI_QUESTIONS)
+
+
+def _loop_scores(all_scores):
+    """ベクトル化する前の項目ごとのループと同じ計算。"""
+    totals = {}
+    for trait, items in BFI_SCALE.items():
+        total = 0
+        for i in items:
+            x = all_scores[i - 1]
+            if i in REVERSE_SCORED and x in REVERSE_MAPPING:
+                x = REVERSE_MAPPING[x]
+            total += x
+        totals[trait] = total
+    return totals
+
+
+def test_matrix_matches_item_loop():
+    rng = np.random.default_rng(0)
+    score_matrix = rng.integers(0, 6, size=(50, N_ITEMS))  # 0 は無効な回答
+    by_matrix = compute_bfi_scores_matrix(score_matrix)
+    for r, row in enumerate(score_matrix.tolist()):
+        assert compute_bfi_scores(row) == _loop_scores(row)
+        assert {trait: by_matrix[trait][r] for trait in BFI_TRAITS} == _loop_scores(row)
+
+
+def test_expected_scores_reverse_as_six_minus_x():
+    scores = [2.5] * N_ITEMS
+    scores[5] = 1.2  # 6 番は逆転項目
+    result = compute_bfi_scores(scores)
+    # 外向性は 8 項目のうち 6・21・31 番が逆転項目
+    assert result["Extraversion"] == pytest.approx(2.5 * 5 + (6 - 1.2) + (6 - 2.5) * 2)
+    assert isinstance(result["Openness"], float)
+    assert isinstance(compute_bfi_scores([3] * N_ITEMS)["Openness"], int)
+
+
+def test_score_from_distribution():
+    dist = {1: 0.1, 2: 0.2, 3: 0.4, 4: 0.2, 5: 0.1}
+    assert score_from_distribution(dist, "argmax") == 3
+    assert score_from_distribution(dist, "expected") == pytest.approx(3.0)
+
+
+def test_sample_item_scores_shape_and_range():
+    dists = [{k: 0.2 for k in range(1, 6)} for _ in range(N_ITEMS)]
+    samples = sample_item_scores(dists, 100, np.random.default_rng(1), temperature=1.0, top_p=1.0)
+    assert samples.shape == (100, N_ITEMS)
+    assert samples.min() >= 1 and samples.max() <= 5
+    again = sample_item_scores(dists, 100, np.random.default_rng(1), temperature=1.0, top_p=1.0)
+    assert np.array_equal(samples, again)
+
+
+def test_sample_item_scores_follows_distribution_and_top_p():
+    dist = {1: 0.05, 2: 0.05, 3: 0.1, 4: 0.3, 5: 0.5}
+    samples = sample_item_scores([dist] * 4, 20000, np.random.default_rng(2), temperature=1.0, top_p=1.0)
+    freq = np.bincount(samples.ravel(), minlength=6)[1:] / samples.size
+    assert freq == pytest.approx([0.05, 0.05, 0.1, 0.3, 0.5], abs=0.01)
+    # top_p=0.5 なら最も確率の高い 5 だけが残る
+    assert (sample_item_scores([dist] * 4, 100, np.random.default_rng(3), temperature=1.0, top_p=0.5) == 5).all()
+    # top_p=0.8 なら 5 と 4 が残る
+    kept = sample_item_scores([dist] * 4, 2000, np.random.default_rng(4), temperature=1.0, top_p=0.8)
+    assert set(np.unique(kept)) == {4, 5}
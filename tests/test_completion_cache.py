@@ -0,0 +1,57 @@
+import json
+
+from completion_cache import CompletionCache, derive_seed
+from fake_backend import FakeLlama
+
+
+def _sum_sizes(cache):
+    return cache._conn.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+
+
+def _output(text):
+    return {"choices": [{"message": {"role": "assistant", "content": text}}]}
+
+
+def test_roundtrip_and_key(tmp_path):
+    cache = CompletionCache(tmp_path / "c.sqlite")
+    model = FakeLlama()
+    key = cache.make_key(model, "chat", {"messages": [{"role": "user", "content": "hi"}], "seed": 1})
+    assert key == cache.make_key(model, "chat", {"seed": 1, "messages": [{"role": "user", "content": "hi"}]})
+    assert key != cache.make_key(model, "chat", {"messages": [{"role": "user", "content": "hi"}], "seed": 2})
+    assert cache.get(key) is None
+    cache.put(key, "chat", _output("hello"))
+    assert cache.get(key) == _output("hello")
+    assert cache.stats == {"hits": 1, "misses": 1, "evictions": 0}
+    cache.close()
+
+
+def test_eviction_drops_least_recently_used(tmp_path):
+    entry_size = len(json.dumps(_output("x" * 100)))
+    cache = CompletionCache(tmp_path / "c.sqlite", max_bytes=3 * entry_size)
+    for name in ("a", "b", "c"):
+        cache.put(name, "chat", _output("x" * 100))
+    cache.get("a")  # b が最も古く参照されたものになる
+    cache.put("d", "chat", _output("x" * 100))
+    assert cache.get("b") is None
+    assert all(cache.get(name) is not None for name in ("a", "c", "d"))
+    assert cache.stats["evictions"] == 1
+    assert cache.total_bytes() == _sum_sizes(cache) == 3 * entry_size
+    cache.close()
+
+
+def test_running_total_survives_replace_and_reopen(tmp_path):
+    path = tmp_path / "c.sqlite"
+    cache = CompletionCache(path)
+    cache.put("k", "chat", _output("short"))
+    cache.put("k", "chat", _output("a much longer completion"))
+    assert cache.total_bytes() == _sum_sizes(cache)
+    cache.close()
+    reopened = CompletionCache(path)
+    assert reopened.total_bytes() == _sum_sizes(reopened)
+    reopened.close()
+
+
+def test_derive_seed_is_stable():
+    assert derive_seed(0, 1, "Agent1", 2) == derive_seed(0, 1, "Agent1", 2)
+    assert derive_seed(0, 1, "Agent1", 2) != derive_seed(0, 1, "Agent2", 2)
+    assert 0 <= derive_seed("x") < 2 ** 31
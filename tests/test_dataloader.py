@@ -0,0 +1,84 @@
+import os
+import pickle
+
+import pytest
+
+import dataloader as dl_module
+from dataloader import ColumnarStore, PickleStore, convert_to_columnar, dataloader, shard_bounds
+
+
+def _write_pickle(path, task_info, answers, **extra):
+    with open(path, "wb") as f:
+        pickle.dump({"task_info": task_info, "answer": answers, **extra}, f)
+
+
+def test_columnar_roundtrip_keeps_types(tmp_path):
+    src = tmp_path / "mmlu.pkl"
+    task_info = [("What is 1+1?", "1", "2", "3", "4"), ("日本語の問題", ("nested", 1), {1: "a"}, None, 2.5)]
+    answers = ["B", {3: ("x", "y")}]
+    _write_pickle(src, task_info, answers, ratio=0.5)
+    dirpath = convert_to_columnar(str(src), str(tmp_path / "mmlu.cols"))
+    pickled, columnar = PickleStore(str(src)), ColumnarStore(dirpath)
+    assert len(columnar) == len(pickled) == 2
+    for idx in range(2):
+        assert columnar.task_info(idx) == pickled.task_info(idx)
+        assert type(columnar.task_info(idx)) is tuple
+        assert columnar.answer(idx) == pickled.answer(idx)
+    assert columnar.task_info(1)[1] == ("nested", 1)
+    assert columnar.task_info(1)[2] == {1: "a"}
+    assert columnar.answer(1) == {3: ("x", "y")}
+
+
+def test_columnar_non_tuple_rows(tmp_path):
+    src = tmp_path / "math.pkl"
+    _write_pickle(src, ["1+1", "2+2", ""], [2, 4, 0])
+    store = ColumnarStore(convert_to_columnar(str(src), str(tmp_path / "math.cols")))
+    assert [store.task_info(i) for i in range(3)] == ["1+1", "2+2", ""]
+    assert [store.answer(i) for i in range(3)] == [2, 4, 0]
+
+
+def test_reconvert_replaces_directory_without_leftovers(tmp_path):
+    src = tmp_path / "mmlu.pkl"
+    dirpath = str(tmp_path / "mmlu.cols")
+    _write_pickle(src, [("q1", "a", "b", "c", "d")], ["A"])
+    convert_to_columnar(str(src), dirpath)
+    old_store = ColumnarStore(dirpath)
+    _write_pickle(src, [("q2", "a", "b", "c", "d"), ("q3", "a", "b", "c", "d")], ["B", "C"])
+    convert_to_columnar(str(src), dirpath)
+    assert sorted(os.listdir(tmp_path)) == ["mmlu.cols", "mmlu.pkl"]
+    assert ColumnarStore(dirpath).task_info(1)[0] == "q3"
+    # 置き換え前に mmap したストアは古いデータを読み続けられる
+    assert old_store.task_info(0)[0] == "q1"
+
+
+def test_old_cell_format_is_rejected(tmp_path):
+    src = tmp_path / "mmlu.pkl"
+    _write_pickle(src, [("q", "a", "b", "c", "d")], ["A"])
+    dirpath = convert_to_columnar(str(src), str(tmp_path / "mmlu.cols"))
+    meta_path = os.path.join(dirpath, "meta.json")
+    with open(meta_path, encoding="utf-8") as f:
+        text = f.read()
+    with open(meta_path, "w", encoding="utf-8") as f:
+        f.write(text.replace('"cell_format": "pickle"', '"cell_format": "json"'))
+    with pytest.raises(ValueError):
+        ColumnarStore(dirpath)
+
+
+def test_dataloader_backends_agree(tmp_path, monkeypatch):
+    src = tmp_path / "mmlu.pkl"
+    task_info = [(f"q{i}", "a", "b", "c", "d") for i in range(5)]
+    _write_pickle(src, task_info, ["ABCD"[i % 4] for i in range(5)])
+    monkeypatch.setitem(dl_module.dataloader.FILE_PATH, "mmlu", str(src))
+    by_backend = {}
+    for backend in ("pickle", "columnar"):
+        loader = dataloader("mmlu", n_case=4, backend=backend)
+        loader.set_mode("all")
+        by_backend[backend] = [loader[i] for i in range(len(loader))]
+        assert list(loader.prefetch(range(len(loader)), depth=2)) == list(enumerate(by_backend[backend]))
+    assert by_backend["pickle"] == by_backend["columnar"]
+    assert len(by_backend["columnar"]) == 4
+
+
+def test_shard_bounds_cover_range():
+    assert shard_bounds(10, 3) == [(0, 4), (4, 7), (7, 10)]
+    assert shard_bounds(2, 5) == [(0, 1), (1, 2)]
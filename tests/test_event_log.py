@@ -0,0 +1,24 @@
+from event_log import EventLog, TextLog, iter_events
+
+
+def test_text_log_keeps_write_order(tmp_path):
+    path = tmp_path / "debate.log"
+    with TextLog(str(path), batch_size=3) as log_f:
+        for i in range(10):
+            log_f.write(f"line {i}\n")
+        log_f.flush()
+    assert path.read_text(encoding="utf-8").splitlines() == [f"line {i}" for i in range(10)]
+    with TextLog(str(path), append=True) as log_f:
+        log_f.write("appended\n")
+    assert path.read_text(encoding="utf-8").splitlines()[-1] == "appended"
+
+
+def test_event_log_roundtrip(tmp_path):
+    path = str(tmp_path / "events.jsonl")
+    with EventLog(path, run_id="r1") as events:
+        events.emit("answer", question=1, agent="Agent1")
+        events.emit("final", question=1)
+    records = list(iter_events([path]))
+    assert [r["event"] for r in records] == ["answer", "final"]
+    assert all(r["run_id"] == "r1" for r in records)
+    assert [r["event"] for r in iter_events([path], event="final")] == ["final"]
@@ -0,0 +1,113 @@
+import json
+import random
+
+import numpy as np
+
+from fake_backend import FakeLlama, quoting_script
+
+MESSAGES = [{"role": "system", "content": "You are Agent1."}, {"role": "user", "content": "Which option is correct?"}]
+
+
+def _content(output):
+    return output["choices"][0]["message"]["content"]
+
+
+def _record_evals(model):
+    sizes = []
+    original = model.eval
+
+    def eval(tokens):
+        tokens = list(tokens)
+        sizes.append(len(tokens))
+        original(tokens)
+
+    model.eval = eval
+    return sizes
+
+
+def test_same_seed_same_output():
+    a = FakeLlama(seed=0).create_chat_completion(MESSAGES, seed=7)
+    b = FakeLlama(seed=0).create_chat_completion(MESSAGES, seed=7)
+    c = FakeLlama(seed=0).create_chat_completion(MESSAGES, seed=8)
+    assert _content(a) == _content(b)
+    assert _content(a) != _content(c)
+    assert json.loads(_content(a))["answer"] in "ABCD"
+    assert a["usage"]["total_tokens"] == a["usage"]["prompt_tokens"] + a["usage"]["completion_tokens"]
+
+
+def test_stream_matches_non_stream():
+    full = FakeLlama(seed=0).create_chat_completion(MESSAGES, seed=1)
+    chunks = list(FakeLlama(seed=0).create_chat_completion(MESSAGES, seed=1, stream=True))
+    text = "".join(c["choices"][0]["delta"].get("content", "") for c in chunks)
+    assert text == _content(full)
+    assert chunks[-1]["choices"][0]["finish_reason"] == "stop"
+
+
+def test_stop_and_length():
+    model = FakeLlama(seed=0)
+    full = _content(model.create_chat_completion(MESSAGES, seed=1))
+    stopped = model.create_chat_completion(MESSAGES, seed=1, stop='"answer"')
+    assert _content(stopped) == full[:full.index('"answer"')]
+    assert stopped["choices"][0]["finish_reason"] == "stop"
+    short = model.create_chat_completion(MESSAGES, seed=1, max_tokens=3)
+    assert short["usage"]["completion_tokens"] == 3
+    assert short["choices"][0]["finish_reason"] == "length"
+
+
+def test_shared_prefix_is_not_evaluated_again():
+    model = FakeLlama(seed=0)
+    sizes = _record_evals(model)
+    model.create_completion("a shared persona prompt about the question", max_tokens=1)
+    first = sizes[0]
+    sizes.clear()
+    model.create_completion("a shared persona prompt about the question and more", max_tokens=1)
+    assert sizes[0] == 2
+    assert first > sizes[0]
+
+
+def test_save_and_load_state():
+    model = FakeLlama(seed=0)
+    model.create_completion("persona prompt", max_tokens=1)
+    state = model.save_state()
+    model.create_completion("something completely different here", max_tokens=1)
+    model.load_state(state)
+    assert model.n_tokens == state.n_tokens
+    assert np.array_equal(model._input_ids, state.input_ids[:state.n_tokens])
+
+
+def test_draft_model_keeps_output_and_batches_steps():
+    class OracleDraft:
+        """次に来るトークンを知っている下書き（受理率 100%）。"""
+        def __init__(self):
+            self.tokens = []
+
+        def __call__(self, input_ids):
+            ids = input_ids.tolist()
+            for start in range(len(ids)):
+                if ids[start:] == self.tokens[:len(ids) - start]:
+                    return np.asarray(self.tokens[len(ids) - start:len(ids) - start + 4], dtype=np.intc)
+            return np.zeros(0, dtype=np.intc)
+
+    plain = FakeLlama(seed=0)
+    plain_sizes = _record_evals(plain)
+    expected = plain.create_chat_completion(MESSAGES, seed=3)
+
+    model = FakeLlama(seed=0)
+    draft = OracleDraft()
+    prompt_tokens = model.tokenize(model.format_chat(MESSAGES).encode("utf-8"), add_bos=True, special=True)
+    draft.tokens = prompt_tokens + model.tokenize(_content(expected).encode("utf-8"), add_bos=False)
+    model.draft_model = draft
+    sizes = _record_evals(model)
+    output = model.create_chat_completion(MESSAGES, seed=3)
+    assert _content(output) == _content(expected)
+    assert output["usage"] == expected["usage"]
+    assert len(sizes) < len(plain_sizes)
+    assert max(sizes[1:]) > 1
+
+
+def test_quoting_script_copies_peer_reasoning():
+    peer = "the condition holds for option b because the facts say so clearly"
+    prompt = f"Other agents said: {{'reasoning': '{peer}', 'answer': 'B'}}"
+    reasoning = json.loads(quoting_script("chat", prompt, random.Random(0)))["reasoning"].lower()
+    quoted = [w for w in peer.split() if w in reasoning.split()]
+    assert len(quoted) >= int(len(peer.split()) * 0.7)
@@ -0,0 +1,52 @@
+import json
+
+from json_stream import JsonFieldScanner, parse_partial
+
+OBJECT = {"reasoning": "A は \"誤り\"、\\ B が正しい", "confidence": 0.8, "ok": True,
+          "meta": {"answer": "nested"}, "options": ["A", "B"], "answer": "B"}
+
+
+def _feed_in_pieces(text, size):
+    scanner = JsonFieldScanner()
+    for i in range(0, len(text), size):
+        scanner.feed(text[i:i+size])
+    return scanner
+
+
+def test_chunked_feed_matches_json_loads():
+    text = "Sure, here is my answer:\n" + json.dumps(OBJECT, ensure_ascii=False) + "\ntrailing text"
+    expected = {k: v for k, v in OBJECT.items() if not isinstance(v, (dict, list))}
+    for size in (1, 2, 7, len(text)):
+        scanner = _feed_in_pieces(text, size)
+        assert scanner.fields == expected
+        assert scanner.closed
+
+
+def test_partial_object_keeps_only_closed_fields():
+    text = '{"reasoning": "because", "confidence": 0.75, "answer": "C'
+    assert parse_partial(text) == {"reasoning": "because", "confidence": 0.75}
+    # 数値は区切りが来るまで閉じていない
+    assert parse_partial('{"reasoning": "because", "confidence": 0.75') == {"reasoning": "because"}
+    assert parse_partial('{"reasoning": "because", "confidence": 0.75,') == {"reasoning": "because", "confidence": 0.75}
+    assert parse_partial("no json here") == {}
+
+
+def test_done_conditions():
+    scanner = JsonFieldScanner().feed('{"answer": "A", "reasoning": "x')
+    assert scanner.done("answer")
+    assert not scanner.done("object")
+    scanner.feed('yz"}')
+    assert scanner.done("object")
+    assert scanner.fields == {"answer": "A", "reasoning": "xyz"}
+
+
+def test_nested_answer_key_is_ignored():
+    scanner = JsonFieldScanner().feed('{"meta": {"answer": "D"}, "answer": "A"}')
+    assert scanner.fields == {"answer": "A"}
+    scanner = JsonFieldScanner().feed('{"meta": {"answer": "D"}')
+    assert not scanner.done("answer")
+
+
+def test_feed_after_close_is_ignored():
+    scanner = JsonFieldScanner().feed('{"answer": "A"} {"answer": "B"}')
+    assert scanner.fields == {"answer": "A"}
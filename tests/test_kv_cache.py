@@ -0,0 +1,25 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+pytest.importorskip("llama_cpp")
+
+from kv_cache import compact_state  # noqa: E402
+
+
+def _state(n_ctx=64, n_tokens=10, n_vocab=32):
+    scores = np.arange(n_ctx * n_vocab, dtype=np.float32).reshape(n_ctx, n_vocab)
+    return SimpleNamespace(scores=scores, n_tokens=n_tokens)
+
+
+def test_logits_all_keeps_only_rows_in_use():
+    state = compact_state(SimpleNamespace(_logits_all=True), _state())
+    assert state.scores.shape == (10, 32)
+    assert state.scores.base is None  # n_ctx 行の配列を参照し続けない
+    assert np.array_equal(state.scores[-1], np.arange(9 * 32, 10 * 32, dtype=np.float32))
+
+
+def test_last_token_only_keeps_one_row():
+    state = compact_state(SimpleNamespace(_logits_all=False), _state())
+    assert state.scores.shape == (1, 32)
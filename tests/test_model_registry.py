@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+
+import pytest
+
+import config
+import model_registry
+from model_registry import ModelRegistry
+
+
+@pytest.fixture
+def models_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "OFFLINE", True)
+    return tmp_path / "models"
+
+
+def _write_model(path, data=b"GGUF" + b"\0" * 1024):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return hashlib.sha256(data).hexdigest()
+
+
+def _count_hashes(monkeypatch):
+    calls = []
+    original = model_registry.file_sha256
+
+    def file_sha256(path, *args, **kwargs):
+        calls.append(str(path))
+        return original(path, *args, progress=False)
+
+    monkeypatch.setattr(model_registry, "file_sha256", file_sha256)
+    return calls
+
+
+def test_resolve_registers_local_file_and_then_trusts_stat(models_dir, monkeypatch):
+    digest = _write_model(models_dir / "m.gguf")
+    hashes = _count_hashes(monkeypatch)
+    registry = ModelRegistry(models_dir / "registry.json")
+    path = registry.resolve("m.gguf")
+    assert path == str(models_dir / "m.gguf")
+    assert len(hashes) == 1
+    # 相対パスで記録されるので台帳はディレクトリごと運べる
+    stored = json.loads((models_dir / "registry.json").read_text(encoding="utf-8"))["models"]["m.gguf"]
+    assert stored["path"] == "m.gguf" and stored["sha256"] == digest
+    assert ModelRegistry(models_dir / "registry.json").resolve("m.gguf") == path
+    assert len(hashes) == 1
+
+
+def test_mtime_change_rehashes_and_size_change_fails(models_dir, monkeypatch):
+    model = models_dir / "m.gguf"
+    _write_model(model)
+    hashes = _count_hashes(monkeypatch)
+    registry = ModelRegistry(models_dir / "registry.json")
+    registry.register("m", model)
+    st = os.stat(model)
+    os.utime(model, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    registry.resolve("m")
+    assert len(hashes) == 2
+    registry.resolve("m")
+    assert len(hashes) == 2
+    _write_model(model, b"GGUF" + b"\1" * 2048)
+    with pytest.raises(ValueError, match="changed size"):
+        registry.resolve("m")
+
+
+def test_same_size_different_content_is_rejected(models_dir):
+    model = models_dir / "m.gguf"
+    _write_model(model)
+    registry = ModelRegistry(models_dir / "registry.json")
+    registry.register("m", model)
+    st = os.stat(model)
+    _write_model(model, b"GGUF" + b"\2" * 1024)
+    os.utime(model, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    with pytest.raises(ValueError, match="checksum mismatch"):
+        registry.resolve("m")
+
+
+def test_register_checks_expected_sha256(models_dir):
+    model = models_dir / "m.gguf"
+    _write_model(model)
+    with pytest.raises(ValueError, match="checksum mismatch"):
+        ModelRegistry(models_dir / "registry.json").register("m", model, sha256="0" * 64)
+
+
+def test_missing_model_offline_raises(models_dir):
+    with pytest.raises(FileNotFoundError, match="offline"):
+        ModelRegistry(models_dir / "registry.json").resolve("absent.gguf")
+
+
+def test_loader_options_layer_over_config(models_dir):
+    model = models_dir / "m.gguf"
+    _write_model(model)
+    registry = ModelRegistry(models_dir / "registry.json")
+    registry.register("m", model, verify=False, use_mlock=True)
+    registry.set_loader_options("m", n_gpu_layers=10)
+    options = ModelRegistry(models_dir / "registry.json").loader_options("m")
+    assert options == {**config.MODEL_LOADER_OPTIONS, "use_mlock": True, "n_gpu_layers": 10}
+    assert registry.name_for_path(model) == "m"
+    assert registry.name_for_path(models_dir / "other.gguf") is None
@@ -0,0 +1,48 @@
+"""
+FakeLlama でディベート1問・BFI 1項目・MBTI 1項目を通すスモークテスト。
+FakeLlama は llama_cpp.Llama と同じ属性だけを持つので、実モデルにない API を使うとここで落ちる。
+"""
+import io
+
+import pytest
+
+pytest.importorskip("llama_cpp")
+
+from agents import AgentTriad, MBTIAnswer  # noqa: E402
+from bfi import BFI_QUESTIONS  # noqa: E402
+from fake_backend import FakeLlama  # noqa: E402
+from kv_cache import AgentSessionManager, PersonaStateCache  # noqa: E402
+from main import bigfive_prompts, build_agents, format_mmlu_question, run_debate  # noqa: E402
+
+PERSONALITIES = [bigfive_prompts["AgentT1"], bigfive_prompts["AgentT2"], bigfive_prompts["AgentT3"]]
+
+
+@pytest.fixture
+def model():
+    return FakeLlama(seed=0)
+
+
+def test_debate_question(model, tmp_path):
+    kv_sessions = AgentSessionManager(PersonaStateCache(cache_dir=tmp_path / "persona"), spill_dir=tmp_path / "sessions")
+    triad = AgentTriad(*build_agents(model, PERSONALITIES, kv_sessions))
+    question = format_mmlu_question(("Which option is correct?", "one", "two", "three", "four"))
+    final_answer = run_debate(triad, question, io.StringIO(), seed_key=(0, 1))
+    kv_sessions.close()
+    assert final_answer in {"A", "B", "C", "D"}
+    assert set(triad.round_responses[1]) == {"Agent1", "Agent2", "Agent3"}
+    assert all(usage["completion_tokens"] > 0 for usage in triad.round_usage[1].values())
+
+
+def test_bfi_item(model):
+    agent = build_agents(model, PERSONALITIES)[0]
+    dist = agent.get_bfi_distribution(BFI_QUESTIONS[0], 1, len(BFI_QUESTIONS))
+    assert sorted(dist) == [1, 2, 3, 4, 5]
+    assert sum(dist.values()) == pytest.approx(1.0)
+    assert 1 <= agent.get_bfi_score(BFI_QUESTIONS[0], 1, len(BFI_QUESTIONS), seed=0) <= 5
+
+
+def test_mbti_item(model):
+    agent = build_agents(model, PERSONALITIES)[0]
+    answer, probs = agent.answer_mbti("Question 1: Do you prefer...\nA. parties\nB. books\nAnswer with only 'A' or 'B'.")
+    assert isinstance(answer, MBTIAnswer)
+    assert probs["A"] + probs["B"] == pytest.approx(1.0)
@@ -1,39 +1,137 @@
+import argparse
+import csv
+import glob
 import re
 
+from event_log import iter_events
+
+VALID_ANSWERS = ['A', 'B', 'C', 'D']
+
+
+class RunStats:
+    """1つの実行（または全実行の合計）についての集計値。"""
+    def __init__(self):
+        self.questions = 0
+        self.valid = 0
+        self.scored = 0
+        self.correct = 0
+        self.token_count = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.rounds = 0
+        self.stop_reasons = {}
+
+    def add_final(self, event):
+        self.questions += 1
+        self.rounds += event.get("rounds", 3) or 3
+        if event.get("stop_reason"):
+            self.stop_reasons[event["stop_reason"]] = self.stop_reasons.get(event["stop_reason"], 0) + 1
+        self.prompt_tokens += event.get("prompt_tokens", 0) or 0
+        self.completion_tokens += event.get("completion_tokens", 0) or 0
+        if event.get("correct_answer"):
+            self.scored += 1
+            if event.get("is_correct"):
+                self.correct += 1
+        # 従来の集計と同じく、最終回答が A～D（N/A以外）の問題だけの単語数
+        if event.get("final_answer") in VALID_ANSWERS:
+            self.valid += 1
+            self.token_count += event.get("token_count", 0) or 0
+
+
+class AgentStats:
+    """エージェントごとの集計値（回答数、有効回答率、トークン数、最終回答との一致、意見の変更）。"""
+    def __init__(self):
+        self.turns = 0
+        self.valid = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.agree_final = 0
+        self.questions = 0
+        self.changed = 0
+
+
+def analyze_event_logs(paths):
+    """
+    JSONL イベントログ（event_log.EventLog の出力）を1行ずつ読んで集計する。
+    ファイルをまるごと読み込まないので、多数の実行ファイルでも一定のメモリで動く。
+    （回答が最終回答と一致したかを調べるため、最終回答前の1問分の turn だけは保持する）
+    戻り値は (実行ごとの RunStats, 全体の RunStats, エージェントごとの AgentStats)。
+    """
+    runs = {}
+    overall = RunStats()
+    agents = {}
+    pending = {}
+
+    for event in iter_events(paths):
+        kind = event.get("event")
+        key = (event.get("run_id"), event.get("task_index"))
+        if kind == "turn":
+            stats = agents.setdefault(event["agent"], AgentStats())
+            stats.turns += 1
+            stats.prompt_tokens += event.get("prompt_tokens", 0) or 0
+            stats.completion_tokens += event.get("completion_tokens", 0) or 0
+            if event.get("answer") in VALID_ANSWERS:
+                stats.valid += 1
+            pending.setdefault(key, {}).setdefault(event["agent"], []).append(event.get("answer"))
+        elif kind == "final":
+            runs.setdefault(event.get("run_id"), RunStats()).add_final(event)
+            overall.add_final(event)
+            for agent_name, answers in pending.pop(key, {}).items():
+                stats = agents[agent_name]
+                stats.questions += 1
+                if answers[-1] == event.get("final_answer"):
+                    stats.agree_final += 1
+                if len(set(answers)) > 1:
+                    stats.changed += 1
+    return runs, overall, agents
+
+
+def print_event_summary(runs, overall, agents):
+    def line(name, s):
+        accuracy = f"{s.correct / s.scored * 100:.1f}% ({s.correct}/{s.scored})" if s.scored else "-"
+        average = f"{s.token_count / s.valid:.2f}" if s.valid else "-"
+        print(f"{name}: 問題数 {s.questions}, A～D {s.valid}, 正解率 {accuracy}, "
+              f"単語数 合計 {s.token_count} / 平均 {average}, "
+              f"prompt tokens {s.prompt_tokens}, completion tokens {s.completion_tokens}")
+        if s.stop_reasons:
+            reasons = ", ".join(f"{reason} {count}" for reason, count in sorted(s.stop_reasons.items()))
+            print(f"    早期終了: {reasons}（平均ラウンド数 {s.rounds / s.questions:.2f}）")
+
+    for run_id, s in sorted(runs.items(), key=lambda item: str(item[0])):
+        line(run_id, s)
+    if len(runs) > 1:
+        line("合計", overall)
+    for agent_name, s in sorted(agents.items()):
+        valid_rate = s.valid / s.turns * 100 if s.turns else 0.0
+        agree_rate = s.agree_final / s.questions * 100 if s.questions else 0.0
+        avg_completion = s.completion_tokens / s.turns if s.turns else 0.0
+        print(f"{agent_name}: 回答数 {s.turns}, A～D の回答 {valid_rate:.1f}%, 最終回答と一致 {agree_rate:.1f}%, "
+              f"意見を変えた問題 {s.changed}/{s.questions}, completion tokens 平均 {avg_completion:.1f}")
+
+
 def parse_mmlu_file(file_path):
     """
-    与えられた形式のテキストファイルを解析し、
+    旧形式のテキストログ（debate_log_*.txt）を1行ずつ読み、
     [Final Consensus Answer] answer: が A～D（N/A以外）の問題だけを対象に
     Total token count for debate: の数値を集計して、
-    合計値と平均値を返す関数。
+    合計値と平均値を表示する関数。新しい実行では analyze_event_logs を使う。
     """
-    
-    # ファイルの内容を全て読み込み
-    with open(file_path, "r", encoding="utf-8") as f:
-        text = f.read()
-
-    # 各問題ブロックごとに分割
-    #   例: "--- MMLU Q1 ---" から始まるブロックを取り出す
-    #      ただし先頭に空要素が来るかもしれないのでフィルタする
-    problem_blocks = re.split(r'-{3,}\s*MMLU\s+Q\d+\s*-{3,}', text)
-    problem_blocks = [block.strip() for block in problem_blocks if block.strip()]
-
     token_counts = []
+    final_answer = None
 
-    for block in problem_blocks:
-        # [Final Consensus Answer] を探す
-        #  例: [Final Consensus Answer] answer: A
-        match_answer = re.search(r'\[Final Consensus Answer\]\s+answer:\s+(\S+)', block)
-        if match_answer:
-            final_answer = match_answer.group(1).strip()
-            print(f"final_answer: {final_answer}")
-            # A, B, C, D のいずれかなら対象とする
-            if final_answer in ['A', 'B', 'C', 'D']:
-                # "Total token count for debate: XXX" の部分を探す
-                match_tokens = re.search(r'Total token count for debate:\s*(\d+)', block)
-                if match_tokens:
-                    token_count = int(match_tokens.group(1))
-                    token_counts.append(token_count)
+    with open(file_path, "r", encoding="utf-8") as f:
+        for line in f:
+            # 問題ブロックの始まり（例: "--- MMLU Q1 ---"）で状態をリセット
+            if re.match(r'-{3,}\s*MMLU\s+Q\d+\s*-{3,}', line):
+                final_answer = None
+                continue
+            match_answer = re.search(r'\[Final Consensus Answer\]\s+answer:\s+(\S+)', line)
+            if match_answer:
+                final_answer = match_answer.group(1).strip()
+                continue
+            match_tokens = re.search(r'Total token count for debate:\s*(\d+)', line)
+            if match_tokens and final_answer in VALID_ANSWERS:
+                token_counts.append(int(match_tokens.group(1)))
 
     # 集計
     if not token_counts:
@@ -48,8 +146,47 @@ def parse_mmlu_file(file_path):
     print(f"Total token countの平均値         : {average_tokens:.2f}")
 
 
+def parse_mmlu_results_csv(csv_path):
+    """
+    結果 CSV の prompt_tokens / completion_tokens 列（モデルが実際に処理したトークン数）を
+    最終回答が A～D の問題について集計して表示する。
+    """
+    usage_rows = []
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            if row.get("final_answer") in VALID_ANSWERS and row.get("prompt_tokens"):
+                usage_rows.append(row)
+
+    if not usage_rows:
+        print("トークン使用量の列を持つ有効なデータが見つかりませんでした。")
+        return
+
+    prompt_total = sum(int(r["prompt_tokens"]) for r in usage_rows)
+    completion_total = sum(int(r["completion_tokens"]) for r in usage_rows)
+    evaluated_total = sum(int(r["prompt_eval_tokens"]) for r in usage_rows)
+
+    print(f"対象の問題数                      : {len(usage_rows)}")
+    print(f"prompt tokens の合計値 / 平均値     : {prompt_total} / {prompt_total / len(usage_rows):.2f}")
+    print(f"completion tokens の合計値 / 平均値 : {completion_total} / {completion_total / len(usage_rows):.2f}")
+    print(f"実際に評価した prompt tokens の合計 : {evaluated_total}")
+
+
 if __name__ == "__main__":
-    # 解析したいファイルのパスを指定
-    file_path = "results/debate_log_TeamT2_20250212_105424.txt"
-    
-    parse_mmlu_file(file_path)
+    parser = argparse.ArgumentParser(description="ディベート実験のログからトークン数・正解率・エージェント別の統計を集計する")
+    parser.add_argument("paths", nargs="*", default=["results/events_*.jsonl"],
+                        help="イベントログ（*.jsonl、glob 可）。旧形式の *.txt、結果の *.csv も指定できる")
+    args = parser.parse_args()
+
+    files = sorted(path for pattern in args.paths for path in glob.glob(pattern))
+    event_files = [path for path in files if path.endswith(".jsonl")]
+    if event_files:
+        print_event_summary(*analyze_event_logs(event_files))
+    for path in files:
+        if path.endswith(".txt"):
+            print(f"\n{path}")
+            parse_mmlu_file(path)
+        elif path.endswith(".csv"):
+            print(f"\n{path}")
+            parse_mmlu_results_csv(path)
+    if not files:
+        print("有効なデータが見つかりませんでした。")